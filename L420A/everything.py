@@ -1,13 +1,23 @@
-import premise as ps
-import bw2io as bi
 import bw2data as bd
 import bw2calc as bc
 import uuid
+import json
+import os
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import sys
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from stats_arrays import MCRandomNumberGenerator
 from Simulation.sim_BM import *
 
 def setup():
+    # the importers are only needed to build the projects
+    import premise as ps
+    import bw2io as bi
 
     bd.projects.set_current('MCCFF')
 
@@ -55,6 +65,8 @@ def setup():
     # ndb.write_db_to_brightway(["SSP2-RCP26_2020", "SSP2-RCP26_2030", "SSP2-RCP26_2040", "SSP2-RCP26_2050", "SSP2-RCP26_2060", "SSP2-RCP26_2070", "SSP2-RCP26_2080"])
 
 def setup_ecoinvent_static() :
+    import bw2io as bi
+
     bd.projects.set_current('MCCFF_static')
 
     bi.bw2setup()
@@ -72,7 +84,8 @@ def setup_ecoinvent_static() :
         
 
 
-def constructor_main(file, sheet):
+def constructor_main(file, sheet, registry = None):
+    '''This function creates the construction products of a sheet in registry, defaults to Product.default_registry'''
     building_data_construction = pd.read_excel(io = file, sheet_name = sheet, engine = 'openpyxl')
     for index in building_data_construction.index :
         Product(name=building_data_construction['Ecoinvent_activity_construction'][index],
@@ -81,10 +94,14 @@ def constructor_main(file, sheet):
                 unit = building_data_construction['Unit'][index],
                 service_life = building_data_construction['Service_life'][index],
                 production_lci = building_data_construction['Ecoinvent_key_construction'][index],
-                eol_lci = building_data_construction['Ecoinvent_key_eol'][index]
+                eol_lci = building_data_construction['Ecoinvent_key_eol'][index],
+                registry = registry
             )
 
-def renovation_main(file, sheet):
+def renovation_main(file, sheet, registry = None):
+    '''This function creates the renovation products of a sheet in registry, defaults to Product.default_registry'''
+    if registry is None:
+        registry = Product.default_registry
     building_data_renovation = pd.read_excel(io = file, sheet_name = sheet, engine = 'openpyxl')
     for index in building_data_renovation.index :
         Product(name=building_data_renovation['Ecoinvent_activity_renovation'][index],
@@ -95,25 +112,95 @@ def renovation_main(file, sheet):
                 production_lci = building_data_renovation['Ecoinvent_key_renovation'][index],
                 eol_lci = building_data_renovation['Ecoinvent_key_renovation_eol'][index],
                 major_renovation_possible = True,
-                renovation_product = True
+                renovation_product = True,
+                registry = registry
             )
-        # check if there is a match in id between renovation and construction products and if yes then set major renovation possible to true
-        for product in Product.real_instances:
-            if product.id == building_data_renovation['ID'][index]:
-                product.major_renovation_possible = True
+        # the construction products with the same id can now be renovated
+        for product in registry.construction_products(building_data_renovation['ID'][index]):
+            product.major_renovation_possible = True
+
+class ProductRegistry:
+    '''This class keeps the products of a study, it should take care of the following:
+    - Keep the construction (real) and renovation products in their order of creation
+    - Index the construction and renovation products by id, so that matching a product with its renovation variants
+      does not scan all the products
+    - Be created for each study, so that running a study again does not add its products to those of the previous run
+    '''
+    def __init__(self):
+        self.real_instances = []
+        self.renovation_instances = []
+        self.all_instances = []
+        self.construction_by_id = {}
+        self.renovation_by_id = {}
+        # position of each product in all_instances
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.all_instances)
+
+    def add(self, product):
+        '''This function adds a product to the lists and indexes'''
+        if not product.renovation_product:
+            self.real_instances.append(product)
+            self.construction_by_id.setdefault(product.id, []).append(product)
+        else:
+            self.renovation_instances.append(product)
+            self.renovation_by_id.setdefault(product.id, []).append(product)
+        self.positions[product] = len(self.all_instances)
+        self.all_instances.append(product)
+
+    def position(self, product) -> int:
+        '''This function returns the position of a product in all_instances'''
+        if product not in self.positions:
+            raise ValueError(f"{product} is not in the registry of the study")
+        return self.positions[product]
+
+    def construction_products(self, id) -> list:
+        '''This function returns the construction products with an id'''
+        return self.construction_by_id.get(id, [])
+
+    def renovation_products(self, id) -> list:
+        '''This function returns the renovation products with an id'''
+        return self.renovation_by_id.get(id, [])
+
+    def product_table(self) -> pd.DataFrame:
+        '''
+        This function returns the attributes of all_instances used by the time line as a table, construction_match
+        being the position of the first construction product with the same id, -1 if there is none'''
+        products = self.all_instances
+        construction_match = [self.positions[self.construction_by_id[p.id][0]] if p.id in self.construction_by_id
+                              else -1 for p in products]
+        return pd.DataFrame({'production_lci': pd.Series([p.production_lci for p in products], dtype=object),
+                             'eol_lci': pd.Series([p.eol_lci for p in products], dtype=object),
+                             'amount': np.array([p.amount for p in products], dtype=float),
+                             'renovation_product': np.array([p.renovation_product for p in products], dtype=bool),
+                             'construction_match': np.array(construction_match, dtype=np.int64)})
+
+    def clear(self):
+        '''This function removes all the products, the lists are emptied in place'''
+        for products in [self.real_instances, self.renovation_instances, self.all_instances]:
+            products.clear()
+        self.construction_by_id.clear()
+        self.renovation_by_id.clear()
+        self.positions.clear()
 
 class Product:
     '''This class represents a product in the system, it should take care of the following:
     - Create a unique id for each product
     - Create a unique serial number for each product
     - Keep track of the product's service life
+    - Register the product in the registry of its study
     '''
-    # keep track of all instances of the class
-    real_instances = []
-    all_instances = []
-    renovation_instances = []
+    # fixed attributes keep the products of large portfolios compact
+    __slots__ = ('random_id', 'id', 'name', 'amount', 'unit', 'production_lci', 'service_life', 'eol_lci',
+                 'embodied_impacts', 'major_renovation_possible', 'renovation_product')
+    # registry of the products created without one, its lists are also available on the class
+    default_registry = ProductRegistry()
+    real_instances = default_registry.real_instances
+    all_instances = default_registry.all_instances
+    renovation_instances = default_registry.renovation_instances
     def __init__(self, name: str, id: int, amount: float, unit: str, service_life: int = None, production_lci: str = None, eol_lci: tuple[str,str] = None,
-                major_renovation_possible : bool = False, renovation_product = False):
+                major_renovation_possible : bool = False, renovation_product = False, registry: ProductRegistry = None):
         # randomly generated id
         self.random_id = uuid.uuid4().hex
         self.id = id
@@ -126,12 +213,10 @@ class Product:
         self.embodied_impacts = {}
         self.major_renovation_possible = major_renovation_possible
         self.renovation_product = renovation_product
-        # only append if not renovation product
-        if not self.renovation_product:
-            self.real_instances.append(self)
-        else:
-            self.renovation_instances.append(self)
-        self.all_instances.append(self)
+        # keep track of the products of the study
+        if registry is None:
+            registry = self.default_registry
+        registry.add(self)
 
     # better representation of the class for humans
     def __repr__(self):
@@ -141,14 +226,26 @@ class Product:
         ...
         
 
+def expand(counts):
+    '''This function returns, for counts.sum() items split between owners, the owner of each item and its rank among
+    the items of its owner'''
+    counts = np.asarray(counts, dtype=np.int64)
+    owners = np.repeat(np.arange(counts.shape[0]), counts)
+    ranks = np.arange(owners.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, ranks
+
 class Mfa:
     '''
     This class represents a material flow analysis, it should take care of the following:
     - Create a time line for the analysis
     - Create a list of points in time where replacements occur
+    - Match the products with their renovation variants in the registry of the study
+    - Calculate the points and events of all the products at once with arrays
     '''
-    def __init__(self, start: int = 2020, end: int = 2080, time_step: int = 10):
+    def __init__(self, start: int = 2020, end: int = 2080, time_step: int = 10, registry: ProductRegistry = None):
         self.start = start
+        # products of the study, defaults to Product.default_registry
+        self.registry = registry if registry is not None else Product.default_registry
         self.end = end
         self.time_step = time_step
         self.time_line = list(range(self.start, self.end+1, self.time_step)) # create a time line
@@ -157,40 +254,77 @@ class Mfa:
         self.max_year = self.get_max_db_year()
         
     
+    def replacement_years(self, service_lives):
+        '''
+        This function calculates the replacement years of products from their service lives, the years of
+        range(start + service_life, end - 1, service_life) of all the products at once. Returns the position of the
+        product of each year in service_lives and the years'''
+        service_lives = np.asarray(service_lives, dtype=np.int64)
+        if np.any(service_lives <= 0):
+            raise ValueError("The service lives must be positive")
+        first_repl = service_lives + self.start
+        # number of years of each range, rounded up
+        counts = np.maximum(0, -((first_repl - (self.end - 1)) // service_lives))
+        owners, ranks = expand(counts)
+        return owners, first_repl[owners] + ranks * service_lives[owners]
+
+    def timeline_points(self, products, replacements: bool = True, eol: bool = True):
+        '''
+        This function calculates the replacement and/or eol points of products, a product whose major renovation is
+        possible being replaced by its renovation variants. Returns the years and the positions in
+        registry.all_instances of the points'''
+        # products of the points of each product, the product itself or its renovation variants
+        targets = [[self.registry.position(p) for p in self.registry.renovation_products(product.id)]
+                   if product.major_renovation_possible else [self.registry.position(product)] for product in products]
+        target_counts = np.array([len(t) for t in targets], dtype=np.int64)
+        target_starts = np.cumsum(target_counts) - target_counts
+        target_positions = np.array([position for t in targets for position in t], dtype=np.int64)
+
+        owners, years = [], []
+        if replacements:
+            replaced, replacement_years = self.replacement_years([product.service_life for product in products])
+            owners.append(replaced)
+            years.append(replacement_years)
+        if eol:
+            owners.append(np.arange(len(products)))
+            years.append(np.full(len(products), self.end, dtype=np.int64))
+        owners = np.concatenate(owners).astype(np.int64)
+        years = np.concatenate(years).astype(np.int64)
+
+        # each point of a product is a point of each of its targets
+        points, ranks = expand(target_counts[owners])
+        return years[points], target_positions[target_starts[owners[points]] + ranks]
+
+    def add_points(self, years, positions):
+        '''
+        This function adds the points given by years and product positions to the time line, the points already in it
+        are skipped and the points stay sorted by year'''
+        order = np.argsort(years, kind='stable')
+        products = self.registry.all_instances
+        existing = set(self.points)
+        new_points = [point for point in dict.fromkeys(zip(np.asarray(years)[order].tolist(),
+                                                           [products[i] for i in np.asarray(positions)[order]]))
+                      if point not in existing]
+        if len(new_points) > 0:
+            self.points = sorted(self.points + new_points, key=lambda x: x[0])
+        return self.points
+
+    def add_products(self, products: list[Product] = None):
+        '''
+        This function adds the replacement and eol points of products, defaults to the construction products of the
+        registry, to the time line in one step'''
+        if products is None:
+            products = self.registry.real_instances
+        return self.add_points(*self.timeline_points(products))
+
     def add_renovation_points(self, product: Product):
         '''
         This function adds points to the time line where replacements occur'''
-        first_repl = product.service_life + self.start
-    
-        
-        # here is for replacements
-        for i in range(first_repl, self.end-1, product.service_life):
-            if product.major_renovation_possible:
-                for p in Product.renovation_instances:
-                    if p.id == product.id:
-                        self.points.append((i, p))
-            else:
-                self.points.append((i, product))
-        self.points = list(set(self.points))
-        # sort by year
-        self.points = sorted(self.points, key=lambda x: x[0])
-        return self.points
+        return self.add_points(*self.timeline_points([product], eol=False))
     
     def add_eol_points(self, product: Product):
         '''This function adds points to the time line where eol occurs'''
-        if product.major_renovation_possible:
-            for p in Product.renovation_instances:
-                if p.id == product.id:
-                    self.points.append((self.end, p))
-        else:
-            self.points.append((self.end, product))
-            
-        
-        # clean duplicates
-        self.points = list(set(self.points))
-        # sort by year
-        self.points = sorted(self.points, key=lambda x: x[0])
-        return self.points
+        return self.add_points(*self.timeline_points([product], replacements=False))
     
         
     def create_time_line_dict(self):
@@ -224,14 +358,13 @@ class Mfa:
     
     def match_renovation_product(self, product):
         '''This function matches the renovation product with the construction product'''
-        for p in Product.real_instances:
-            if p.id == product.id:
-                return p
+        for p in self.registry.construction_products(product.id):
+            return p
 
     
     def clean_list_renovation(self):
         clean_list = []
-        check_if_first_time = []
+        check_if_first_time = set()
         
         for point in self.points:
             if not point[1].renovation_product:
@@ -242,9 +375,10 @@ class Mfa:
         for point in self.points:
             if point[1].renovation_product and point[1] not in check_if_first_time:
                 clean_list.append((point[0], point[1].production_lci, point[1]))
-                clean_list.append((point[0], self.match_renovation_product(point[1]).eol_lci, self.match_renovation_product(point[1])))
+                replaced_product = self.match_renovation_product(point[1])
+                clean_list.append((point[0], replaced_product.eol_lci, replaced_product))
                 # add the renovation product to the check list
-                check_if_first_time.append(point[1])
+                check_if_first_time.add(point[1])
                 
             elif point[1].renovation_product and point[1] in check_if_first_time:
                 clean_list.append((point[0], point[1].production_lci, point[1]))
@@ -257,7 +391,413 @@ class Mfa:
             if point[0] == self.end:
                 clean_list.append((point[0], point[1].eol_lci, point[1]))
         return clean_list
+
+    def event_table(self) -> pd.DataFrame:
+        '''
+        This function returns the events of the time line, those of clean_list_renovation and clean_list_eol,
+        calculated for all the points at once. Each event is a row with the year, the position of the product in
+        registry.all_instances, the event (production or eol), the lci key and the amount of the product, the rows
+        being sorted by year'''
+        table = self.registry.product_table()
+        years = np.array([point[0] for point in self.points], dtype=np.int64)
+        positions = np.array([self.registry.position(point[1]) for point in self.points], dtype=np.int64)
+
+        # the first point of a renovation product ends the life of the construction product it replaces, the next
+        # points end the life of the renovation product itself
+        renovation = table['renovation_product'].values[positions]
+        first_point = years == pd.Series(years).groupby(positions).transform('min').values
+        matches = table['construction_match'].values[positions]
+        if np.any(renovation & first_point & (matches < 0)):
+            raise ValueError("Some renovation products have no construction product with the same id")
+        replaced = np.where(renovation & first_point, matches, positions)
+        at_end = years == self.end
+
+        event_years = np.concatenate([years, years, years[at_end]])
+        event_positions = np.concatenate([positions, replaced, positions[at_end]])
+        events = np.repeat(['production', 'eol'], [positions.shape[0], positions.shape[0] + at_end.sum()])
+        lci = np.where(events == 'production', table['production_lci'].values[event_positions],
+                       table['eol_lci'].values[event_positions])
+        order = np.argsort(event_years, kind='stable')
+        return pd.DataFrame({'year': event_years[order], 'product': event_positions[order], 'event': events[order],
+                             'lci': lci[order], 'amount': table['amount'].values[event_positions][order]})
+
+    def clean_list(self, events: pd.DataFrame = None):
+        '''
+        This function returns the (year, lci key, product) triples of the events, clean_list_renovation and
+        clean_list_eol together'''
+        if events is None:
+            events = self.event_table()
+        products = self.registry.all_instances
+        return list(zip(events['year'].tolist(), events['lci'].tolist(), [products[i] for i in events['product']]))
+
+    def activity_demands(self, events: pd.DataFrame = None) -> pd.DataFrame:
+        '''
+        This function aggregates the events of identical (year, lci key) pairs, so that each activity is given once a
+        year to the LCA. Returns a table with the year, the lci key, the total amount and the number of events of each
+        demand, the events without lci key are skipped'''
+        if events is None:
+            events = self.event_table()
+        demands = events.groupby(['year', 'lci'], sort=False).agg(amount=('amount', 'sum'),
+                                                                  event_count=('amount', 'size'))
+        return demands.reset_index().sort_values('year', kind='stable', ignore_index=True)
     
+class LCASolverCache:
+    '''
+    This class keeps one factorized LCA per database, it should take care of the following:
+    - Factorize the technosphere matrix of each database only once
+    - Solve blocks of demands of a database at once with the existing factorization
+    - Characterize the inventories of all methods at once with a stacked characterization matrix
+    - Give the scores of one unit of every activity of a database from one transposed solve
+    '''
+    def __init__(self, methods: list[tuple[str,str,str]], block_size: int = 250):
+        self.methods = methods
+        # number of demands solved together, bounds the size of the dense supply block
+        self.block_size = block_size
+        self.lcas = {}
+        self.solvers = {}
+        self.characterization = {}
+        self.characterized_biosphere = {}
+        # scores of one unit of each product of a database (products x methods)
+        self.unit_scores = {}
+
+    def get_lca(self, db, demand):
+        '''
+        This function returns the LCA matrices of the database, they are built with the first demand asked for'''
+        if db not in self.lcas:
+            lca = bc.LCA({demand: 1}, self.methods[0])
+            lca.load_lci_data()
+            self.solvers[db] = splu(lca.technosphere_matrix.tocsc())
+            # one row of characterization factors per method, applied to the biosphere matrix once
+            characterization_factors = []
+            for method in self.methods:
+                lca.switch_method(method)
+                characterization_factors.append(lca.characterization_matrix.diagonal())
+            self.characterization[db] = sparse.csr_matrix(np.vstack(characterization_factors))
+            self.characterized_biosphere[db] = self.characterization[db] * lca.biosphere_matrix
+            self.lcas[db] = lca
+        return self.lcas[db]
+
+    def impact_matrix(self, db, demands, amounts = None) -> np.ndarray:
+        '''
+        This function solves all the demands of the database as a multi-column right hand side and returns an array
+        (demands x methods) of scores. When there are more demands than methods, the unit scores of the transposed
+        solve are scaled instead'''
+        if amounts is None:
+            amounts = np.ones(len(demands))
+        if len(demands) > len(self.methods):
+            return self.unit_score_matrix(db, demands) * np.asarray(amounts, dtype=float).reshape(-1, 1)
+        lca = self.get_lca(db, demands[0])
+        scores = np.zeros((len(demands), len(self.methods)))
+        for start in range(0, len(demands), self.block_size):
+            block = demands[start:start + self.block_size]
+            supply = self.solvers[db].solve(self.demand_matrix(lca, block, amounts[start:start + len(block)]))
+            scores[start:start + len(block)] = (self.characterized_biosphere[db] * supply).T
+        return scores
+
+    def unit_score_matrix(self, db, demands) -> np.ndarray:
+        '''
+        This function returns the scores of one unit of each demand (demands x methods). The scores of all the products
+        of the database come from one solve of the transposed technosphere matrix, whose right hand side has one column
+        per method instead of one per demand, and are kept for the next calls'''
+        lca = self.get_lca(db, demands[0])
+        if db not in self.unit_scores:
+            self.unit_scores[db] = self.solvers[db].solve(self.characterized_biosphere[db].T.toarray(), trans='T')
+        return self.unit_scores[db][[lca.product_dict[demand] for demand in demands]]
+
+    @staticmethod
+    def demand_matrix(lca, demands, amounts) -> np.ndarray:
+        '''
+        This function returns the right hand side (products x demands) of a block of demands'''
+        demand_matrix = np.zeros((len(lca.product_dict), len(demands)))
+        for column, demand in enumerate(demands):
+            demand_matrix[lca.product_dict[demand], column] = amounts[column]
+        return demand_matrix
+
+    def impacts(self, db, demand, amount = 1):
+        '''
+        This function solves a single demand and returns one score per method'''
+        return self.impact_matrix(db, [demand], [amount])[0].tolist()
+
+def database_key(db):
+    '''
+    This function returns the stored name and version of a database, bw2data updates the modified date of a database
+    each time it is written'''
+    return f'{bd.projects.current}/{db}', str(bd.databases[db].get('modified'))
+
+
+class LCIAResultStore:
+    '''
+    This class keeps the LCIA scores on disk in an SQLite table, it should take care of the following:
+    - Store the score of one unit of each activity, for each database and method
+    - Give back the scores already calculated so that a study only solves the missing ones
+    - Invalidate the scores of a database when it is rewritten
+    '''
+    def __init__(self, path: str = 'lcia_results.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS scores (database TEXT, version TEXT, activity TEXT, method TEXT, score REAL, '
+            'PRIMARY KEY (database, activity, method))')
+        self.checked_versions = {}
+
+    def check_version(self, db):
+        '''
+        This function deletes the scores of the database calculated with a previous version of it'''
+        database, version = database_key(db)
+        if self.checked_versions.get(database) != version:
+            with self.connection:
+                self.connection.execute('DELETE FROM scores WHERE database = ? AND version != ?', (database, version))
+            self.checked_versions[database] = version
+        return database, version
+
+    def load(self, db, methods) -> dict:
+        '''
+        This function returns {activity code: array of scores for one unit} for the activities of the database
+        that have a score for all the methods'''
+        database, version = self.check_version(db)
+        method_index = {json.dumps(method): m for m, method in enumerate(methods)}
+        scores = {}
+        for activity, method, score in self.connection.execute(
+                'SELECT activity, method, score FROM scores WHERE database = ?', (database,)):
+            if method in method_index:
+                scores.setdefault(activity, np.full(len(methods), np.nan))[method_index[method]] = score
+        return {activity: activity_scores for activity, activity_scores in scores.items()
+                if not np.isnan(activity_scores).any()}
+
+    def save(self, db, activities, methods, scores):
+        '''
+        This function stores the scores (activities x methods) of one unit of each activity'''
+        database, version = self.check_version(db)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)',
+                [(database, version, activity, json.dumps(method), float(score))
+                 for activity, activity_scores in zip(activities, scores)
+                 for method, score in zip(methods, activity_scores)])
+
+    def close(self):
+        self.connection.close()
+
+
+class ExchangeSampleStore:
+    '''
+    This class keeps pre-sampled exchange values of the databases on disk, it should take care of the following:
+    - Draw the technosphere and biosphere samples of a database once, from the uncertainty of its exchanges
+    - Store them as memory-mapped arrays (iterations x exchanges) that the next studies read without drawing again
+    - Draw them again when the database is rewritten or when more iterations are asked for
+    '''
+    def __init__(self, path: str = 'exchange_samples', seed: int = None, chunk_size: int = 100):
+        self.path = path
+        self.seed = seed
+        # number of iterations drawn together, bounds the memory used while drawing
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+
+    def file_stem(self, db):
+        '''
+        This function returns the path of the files of a database without extension'''
+        database, _ = database_key(db)
+        return os.path.join(self.path, hashlib.md5(database.encode()).hexdigest())
+
+    def samples(self, db, lca, iterations) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        This function returns read-only arrays of the technosphere and biosphere samples (iterations x parameters) of
+        the database, in the order of lca.tech_params and lca.bio_params'''
+        stem = self.file_stem(db)
+        database, version = database_key(db)
+        params = {'technosphere': lca.tech_params, 'biosphere': lca.bio_params}
+        metadata = {}
+        if os.path.exists(stem + '.json'):
+            with open(stem + '.json') as metadata_file:
+                metadata = json.load(metadata_file)
+
+        if (metadata.get('version') != version or metadata.get('iterations', 0) < iterations or
+                metadata.get('seed') != self.seed or
+                any(metadata.get(kind) != len(kind_params) for kind, kind_params in params.items())):
+            seeds = self.draw_seeds(database)
+            for kind, kind_params in params.items():
+                self.draw(f'{stem}_{kind}.npy', kind_params, iterations, seeds[kind])
+            metadata = {'database': database, 'version': version, 'iterations': iterations, 'seed': self.seed,
+                        **{kind: len(kind_params) for kind, kind_params in params.items()}}
+            with open(stem + '.json', 'w') as metadata_file:
+                json.dump(metadata, metadata_file)
+
+        return tuple(np.load(f'{stem}_{kind}.npy', mmap_mode='r')[:iterations] for kind in params)
+
+    def draw_seeds(self, database) -> dict:
+        '''
+        This function returns the seeds of the technosphere and biosphere draws of a database. They are spawned from
+        the seed of the store and the name of the database, so that the draws of the two kinds and of the databases
+        are independent. Without seed, the draws are not reproducible'''
+        if self.seed is None:
+            return {'technosphere': None, 'biosphere': None}
+        database_entropy = int(hashlib.md5(database.encode()).hexdigest(), 16)
+        sequences = np.random.SeedSequence([self.seed, database_entropy]).spawn(2)
+        return {kind: int(sequence.generate_state(1)[0]) for kind, sequence in zip(['technosphere', 'biosphere'],
+                                                                                   sequences)}
+
+    def draw(self, file_path, params, iterations, seed = None):
+        '''
+        This function draws the samples of parameters in a new memory-mapped file, chunk by chunk'''
+        samples = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.float64, shape=(iterations, len(params)))
+        generator = MCRandomNumberGenerator(params, seed=seed)
+        for start in range(0, iterations, self.chunk_size):
+            count = min(self.chunk_size, iterations - start)
+            samples[start:start + count] = generator.generate(count).reshape(len(params), count).T
+        samples.flush()
+        del samples
+
+
+class MonteCarloLCASolver(LCASolverCache):
+    '''
+    This class solves demands against the pre-sampled exchange values of a database, it should take care of the
+    following:
+    - Take the samples of each database from an ExchangeSampleStore
+    - Factorize the technosphere matrix of each sample once and solve all the demands of the database with it
+    - Characterize the inventories of all methods at once, with the characterization factors of the static solver
+    '''
+    def __init__(self, methods: list[tuple[str,str,str]], sample_store: ExchangeSampleStore, iterations: int = 100,
+                 block_size: int = 250):
+        super().__init__(methods, block_size)
+        self.sample_store = sample_store
+        self.iterations = iterations
+
+    def sample_impact_matrix(self, db, demands, amounts = None) -> np.ndarray:
+        '''
+        This function solves all the demands of the database for each sample and returns an array
+        (iterations x demands x methods) of scores'''
+        if amounts is None:
+            amounts = np.ones(len(demands))
+        lca = self.get_lca(db, demands[0])
+        technosphere_samples, biosphere_samples = self.sample_store.samples(db, lca, self.iterations)
+        demand_matrix = self.demand_matrix(lca, demands, amounts)
+        scores = np.zeros((self.iterations, len(demands), len(self.methods)))
+        try:
+            for iteration in range(self.iterations):
+                lca.rebuild_technosphere_matrix(np.asarray(technosphere_samples[iteration]))
+                lca.rebuild_biosphere_matrix(np.asarray(biosphere_samples[iteration]))
+                solver = splu(lca.technosphere_matrix.tocsc())
+                for start in range(0, len(demands), self.block_size):
+                    supply = solver.solve(demand_matrix[:, start:start + self.block_size])
+                    scores[iteration, start:start + self.block_size] = \
+                        (self.characterization[db] * (lca.biosphere_matrix * supply)).T
+        finally:
+            # the static matrices are kept for the deterministic solves
+            lca.rebuild_technosphere_matrix(lca.tech_params['amount'])
+            lca.rebuild_biosphere_matrix(lca.bio_params['amount'])
+        return scores
+
+
+# factorized LCAs of a worker process, kept warm between the databases it is given
+_worker_solvers = None
+
+
+def _init_worker(project, methods, block_size):
+    '''This function initializes a worker process of ProLCA.solve_databases'''
+    global _worker_solvers
+    bd.projects.set_current(project)
+    _worker_solvers = LCASolverCache(methods, block_size)
+
+
+def _solve_database(db, activities, amounts):
+    '''This function solves all the demands of a database in a worker process'''
+    demands = [bd.get_activity((str(db), activity)) for activity in activities]
+    return _worker_solvers.impact_matrix(db, demands, amounts)
+
+
+class DemandAggregation:
+    '''
+    This class groups the events of a time line (see Mfa.event_table) by database and year, it should take care of
+    the following:
+    - Give each activity of a database once to the LCA, for one unit, whatever the number of years and products using it
+    - Combine the events of each database and year in one functional unit vector over the activities of the database
+    - Keep a sparse attribution matrix (events x activities) per database, so that the scores of each event, product
+      and year are recovered from the unit scores without solving more LCAs
+    '''
+    def __init__(self, events: pd.DataFrame, database_chooser, methods: list[tuple[str,str,str]], products: list = None):
+        self.events = events.reset_index(drop=True)
+        self.methods = methods
+        # products of the product positions of the events, the positions are kept without them
+        self.products = products
+        # activity codes of the columns of the matrices of each database
+        self.activities = {}
+        # events whose year is solved with each database
+        self.rows = {}
+        self.years = {}
+        self.attribution = {}
+        self.functional_units = {}
+        self.unit_scores = {}
+
+        event_years = self.events['year'].values
+        rows_by_db = {}
+        for year in np.unique(event_years):
+            for db in database_chooser(year):
+                rows_by_db.setdefault(db, []).append(np.flatnonzero(event_years == year))
+        amounts = self.events['amount'].values.astype(float)
+        for db, rows in rows_by_db.items():
+            rows = np.concatenate(rows)
+            columns, activities = pd.factorize(self.events['lci'].values[rows])
+            # events without lci key have no demand
+            rows, columns = rows[columns >= 0], columns[columns >= 0]
+            years, year_rows = np.unique(event_years[rows], return_inverse=True)
+            self.activities[db] = list(activities)
+            self.rows[db] = rows
+            self.years[db] = years
+            self.attribution[db] = sparse.csr_matrix((amounts[rows], (rows, columns)),
+                                                     shape=(self.events.shape[0], len(activities)))
+            # the amounts of the same activity in a year are summed
+            self.functional_units[db] = sparse.csr_matrix((amounts[rows], (year_rows, columns)),
+                                                          shape=(len(years), len(activities)))
+
+    def demands_by_db(self) -> dict:
+        '''This function returns the demands of each database, {db: (activity codes, amounts)}, each for one unit'''
+        return {db: (activities, np.ones(len(activities))) for db, activities in self.activities.items()}
+
+    def solve(self, solve_databases):
+        '''
+        This function calculates the unit scores of the activities with solve_databases, a function taking and
+        returning the demands of each database as ProLCA.solve_databases'''
+        self.unit_scores = solve_databases(self.demands_by_db())
+        return self
+
+    def year_results(self) -> dict:
+        '''This function returns the scores of the functional unit of each (year, db), one score per method'''
+        results_dict = {}
+        for db, functional_units in self.functional_units.items():
+            for year, scores in zip(self.years[db], functional_units @ self.unit_scores[db]):
+                results_dict[(int(year), db)] = scores.tolist()
+        return results_dict
+
+    def event_scores(self) -> pd.DataFrame:
+        '''
+        This function returns the scores of each event with each database of its year, as a DataFrame indexed by event
+        (row of the events) and database with one column per method'''
+        frames = []
+        for db, attribution in self.attribution.items():
+            rows = self.rows[db]
+            frames.append(pd.DataFrame(attribution[rows] @ self.unit_scores[db], columns=range(len(self.methods)),
+                                       index=pd.MultiIndex.from_arrays([rows, [db] * len(rows)],
+                                                                       names=['event', 'database'])))
+        scores = pd.concat(frames)
+        scores.columns = pd.Index(self.methods, tupleize_cols=False)
+        return scores
+
+    def product_results(self) -> dict:
+        '''
+        This function returns the scores of each product in each year and database, {(year, product, db): scores}, the
+        production and eol events of a product being summed'''
+        scores = self.event_scores()
+        event_rows = scores.index.get_level_values('event')
+        keys = pd.MultiIndex.from_arrays([self.events['year'].values[event_rows], self.events['product'].values[event_rows],
+                                          scores.index.get_level_values('database')])
+        product_scores = pd.DataFrame(scores.values, index=keys).groupby(level=[0, 1, 2], sort=False).sum()
+        results_dict = {}
+        for (year, product, db), product_score in zip(product_scores.index, product_scores.values):
+            product = self.products[product] if self.products is not None else int(product)
+            results_dict[(int(year), product, db)] = product_score.tolist()
+        return results_dict
+
+
 class ProLCA:
     '''
     This class should take care of the following:
@@ -269,13 +809,30 @@ class ProLCA:
     def __init__(self, activities_and_years: list[tuple[str, int]],
                  methods: list[tuple[str,str,str]] = [('EF v3.0 EN15804', 'climate change', 'global warming potential (GWP100)'),],
                  yearly_databases: dict = None,
-                 products: list[Product] = None,):
+                 products: list[Product] = None,
+                 n_cpu: int = 1,
+                 store: LCIAResultStore = None,
+                 sample_store: ExchangeSampleStore = None,
+                 iterations: int = 100):
         self.activities_and_years = activities_and_years
         self.methods = methods
         self.yearly_databases = yearly_databases
         self.results = {}
         self.results_aggregated = {}
         self.products = products
+        # factorized LCAs shared by all the calculations of the study
+        self.solvers = LCASolverCache(self.methods)
+        # number of worker processes solving the databases in parallel, 1 solves them in this process
+        self.n_cpu = n_cpu
+        # one single-process executor per worker, each database is always solved by the same worker
+        self.executors = []
+        self.database_workers = {}
+        # on-disk scores of the previous studies, None calculates everything
+        self.store = store
+        # pre-sampled exchange values used by the uncertainty calculations, shared between the studies
+        self.sample_store = sample_store
+        self.iterations = iterations
+        self.sample_solvers = None
         
     def database_chooser(self, year):
         '''
@@ -297,82 +854,180 @@ class ProLCA:
             # round down to the nearest year
             return self.yearly_databases[year - (year % 10)]
 
-    def give_me_embodied(self):
-        '''give me the lca please'''
-        # initialize an empty dictionary to store results
-        results_dict = {}
+    def solve_databases(self, demands_by_db: dict) -> dict:
+        '''
+        This function solves the demands of each database, given as {db: (activity codes, amounts)}, and returns
+        {db: array (demands x methods)}. With a store, only the activities without stored scores are solved, for one
+        unit, and the scores are scaled by the amounts'''
+        if self.store is None:
+            return self.solve_missing(demands_by_db)
+
+        unit_scores = {}
+        missing_by_db = {}
+        for db, (activities, amounts) in demands_by_db.items():
+            unit_scores[db] = self.store.load(db, self.methods)
+            missing = [activity for activity in dict.fromkeys(activities) if activity not in unit_scores[db]]
+            if len(missing) > 0:
+                missing_by_db[db] = (missing, np.ones(len(missing)))
+
+        for db, scores in self.solve_missing(missing_by_db).items():
+            self.store.save(db, missing_by_db[db][0], self.methods, scores)
+            unit_scores[db].update(zip(missing_by_db[db][0], scores))
+
+        return {db: np.array([unit_scores[db][activity] for activity in activities]).reshape(-1, len(self.methods)) *
+                np.asarray(amounts, dtype=float).reshape(-1, 1)
+                for db, (activities, amounts) in demands_by_db.items()}
+
+    def solve_missing(self, demands_by_db: dict) -> dict:
+        '''
+        This function solves the demands of each database, given as {db: (activity codes, amounts)}, and returns
+        {db: array (demands x methods)}. With n_cpu > 1 the databases are spread over worker processes, which keep
+        their factorized matrices for the next calls'''
+        if self.n_cpu <= 1 or len(demands_by_db) <= 1:
+            return {db: self.solvers.impact_matrix(db, [bd.get_activity((str(db), activity)) for activity in activities],
+                                                   amounts)
+                    for db, (activities, amounts) in demands_by_db.items()}
+
+        if len(self.executors) == 0:
+            self.executors = [ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                                  initargs=(bd.projects.current, self.methods, self.solvers.block_size))
+                              for _ in range(self.n_cpu)]
+        futures = {db: self.executors[self.database_worker(db)].submit(_solve_database, db, activities, amounts)
+                   for db, (activities, amounts) in demands_by_db.items()}
+        return {db: future.result() for db, future in futures.items()}
+
+    def database_worker(self, db) -> int:
+        '''
+        This function returns the worker solving the database, the databases are given to the workers in turn the
+        first time they are solved so that the next calls reuse the factorization of the worker'''
+        if db not in self.database_workers:
+            self.database_workers[db] = len(self.database_workers) % self.n_cpu
+        return self.database_workers[db]
+
+    def close(self):
+        '''This function stops the worker processes'''
+        for executor in self.executors:
+            executor.shutdown()
+        self.executors = []
+        self.database_workers = {}
+
+    def embodied_demands(self):
+        '''
+        This function groups the activities of the time line by database, it returns the result keys
+        (year, activity, db) in the order of the time line and {db: {activity: [result keys]}} so that each activity is
+        solved once for all the years using it'''
+        # keys are kept in the order of the time line
+        result_keys = {}
+        # group the activities by database so that each database is solved in one block
+        demands_by_db = {}
         # iterate through all years in the time line
-        for year, activity, _ in self.activities_and_years:            
+        for year, activity, _ in self.activities_and_years:
             # Choose the appropriate database(s) based on the year
             dbs = self.database_chooser(year)
             # Iterate through all chosen databases
             for db in dbs:
                 # check if year and activity are already in the results dictionary if so, skip
-                if (year, activity, db) in results_dict.keys():
+                if (year, activity, db) in result_keys:
                     continue
                 # Construct a unique key for storing results
                 result_key = (year, activity, db)
-                # get the activity from the database
-                print(db, activity)
-                demand = bd.get_activity((str(db), activity))
-                # Define the functional unit for the LCA
-                amount = 1
-                fu = {demand: amount}
-                # Initialize the LCA with the first method and calculate impacts
-                lca = bc.LCA(fu, self.methods[0])
-                lca.lci()
-                lca.lcia()
-                impacts = [lca.score]
-                # If there are additional methods, switch methods and calculate additional impacts
-                if len(self.methods) > 1:    
-                    for method in self.methods[1:]:
-                        lca.switch_method(method)
-                        lca.lcia()
-                        impacts.append(lca.score)
-
-                # Store all calculated impacts in the results dictionary
-                results_dict[result_key] = impacts
+                result_keys[result_key] = None
+                demands_by_db.setdefault(db, {}).setdefault(activity, []).append(result_key)
+        return list(result_keys), demands_by_db
+
+    def give_me_embodied(self):
+        '''give me the lca please'''
+        result_keys, demands_by_db = self.embodied_demands()
+        results_dict = dict.fromkeys(result_keys)
+
+        # Calculate the impacts of all activities and methods, each activity is solved once for all the years using it
+        # and the amount is 1
+        impacts_by_db = self.solve_databases({db: (list(activities), np.ones(len(activities)))
+                                              for db, activities in demands_by_db.items()})
+        for db, activities in demands_by_db.items():
+            # Store all calculated impacts in the results dictionary
+            for result_keys, activity_impacts in zip(activities.values(), impacts_by_db[db]):
+                for result_key in result_keys:
+                    results_dict[result_key] = activity_impacts.tolist()
         return results_dict
- 
+
+    def give_me_embodied_aggregated(self, mfa: Mfa) -> DemandAggregation:
+        '''
+        give me the lca of the time line of an Mfa, aggregated by database and year
+
+        The events of the time line are combined in one functional unit vector per database and year, each activity
+        being solved once per database. The returned aggregation gives the scores of the years (year_results), of the
+        products (product_results) and of the events (event_scores) without further solves.
+        '''
+        aggregation = DemandAggregation(mfa.event_table(), self.database_chooser, self.methods,
+                                        mfa.registry.all_instances)
+        return aggregation.solve(self.solve_databases)
+
+    def give_me_embodied_uncertainty(self, confidence: float = 0.95) -> pd.DataFrame:
+        '''
+        give me the confidence intervals of the embodied lca, per year and product
+
+        Each database is evaluated for the iterations of the sample store, the technosphere of each sample being
+        factorized once for all the activities of the time line using the database. The samples of the activities of
+        a product in a year are summed before the statistics are calculated.
+
+        Returns:
+            DataFrame indexed by year, product (as given in activities_and_years), database and method with the mean,
+            median and confidence bounds
+        '''
+        assert self.sample_store is not None, "Please give a sample store to calculate the uncertainty"
+        if self.sample_solvers is None:
+            self.sample_solvers = MonteCarloLCASolver(self.methods, self.sample_store, self.iterations,
+                                                      self.solvers.block_size)
+        _, demands_by_db = self.embodied_demands()
+
+        # samples (iterations x methods) of each result key
+        samples = {}
+        for db, activities in demands_by_db.items():
+            demands = [bd.get_activity((str(db), activity)) for activity in activities]
+            db_samples = self.sample_solvers.sample_impact_matrix(db, demands)
+            for a, result_keys in enumerate(activities.values()):
+                for result_key in result_keys:
+                    samples[result_key] = db_samples[:, a, :]
+
+        # sum the activities of each product and year, products with the same name are kept apart
+        product_samples = {}
+        for year, activity, product in dict.fromkeys(self.activities_and_years):
+            for db in self.database_chooser(year):
+                key = (year, product, db)
+                product_samples[key] = product_samples.get(key, 0.) + samples[(year, activity, db)]
+
+        tail = (1. - confidence) / 2.
+        rows = []
+        # products can not be compared, the rows are sorted by year only
+        for (year, product, db), product_sample in sorted(product_samples.items(), key=lambda item: item[0][0]):
+            for m, method in enumerate(self.methods):
+                rows.append({'year': year, 'product': product, 'database': db, 'method': method,
+                             'mean': product_sample[:, m].mean(), 'median': np.median(product_sample[:, m]),
+                             'lower': np.quantile(product_sample[:, m], tail),
+                             'upper': np.quantile(product_sample[:, m], 1. - tail)})
+        return pd.DataFrame(rows).set_index(['year', 'product', 'database', 'method'])
+
     def production_lca(self, db = 'ecoinvent-3.9.1-cuttoff', mfa_start = 2020):
         results_dict = {}
          
         for p, product in enumerate(self.products):            
-            # Construct a unique key for storing results
-            result_key = (mfa_start, product, db)    
-        
             # Ensure this returns the expected activity
             try:
-               activity = bd.get_activity((str(db), product.production_lci))
+               bd.get_activity((str(db), product.production_lci))
             except:
                 print(f'something wrong with {product.production_lci}')
                 sys.exit(1)
-               
-           
-            # Define the functional unit for the LCA
-            amount = product.amount
-            fu = {activity: amount}
-           
-            #  if p==0:
-                # Initialize the LCA with the first method and calculate impacts
-            lca = bc.LCA(fu, self.methods[0])
-            lca.lci()
-            lca.lcia()
-            #  else:
-            #     lca.redo_lcia(fu)
-           
-             # Initialize a list to store impact scores for all methods
-            impacts = [lca.score]
-        
-            # If there are additional methods, switch methods and calculate additional impacts
-            if len(self.methods) > 1:    
-                for method in self.methods[1:]:
-                    lca.switch_method(method)
-                    lca.lcia()
-                    impacts.append(lca.score)
+
+        # Calculate the impacts of all products and methods in one block, the functional unit is the product amount
+        impacts = self.solve_databases({db: ([product.production_lci for product in self.products],
+                                             [product.amount for product in self.products])})[db]
            
-             # Store all calculated impacts in the results dictionary
-            results_dict[result_key] = impacts
+        for product, product_impacts in zip(self.products, impacts):
+            # Construct a unique key for storing results
+            result_key = (mfa_start, product, db)    
+            # Store all calculated impacts in the results dictionary
+            results_dict[result_key] = product_impacts.tolist()
         return results_dict
     
     def give_me_operational(self, mfa_start = 2020, mfa_end = 2080, climate = french_climate, metadata = french_metadata, heating_set_point = 18 ):
@@ -403,12 +1058,9 @@ class ProLCA:
         
         energy_consumption = 0
         operational_lca = 0
-        # iterate through all the years where the energy simulation will change
+        # renovation state of each period, every step keeps the renovations of the previous ones
+        reno_steps = {}
         for i in range (1, len(dates_new_energetic_simulations)) :
-            year_duration = dates_new_energetic_simulations[i] - dates_new_energetic_simulations[i-1]
-            print(year_duration)
-            year = dates_new_energetic_simulations[i]
-            old_year = dates_new_energetic_simulations[i-1]
             if i==1 :
                 reno_dict['291 Mass inventory heating'] = 1
             if i==2 :
@@ -418,7 +1070,19 @@ class ProLCA:
                 reno_dict['51 Loadbering deck'] = 1
             if i==4 :
                 reno_dict['231 Bearing outer wall'] = 1
-            energy_consumption = FMES(climate, metadata, reno_dict) * year_duration
+            reno_steps[i] = dict(reno_dict)
+        # all the energy simulations share the same inputs and climate preprocessing
+        annual_consumptions = ScenarioBatch({'climate': (climate, metadata)}, reno_steps,
+                                            [heating_set_point]).run().set_index('scenario')['total_final_consumption']
+        # energy demands of each database, solved together once all the years are known
+        demands_by_db = {}
+        # iterate through all the years where the energy simulation will change
+        for i in range (1, len(dates_new_energetic_simulations)) :
+            year_duration = dates_new_energetic_simulations[i] - dates_new_energetic_simulations[i-1]
+            print(year_duration)
+            year = dates_new_energetic_simulations[i]
+            old_year = dates_new_energetic_simulations[i-1]
+            energy_consumption = annual_consumptions[i] * year_duration
             dbs = self.database_chooser(year)      
             for db in dbs:
                 
@@ -434,19 +1098,16 @@ class ProLCA:
                     print(energy_consumption)
                 
                 result_key = (year, demand, db)
-                fu = {demand: amount}
-                # Initialize the LCA with the first method and calculate impacts
-                lca = bc.LCA(fu, self.methods[0])
-                lca.lci()
-                lca.lcia()
-                impacts = [lca.score]
-                # If there are additional methods, switch methods and calculate additional impacts
-                if len(self.methods) > 1:    
-                    for method in self.methods[1:]:
-                        lca.switch_method(method)
-                        lca.lcia()
-                        impacts.append(lca.score)
-                results_dict[result_key] = impacts
+                results_dict[result_key] = None
+                demands_by_db.setdefault(db, []).append((result_key, amount))
+
+        # Calculate the impacts of all methods with the factorized LCA of each database
+        impacts_by_db = self.solve_databases({db: ([result_key[1]['code'] for result_key, _ in demands],
+                                                   [amount for _, amount in demands])
+                                              for db, demands in demands_by_db.items()})
+        for db, demands in demands_by_db.items():
+            for (result_key, _), impacts in zip(demands, impacts_by_db[db]):
+                results_dict[result_key] = impacts.tolist()
         return results_dict
                 
      
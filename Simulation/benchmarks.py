@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from Simulation.main import Parameters
+from Simulation.climate import preprocess_climate
+from Simulation.solar_gains import run_models as run_solar_gain_models
+from Simulation.thermal_needs import calculate_thermal_needs
+
+data_path = os.path.dirname(__file__) + '/data/'
+
+
+def synthetic_stock(building_count, seed=0):
+    """Creates a synthetic building stock by replicating the case study building and its boundaries
+
+    Numerical building and boundary results are randomly perturbed so that buildings do not all get the same values.
+
+    Args:
+        building_count (int): number of buildings in the synthetic stock
+        seed (int): seed of the random generator
+
+    Returns:
+        tuple of DataFrame, containing the buildings (indexed by building_id) and the boundaries
+    """
+
+    rng = np.random.default_rng(seed)
+    buildings = pd.read_csv(data_path + 'Building_case_study.csv', sep=';')
+    boundaries = pd.read_csv(data_path + 'Boundaries_case_study.csv', sep=';')
+    building_ids = np.arange(building_count) + 1
+
+    buildings = buildings.loc[np.zeros(building_count, dtype=int)].reset_index(drop=True)
+    buildings['building_id'] = building_ids
+    buildings.set_index('building_id', inplace=True, drop=False)
+
+    boundary_count = boundaries.shape[0]
+    boundaries = boundaries.loc[np.tile(np.arange(boundary_count), building_count)].reset_index(drop=True)
+    boundaries['building_id'] = np.repeat(building_ids, boundary_count)
+
+    for frame, columns in [(buildings, ['annual_ventilation_losses', 'annual_occupant_gains',
+                                        'conventional_ventilation_losses', 'conventional_occupant_gains']),
+                           (boundaries, ['annual_thermal_losses', 'conventional_thermal_losses',
+                                         'peak_thermal_losses', 'transmitted_solar_gain'])]:
+        for col in columns:
+            frame[col] = frame[col] * rng.uniform(0.2, 5., frame.shape[0])
+
+    return buildings, boundaries
+
+
+def time_function(function, *args, repeat=3):
+    """Returns the best execution time of function(*args) over repeat runs, in seconds"""
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - start)
+
+    return min(durations)
+
+
+def benchmark_thermal_needs(building_counts=(10, 100, 1000, 10000, 100000)):
+    """Times calculate_thermal_needs on synthetic stocks of increasing size
+
+    Args:
+        building_counts (iterable of int): the stock sizes to benchmark
+
+    Returns:
+        DataFrame with the duration in seconds and the duration by building in microseconds for each stock size
+    """
+
+    parameters = Parameters()
+    results = []
+    for building_count in building_counts:
+        buildings, boundaries = synthetic_stock(building_count)
+        duration = time_function(calculate_thermal_needs, buildings, boundaries, parameters)
+        results.append({'building_count': building_count,
+                        'duration': duration,
+                        'duration_by_building_us': duration / building_count * 1e6})
+
+    return pd.DataFrame(results).set_index('building_count')
+
+
+def benchmark_solar_gains(building_counts=(10, 100, 1000, 10000),
+                          climate_file=data_path + 'FRA_AR_Grenoble.074850_TMYx.epw'):
+    """Measures the duration and peak memory of the solar gain models on synthetic stocks of increasing size
+
+    Args:
+        building_counts (iterable of int): the stock sizes to benchmark
+        climate_file (str): path to the EPW climate file
+
+    Returns:
+        DataFrame with the boundary count, the duration in seconds and the peak memory in MB for each stock size
+    """
+
+    climate = preprocess_climate(climate_file, 164.4).to_frame()
+    results = []
+    for building_count in building_counts:
+        buildings, boundaries = synthetic_stock(building_count)
+        tracemalloc.start()
+        start = time.perf_counter()
+        run_solar_gain_models(buildings, boundaries, climate)
+        duration = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({'building_count': building_count,
+                        'boundary_count': boundaries.shape[0],
+                        'duration': duration,
+                        'peak_memory_mb': peak_memory / 1e6})
+
+    return pd.DataFrame(results).set_index('building_count')
+
+
+if __name__ == '__main__':
+    print(benchmark_thermal_needs())
+    print(benchmark_solar_gains())
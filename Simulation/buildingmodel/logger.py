@@ -2,7 +2,7 @@ import functools
 import logging
 import time
 from datetime import timedelta
-from shape_optim.buildingmodel import log_dir
+from Simulation.buildingmodel import log_dir
 
 
 def create_logger():
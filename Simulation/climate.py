@@ -1,7 +1,47 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
 import numpy as np
+import pandas as pd
 import pvlib
+from pvlib.iotools import read_epw
+from Simulation.thermal_losses import degree_hour_table
+
+EPW_name_dict = {
+    "temp_air": "air_temperature",
+    "temp_dew": "dew_point_temperature",
+    "dni": "direct_normal_radiation",
+    "dhi": "diffuse_horizontal_radiation",
+    "opaque_sky_cover": "opaque_sky_cover",
+}
+
+# Maximal number of preprocessed climates kept in memory by preprocess_climate
+CLIMATE_CACHE_SIZE = 8
+
+_climate_cache = OrderedDict()
+
+
+def load_climate_data(file_path):
+    """Reads an EPW climate file and returns the relevant climate data
+
+    Args:
+        file_path (str): path to EPW climate file
+
+    Returns:
+        Dataframe : DataFrame containing air_temperature, dew_point_temperature, wind_speed, wind_direction,
+        direct_normal_radiation, diffuse_horizontal_radiation
+    """
+
+    data, metadata = read_epw(file_path, coerce_year="2019")
+    data = data.loc[:, EPW_name_dict.keys()]
+    data = data.rename(EPW_name_dict, axis=1)
+    data.astype(float)
+
+    return data, metadata
 
 
 def sun_position(climate_data, latitude, longitude):
@@ -88,6 +128,24 @@ def ground_temperature(climate_data, ground_diffusivity=0.8e-6, depth=0.5):
     climate_data["ground_temperature"] = ground_temperature
 
 
+def daylight(climate_data):
+    """Flags the time steps during which the sun is above the horizon and some solar radiation is received
+
+    The solar gain models only work on these time steps. The flag is calculated once with the other climate models
+    and shared by all the simulations using the preprocessed climate.
+
+    Args:
+        climate_data (Dataframe): a Dataframe containing sun height, direct normal and diffuse horizontal radiation
+
+    Returns:
+        Dataframe : DataFrame containing the daylight flag
+    """
+
+    climate_data['daylight'] = ((climate_data['sun_height'] > 0.) &
+                                ((climate_data['direct_normal_radiation'] > 0.) |
+                                 (climate_data['diffuse_horizontal_radiation'] > 0.)))
+
+
 def run_models(climate_data, metadata):
     """Runs all climate models
 
@@ -96,14 +154,19 @@ def run_models(climate_data, metadata):
         :func:`buildingmodel.io.climate.load_data`
 
     Returns:
-        Dataframe : DataFrame containing all necessary climate data
+        Dataframe : a new DataFrame containing all necessary climate data, climate_data is left unchanged
     """
 
+    climate_data = climate_data.copy()
     sun_position(climate_data, metadata["latitude"], metadata["longitude"])
     sky_temperature(climate_data)
     ground_temperature(climate_data)
     climate_data['air_temperature'] -= (metadata['building_altitude'][0] - metadata['altitude']) / 100. * 0.6
     climate_data['extra_terrestrial'] = pvlib.irradiance.get_extra_radiation(climate_data.index).values
+    daylight(climate_data)
+
+    return climate_data
+
 
 def run_models_BM(climate_data, metadata):
     """Runs all climate models
@@ -113,11 +176,113 @@ def run_models_BM(climate_data, metadata):
         :func:`buildingmodel.io.climate.load_data`
 
     Returns:
-        Dataframe : DataFrame containing all necessary climate data
+        Dataframe : a new DataFrame containing all necessary climate data, climate_data is left unchanged
     """
 
+    climate_data = climate_data.copy()
     sun_position(climate_data, metadata["latitude"], metadata["longitude"])
     sky_temperature(climate_data)
     ground_temperature(climate_data)
     climate_data['air_temperature'] -= (metadata['building_altitude'] - metadata['altitude']) / 100. * 0.6
     climate_data['extra_terrestrial'] = pvlib.irradiance.get_extra_radiation(climate_data.index).values
+    daylight(climate_data)
+
+    return climate_data
+
+
+class PreprocessedClimate(object):
+    """
+    The result of the climate models for an EPW file and a site, as returned by :func:`preprocess_climate`
+
+    The preprocessed data is shared between all the simulations using the same climate and site, it must not be
+    modified : :meth:`to_frame` returns a copy that the models can use freely.
+
+    Args:
+        data (DataFrame): the climate data returned by :func:`run_models_BM`
+        metadata (dict): the EPW metadata completed with the building altitude
+        key (tuple): EPW path, latitude, longitude, building altitude and EPW modification time of the preprocessed
+        climate
+    """
+
+    def __init__(self, data, metadata, key):
+        self._data = data
+        self.metadata = metadata
+        self.key = key
+        self._degree_hours = None
+
+    def to_frame(self):
+        """Returns a copy of the preprocessed climate data"""
+
+        return self._data.copy()
+
+    def degree_hours(self):
+        """Returns the degree hour table of the climate for the default heating season, calculated on first use
+
+        See :func:`Simulation.thermal_losses.degree_hour_table`
+        """
+
+        if self._degree_hours is None:
+            self._degree_hours = degree_hour_table(self._data)
+
+        return self._degree_hours
+
+    def __repr__(self):
+        return f"PreprocessedClimate{self.key}"
+
+
+def preprocess_climate(epw_path, building_altitude, latitude=None, longitude=None, cache_dir=None):
+    """Returns the preprocessed climate of an EPW file for a site, computing it only once
+
+    Preprocessed climates are kept in memory for the last :data:`CLIMATE_CACHE_SIZE` keys used. If cache_dir is given,
+    they are also stored there as parquet files and reloaded by later sessions. The modification time of the EPW file
+    is part of the keys, a climate being preprocessed again when the file is modified.
+
+    Args:
+        epw_path (str): path to the EPW climate file
+        building_altitude (float): altitude of the buildings in meters, used to correct the air temperature
+        latitude (float): latitude of the site, defaults to the latitude of the EPW file
+        longitude (float): longitude of the site, defaults to the longitude of the EPW file
+        cache_dir (str): directory in which the preprocessed climates are stored. Defaults to None (memory cache only)
+
+    Returns:
+        PreprocessedClimate
+    """
+
+    epw_path = os.path.abspath(epw_path)
+    key = (epw_path, latitude, longitude, float(building_altitude), os.path.getmtime(epw_path))
+
+    if key in _climate_cache:
+        _climate_cache.move_to_end(key)
+        return _climate_cache[key]
+
+    file_key = hashlib.sha1(repr(key).encode()).hexdigest()
+    if cache_dir is not None and os.path.exists(os.path.join(cache_dir, f'{file_key}.parquet')):
+        data = pd.read_parquet(os.path.join(cache_dir, f'{file_key}.parquet'))
+        with open(os.path.join(cache_dir, f'{file_key}.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+    else:
+        data, metadata = load_climate_data(epw_path)
+        if latitude is not None:
+            metadata['latitude'] = latitude
+        if longitude is not None:
+            metadata['longitude'] = longitude
+        metadata['building_altitude'] = float(building_altitude)
+        data = run_models_BM(data, metadata)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            data.to_parquet(os.path.join(cache_dir, f'{file_key}.parquet'))
+            with open(os.path.join(cache_dir, f'{file_key}.json'), 'w') as metadata_file:
+                json.dump(metadata, metadata_file)
+
+    climate = PreprocessedClimate(data, metadata, key)
+    _climate_cache[key] = climate
+    if len(_climate_cache) > CLIMATE_CACHE_SIZE:
+        _climate_cache.popitem(last=False)
+
+    return climate
+
+
+def clear_climate_cache():
+    """Empties the in-memory cache of preprocessed climates"""
+
+    _climate_cache.clear()
@@ -1,8 +1,136 @@
 from Simulation.main import *
 
+import numpy as np
+import pandas as pd
+
+from Simulation.store import unpack
+
 energy_list     = ['electricity', 'gas', 'oil', 'biomass', 'district_network', 'biogas']
 dhw_efficiencies = {'electricity': 0.7, 'gas': 0.6, 'oil': 0.6, 'biomass': 0.6, 'district_network': 0.6, 'biogas': 0.6}
 
+# end uses of the allocation array, the consumption of an energy is the sum of its end uses in this order
+END_USES = ['heating', 'dhw', 'specific', 'cooking']
+
+
+def energy_codes(buildings, column, selection=None):
+    """
+    Encodes the energy carriers of a column as their position in energy_list
+
+    Args:
+        buildings (DataFrame): the buildings
+        column (str): name of the column containing the energy carriers
+        selection (ndarray of bool): buildings to encode, the other ones are given the code -1
+
+    Returns:
+        ndarray of int, the energy codes (-1 for unselected buildings and carriers missing from energy_list)
+    """
+
+    codes = pd.Categorical(buildings[column], categories=energy_list).codes.astype(int)
+    if selection is not None:
+        codes[~selection] = -1
+
+    return codes
+
+
+def add_energy(allocation, end_use, codes, consumption):
+    """
+    Scatter-adds the consumption of each building to allocation[building, energy code, end use]
+
+    Args:
+        allocation (ndarray): array of shape (buildings x energies x end uses) with an optional trailing sample axis
+        end_use (str): one of END_USES
+        codes (ndarray of int): energy code of each building, buildings with a negative code are skipped
+        consumption (ndarray): consumption of each building, of shape (buildings) or (buildings x samples)
+    """
+
+    rows = np.flatnonzero(codes >= 0)
+    np.add.at(allocation, (rows, codes[rows], END_USES.index(end_use)), consumption[rows])
+
+
+def divide(needs, efficiency, selection):
+    """Divides the needs by a building efficiency where selection is True, broadcasting over a sample axis"""
+
+    efficiency = efficiency.reshape((-1,) + (1,) * (needs.ndim - 1))
+    selection = np.broadcast_to(selection.reshape(efficiency.shape), needs.shape)
+    return np.divide(needs, efficiency, out=np.zeros(needs.shape), where=selection)
+
+
+def energy_allocation(buildings, heating_needs, dhw_needs, specific_needs=None, cooking_needs=None):
+    """
+    Allocates the needs of each building to energy carriers and end uses :
+     * heating needs are shared between the main and backup systems and divided by their efficiency
+     * dhw needs are divided by the efficiency of the dhw energy
+     * specific needs are allocated to electricity
+     * cooking needs are allocated to the cooking energy
+
+    Only buildings to simulate are allocated. The needs may have a trailing sample axis which is kept in the result.
+
+    Args:
+        buildings (DataFrame): the buildings, giving the energy carriers, efficiencies and backup shares
+        heating_needs (ndarray): heating needs of each building, of shape (buildings) or (buildings x samples)
+        dhw_needs (ndarray): dhw needs of each building
+        specific_needs (ndarray): specific electricity needs of each building, not allocated if None
+        cooking_needs (ndarray): cooking needs of each building, not allocated if None
+
+    Returns:
+        ndarray of shape (buildings x energies x end uses) or (buildings x energies x end uses x samples)
+    """
+
+    to_sim = buildings['to_sim'].values.astype(bool)
+    backup_share = buildings['backup_heating_share'].values
+    heating_needs = np.asarray(heating_needs, dtype=float)
+    share_shape = (-1,) + (1,) * (heating_needs.ndim - 1)
+    allocation = np.zeros((buildings.shape[0], len(energy_list), len(END_USES)) + heating_needs.shape[1:])
+
+    main_codes = energy_codes(buildings, 'main_heating_energy', to_sim)
+    main_consumption = divide(heating_needs, buildings['main_heating_system_efficiency'].values, main_codes >= 0)
+    add_energy(allocation, 'heating', main_codes, main_consumption * (1. - backup_share).reshape(share_shape))
+
+    backup_codes = energy_codes(buildings, 'backup_heating_energy', to_sim & (backup_share > 0.))
+    backup_consumption = divide(heating_needs, buildings['backup_heating_system_efficiency'].values, backup_codes >= 0)
+    add_energy(allocation, 'heating', backup_codes, backup_consumption * backup_share.reshape(share_shape))
+
+    dhw_codes = energy_codes(buildings, 'dhw_energy', to_sim)
+    dhw_efficiency = np.array([dhw_efficiencies[energy] for energy in energy_list])[dhw_codes]
+    add_energy(allocation, 'dhw', dhw_codes, divide(np.asarray(dhw_needs, dtype=float), dhw_efficiency,
+                                                    dhw_codes >= 0))
+
+    if specific_needs is not None:
+        specific_codes = np.where(to_sim, energy_list.index('electricity'), -1)
+        add_energy(allocation, 'specific', specific_codes, np.asarray(specific_needs, dtype=float))
+
+    if cooking_needs is not None:
+        cooking_codes = energy_codes(buildings, 'cooking_energy', to_sim)
+        add_energy(allocation, 'cooking', cooking_codes, np.asarray(cooking_needs, dtype=float))
+
+    return allocation
+
+
+def allocation_columns(allocation, prefix, end_uses):
+    """
+    Exposes an energy allocation as columns {prefix}_{energy}_{end use} and {prefix}_{energy}_consumption
+
+    Args:
+        allocation (ndarray): array of shape (buildings x energies x end uses) given by energy_allocation
+        prefix (str): 'annual', 'peak' or 'conventional'
+        end_uses (dict): end uses to expose as columns with their column suffix
+
+    Returns:
+        dict of column name: ndarray
+    """
+
+    columns = {}
+    for energy_id, energy in enumerate(energy_list):
+        consumption = allocation[:, energy_id, 0].copy()
+        for end_use_id in range(1, len(END_USES)):
+            consumption += allocation[:, energy_id, end_use_id]
+        columns[f'{prefix}_{energy}_consumption'] = consumption
+        for end_use, suffix in end_uses.items():
+            columns[f'{prefix}_{energy}_{suffix}'] = allocation[:, energy_id, END_USES.index(end_use)]
+
+    return columns
+
+
 def annual_energy_consumption(buildings):
     """
     Calculates the energy consumption of each building :
@@ -10,6 +138,7 @@ def annual_energy_consumption(buildings):
      * calculation of heating consumption using efficiency, thermal need and share for main and backup system
      * calculation of electricity consumption for specific needs by summing the need for each dwelling
      * calculation of dhw consumption and attribution to the corresponding fuel
+     * calculation of cooking consumption and attribution to the cooking energy of each building
 
     Args:
         buildings:
@@ -27,46 +156,22 @@ def annual_energy_consumption(buildings):
     buildings.loc[
         buildings.heating_system == 'district_network', 'dhw_energy'] = 'district_network'  # TODO : correct at the diagnosis sample level
 
-    for energy in energy_list:
-
-        buildings[f'annual_{energy}_consumption'] = 0.
-        buildings[f'peak_{energy}_consumption'] = 0.
-        buildings[f'annual_{energy}_heating'] = 0.
-        buildings[f'peak_{energy}_heating'] = 0.
-        buildings[f'annual_{energy}_dhw'] = 0.
-        buildings[f'peak_{energy}_dhw'] = 0.
-
-        for priority, data_dict in get_heating_system_dict(buildings, energy).items():
-            ids = data_dict['ids']
-            annual_heating_needs = buildings.loc[ids, 'annual_heating_needs']
-            peak_heating_needs = buildings.loc[ids, 'peak_heating_needs']
-            efficiency = buildings.loc[ids, f'{priority}_heating_system_efficiency']
-            buildings.loc[ids, f'annual_{energy}_heating'] += annual_heating_needs / efficiency * data_dict['share']
-            buildings.loc[ids, f'peak_{energy}_heating'] += peak_heating_needs / efficiency * data_dict['share']
-
-            buildings.loc[ids, f'annual_{energy}_consumption'] += buildings.loc[ids, f'annual_{energy}_heating']
-            buildings.loc[ids, f'peak_{energy}_consumption'] += buildings.loc[ids, f'peak_{energy}_heating']
-
-        dhw_ids = buildings.loc[(buildings['dhw_energy'] == energy) & (buildings.to_sim)].index
-        buildings.loc[dhw_ids, f'annual_{energy}_dhw'] += buildings.loc[dhw_ids, 'annual_dhw_needs'] / dhw_efficiencies[
-            energy]
-        buildings.loc[dhw_ids, f'peak_{energy}_dhw'] += buildings.loc[dhw_ids, 'peak_dhw_needs'] / dhw_efficiencies[
-            energy]
-        buildings.loc[dhw_ids, f'annual_{energy}_consumption'] += buildings.loc[dhw_ids, f'annual_{energy}_dhw']
-        buildings.loc[dhw_ids, f'peak_{energy}_consumption'] += buildings.loc[dhw_ids, f'peak_{energy}_dhw']
-
-    buildings['annual_electricity_specific'] = 0.
-    buildings['peak_electricity_specific'] = 0.
-    ids = (buildings.to_sim)
-    buildings.loc[ids, 'annual_electricity_consumption'] += buildings.loc[ids, 'annual_specific_needs']
-    buildings.loc[ids, 'peak_electricity_consumption'] += buildings.loc[ids, 'peak_specific_needs']
-    buildings.loc[ids, 'annual_electricity_specific'] = buildings.loc[ids, 'annual_specific_needs']
-    buildings.loc[ids, 'peak_electricity_specific'] = buildings.loc[ids, 'peak_specific_needs']
-
-    cooking_energy = buildings['cooking_energy'][2842]
-
-    buildings.loc[ids, f'annual_{cooking_energy}_consumption'] += buildings['annual_cooking_needs']
-    buildings.loc[ids, f'annual_{cooking_energy}_cooking'] = buildings['annual_cooking_needs']
+    annual = energy_allocation(buildings, buildings['annual_heating_needs'].values,
+                               buildings['annual_dhw_needs'].values,
+                               specific_needs=buildings['annual_specific_needs'].values,
+                               cooking_needs=buildings['annual_cooking_needs'].values)
+    peak = energy_allocation(buildings, buildings['peak_heating_needs'].values,
+                             buildings['peak_dhw_needs'].values,
+                             specific_needs=buildings['peak_specific_needs'].values)
+
+    columns = allocation_columns(annual, 'annual', {'heating': 'heating', 'dhw': 'dhw', 'cooking': 'cooking'})
+    columns.update(allocation_columns(peak, 'peak', {'heating': 'heating', 'dhw': 'dhw'}))
+    electricity_id = energy_list.index('electricity')
+    columns['annual_electricity_specific'] = annual[:, electricity_id, END_USES.index('specific')]
+    columns['peak_electricity_specific'] = peak[:, electricity_id, END_USES.index('specific')]
+
+    buildings[list(columns)] = pd.DataFrame(columns, index=buildings.index)
+
 
 def conventional_energy_consumption(buildings):
     """
@@ -84,54 +189,11 @@ def conventional_energy_consumption(buildings):
 
     #buildings['conventional_dhw_needs'] = dwellings.groupby('building_id')['conventional_dhw_needs'].sum()
 
-    for energy in energy_list:
-
-        buildings[f'conventional_{energy}_consumption'] = 0.
-        buildings[f'conventional_{energy}_heating'] = 0.
-        buildings[f'conventional_{energy}_dhw'] = 0.
-
-        for priority, data_dict in get_heating_system_dict(buildings, energy).items():
-            ids = data_dict['ids']
-            annual_heating_needs = buildings.loc[ids, 'conventional_heating_needs']
-            efficiency = buildings.loc[ids, f'{priority}_heating_system_efficiency']
-            buildings.loc[ids, f'conventional_{energy}_heating'] += annual_heating_needs / efficiency * data_dict['share']
-            buildings.loc[ids, f'conventional_{energy}_consumption'] += buildings.loc[ids, f'conventional_{energy}_heating']
-
-        dhw_ids = buildings.loc[(buildings['dhw_energy'] == energy) & (buildings.to_sim)].index
-        buildings.loc[dhw_ids, f'conventional_{energy}_dhw'] += buildings.loc[dhw_ids, 'conventional_dhw_needs'] / \
-                                                                dhw_efficiencies[
-                                                                    energy]
-
-        buildings.loc[dhw_ids, f'conventional_{energy}_consumption'] += buildings.loc[
-            dhw_ids, f'conventional_{energy}_dhw']
+    conventional = energy_allocation(buildings, buildings['conventional_heating_needs'].values,
+                                     buildings['conventional_dhw_needs'].values)
 
-
-def get_heating_system_dict(buildings, energy):
-    """
-
-    Args:
-        buildings:
-
-    Returns:
-
-    """
-
-    heating_system_dict = {
-        'main': {
-            'ids': buildings.loc[(buildings['main_heating_energy'] == energy) & (buildings.to_sim)].index,
-        },
-        'backup': {
-            'ids': buildings.loc[(buildings['backup_heating_energy'] == energy) &
-                                 (buildings['backup_heating_share'] > 0.) &
-                                 (buildings.to_sim)].index,
-        }
-    }
-    heating_system_dict['main']['share'] = 1. - buildings.loc[
-        heating_system_dict['main']['ids'], 'backup_heating_share'].values
-    heating_system_dict['backup']['share'] = buildings.loc[
-        heating_system_dict['backup']['ids'], 'backup_heating_share'].values
-
-    return heating_system_dict
+    columns = allocation_columns(conventional, 'conventional', {'heating': 'heating', 'dhw': 'dhw'})
+    buildings[list(columns)] = pd.DataFrame(columns, index=buildings.index)
 
 
 def run_models(buildings):
@@ -139,10 +201,11 @@ def run_models(buildings):
     runs the energy consumption model
 
     Args:
-        buildings:
+        buildings (DataFrame or BuildingStore): the buildings or a store
 
     Returns:
 
     """
+    buildings, _ = unpack(buildings)
     annual_energy_consumption(buildings)
-    conventional_energy_consumption(buildings)
\ No newline at end of file
+    conventional_energy_consumption(buildings)
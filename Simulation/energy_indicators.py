@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 
+from Simulation.store import unpack
+
 bin_DPE_values_energy = [-10, 0, 70, 110, 180, 250, 330, 420, np.inf]
 bin_DPE_letter_energy = ["X", "A", "B", "C", "D", "E", "F", "G"]
 
@@ -102,12 +104,13 @@ def run_models(buildings, parameters):
     """
 
     Args:
-        buildings:
+        buildings (DataFrame or BuildingStore): the buildings or a store
         parameters:
 
     Returns:
 
     """
+    buildings, _ = unpack(buildings)
     actual_energy_indicators(buildings, parameters)
     conventional_energy_indicators(buildings, parameters)
     diagnosis_class(buildings)
\ No newline at end of file
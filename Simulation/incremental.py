@@ -0,0 +1,359 @@
+from fnmatch import fnmatchcase
+
+import numpy as np
+import pandas as pd
+
+from Simulation.main import check_model_list, needs_solar_masks
+from Simulation.climate import run_models_BM as run_climate_models_BM, PreprocessedClimate
+from Simulation.solar_masks import run_models as run_solar_mask_models
+from Simulation.solar_gains import run_models as run_solar_gain_models
+from Simulation.thermal_losses import unified_degree_hours, maximal_temperature_difference, boundary_losses, \
+    ventilation_losses
+from Simulation.thermal_needs import run_models as run_thermal_need_models
+from Simulation.energy_consumption import run_models as run_energy_consumption_models, energy_list
+from Simulation.energy_indicators import run_models as run_energy_indicators
+from Simulation.store import unpack
+
+FRAMES = ('buildings', 'boundaries')
+
+
+class Stage(object):
+    '''
+    A step of the building models, it should take care of the following:
+        - the columns read and written in the buildings and boundaries, given as names or fnmatch patterns
+        - the model of parameters.models it belongs to
+        - the function running it on an IncrementalSimulation
+        - the matches of the columns with the patterns, calculated once for all the simulations
+    '''
+
+    def __init__(self, name, model, function, reads, writes):
+        self.name = name
+        self.model = model
+        self.function = function
+        self.reads = {frame: reads.get(frame, []) for frame in FRAMES}
+        self.writes = {frame: writes.get(frame, []) for frame in FRAMES}
+        self.matched = {}
+
+    def __repr__(self):
+        return f'Stage({self.name})'
+
+    def reads_column(self, frame, column):
+        """Returns True if the stage reads a column of frame, column being a name or a pattern"""
+
+        if ('reads', frame, column) not in self.matched:
+            self.matched['reads', frame, column] = matches(column, self.reads[frame])
+
+        return self.matched['reads', frame, column]
+
+    def writes_column(self, frame, column):
+        """Returns True if the stage writes a column of frame, column being a name or a pattern"""
+
+        if ('writes', frame, column) not in self.matched:
+            self.matched['writes', frame, column] = matches(column, self.writes[frame])
+
+        return self.matched['writes', frame, column]
+
+
+def matches(column, patterns):
+    """Returns True if column, a name or a pattern, matches one of patterns or is matched by one of them"""
+
+    return any(fnmatchcase(column, pattern) or fnmatchcase(pattern, column) for pattern in patterns)
+
+
+def same_values(current, new):
+    """Returns True if two columns have the same type and values, missing values being equal"""
+
+    current, new = np.asarray(current), np.asarray(new)
+    if current.dtype != new.dtype or current.shape != new.shape:
+        return False
+    if current.dtype.kind in 'fc':
+        return np.array_equal(current, new, equal_nan=True)
+    if current.dtype.kind == 'O':
+        return pd.Series(current).equals(pd.Series(new))
+
+    return np.array_equal(current, new)
+
+
+def _solar_masks(simulation):
+    run_solar_mask_models(simulation.target, simulation.boundaries, simulation.parameters)
+
+
+def _solar_gains(simulation):
+    run_solar_gain_models(simulation.target, simulation.boundaries, simulation.climate)
+
+
+def _degree_hours(simulation):
+    unified_degree_hours(simulation.buildings, simulation.boundaries, simulation.climate,
+                         degree_hours=simulation.degree_hours)
+    maximal_temperature_difference(simulation.buildings, simulation.boundaries, simulation.climate)
+    simulation.boundaries['thermal_bridge_loss_factor'] = 0.
+
+
+def _boundary_losses(simulation):
+    boundary_losses(simulation.boundaries)
+
+
+def _ventilation_losses(simulation):
+    ventilation_losses(simulation.buildings)
+
+
+def _thermal_needs(simulation):
+    run_thermal_need_models(simulation.target, simulation.boundaries, simulation.parameters)
+
+
+def _energy_consumption(simulation):
+    run_energy_consumption_models(simulation.target)
+
+
+def _energy_indicators(simulation):
+    run_energy_indicators(simulation.target, simulation.parameters)
+
+
+# Columns written by the energy consumption models, {period}_{energy}_{consumption or end use}
+CONSUMPTION_COLUMNS = [f'{period}_{energy}_{suffix}' for period in ['annual', 'peak', 'conventional']
+                       for energy in energy_list for suffix in ['consumption', 'heating', 'dhw', 'cooking', 'specific']]
+
+# The stages of run_models_quick following the climate models, in their order of execution. The thermal loss models
+# are split in the stages depending only on the heating set points and in the boundary and ventilation losses.
+STAGES = [
+    Stage('solar_masks', 'solar_masks', _solar_masks,
+          reads={'buildings': ['geometry', 'height', 'altitude'],
+                 'boundaries': ['type', 'azimuth', 'center_x', 'center_y', 'center_z']},
+          writes={'boundaries': ['mask_*']}),
+    Stage('solar_gains', 'solar_gains', _solar_gains,
+          reads={'boundaries': ['type', 'azimuth', 'area', 'window_share', 'window_solar_factor',
+                                'actual_heating_set_point', 'mask_*']},
+          writes={'boundaries': ['transmitted_solar_gain', 'window_area', 'opaque_area']}),
+    Stage('degree_hours', 'thermal_losses', _degree_hours,
+          reads={'buildings': ['conventional_heating_set_point', 'actual_heating_set_point'],
+                 'boundaries': ['type', 'conventional_heating_set_point', 'actual_heating_set_point']},
+          writes={'buildings': ['*_unified_degree_hours', 'heating_season_duration', 'maximal_temperature_difference'],
+                  'boundaries': ['unified_degree_hours', '*_unified_degree_hours', 'maximal_temperature_difference',
+                                 'thermal_bridge_loss_factor']}),
+    Stage('boundary_losses', 'thermal_losses', _boundary_losses,
+          reads={'boundaries': ['u_value', 'window_u_value', 'opaque_area', 'window_area', 'adjacency_factor',
+                                'thermal_bridge_loss_factor', '*_unified_degree_hours',
+                                'maximal_temperature_difference']},
+          writes={'boundaries': ['loss_factor', 'annual_thermal_losses', 'conventional_thermal_losses',
+                                 'peak_thermal_losses']}),
+    Stage('ventilation_losses', 'thermal_losses', _ventilation_losses,
+          reads={'buildings': ['*_unified_degree_hours', 'maximal_temperature_difference', 'volume',
+                               'air_change_rate']},
+          writes={'buildings': ['annual_ventilation_losses', 'conventional_ventilation_losses',
+                                'peak_ventilation_losses']}),
+    Stage('thermal_needs', 'thermal_needs', _thermal_needs,
+          reads={'buildings': ['to_sim', 'building_id', 'annual_ventilation_losses', 'conventional_ventilation_losses',
+                               'peak_ventilation_losses', 'annual_occupant_gains', 'conventional_occupant_gains',
+                               'heated_area_share', 'regulation_factor', 'intermittency_factor',
+                               'conventional_intermittency_factor'],
+                 'boundaries': ['building_id', 'annual_thermal_losses', 'conventional_thermal_losses',
+                                'peak_thermal_losses', 'transmitted_solar_gain']},
+          writes={'buildings': ['annual_heating_needs', 'conventional_heating_needs', 'peak_heating_needs',
+                                'annual_solar_gains', 'annual_boundary_losses', 'annual_thermal_losses',
+                                'annual_occupant_gains', 'conventional_thermal_losses',
+                                'conventional_occupant_gains']}),
+    Stage('energy_consumption', 'energy_consumption', _energy_consumption,
+          reads={'buildings': ['to_sim', 'heating_system', 'main_heating_energy', 'backup_heating_energy',
+                               'dhw_energy', 'cooking_energy', 'main_heating_system_efficiency',
+                               'backup_heating_system_efficiency', 'backup_heating_share', 'annual_heating_needs',
+                               'peak_heating_needs', 'conventional_heating_needs', 'annual_dhw_needs',
+                               'peak_dhw_needs', 'conventional_dhw_needs', 'annual_specific_needs',
+                               'peak_specific_needs', 'annual_cooking_needs']},
+          writes={'buildings': ['dhw_energy'] + CONSUMPTION_COLUMNS}),
+    Stage('energy_indicators', 'energy_indicators', _energy_indicators,
+          reads={'buildings': CONSUMPTION_COLUMNS + ['living_area']},
+          writes={'buildings': ['total_*', 'conventional_final_consumption', 'conventional_primary_consumption',
+                                'conventional_CO2_emission', 'conventional_*_by_surface', 'diagnosis_class*']}),
+]
+
+
+class IncrementalSimulation(object):
+    '''
+    Runs the building models once and reruns only the stages affected by later changes of the inputs, it should take
+    care of the following:
+        - each stage of STAGES declares the columns it reads and writes, a change of an input column reruns the
+          stages reading it and, transitively, the stages reading their results
+        - inputs overwritten by their own stage (occupant gains clipped by the thermal needs, dhw energy of district
+          networks) are kept aside so that a stage always reruns on its original inputs
+        - the climate is preprocessed once, the solar masks are only part of the stages when run_models_quick would
+          calculate them
+        - each column is matched with the column patterns of the stages once, the updates then only use sets of
+          columns
+
+    For instance, a change of the boundary u_value only reruns boundary_losses, thermal_needs, energy_consumption and
+    energy_indicators. The buildings and boundaries are modified in place, the models are run in the calling process.
+
+    Args:
+        buildings (GeoDataframe or BuildingStore): a GeoDataframe containing the building geometries and parameters,
+        or a store in which case boundaries is ignored
+        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
+        climate (GeoDataframe or PreprocessedClimate): the climate data or a preprocessed climate
+        metadata (dict): climate metadata
+        parameters: instance of class Parameters
+    '''
+
+    def __init__(self, buildings, boundaries, climate, metadata, parameters):
+        check_model_list(parameters.models)
+
+        self.degree_hours = None
+        if isinstance(climate, PreprocessedClimate):
+            self.degree_hours = climate.degree_hours()
+            climate = climate.to_frame()
+        elif 'climate' in parameters.models:
+            climate = run_climate_models_BM(climate, metadata)
+
+        self.target = buildings
+        self.buildings, self.boundaries = unpack(buildings, boundaries)
+        self.climate = climate
+        self.parameters = parameters
+        self.stages = [stage for stage in STAGES if stage.model in parameters.models and
+                       (stage.name != 'solar_masks' or needs_solar_masks(self.buildings, self.boundaries, parameters))]
+        # stages to rerun after each stage, the later stages reading one of its results
+        self.dependents = {stage.name: {later.name for later in self.stages[i + 1:]
+                                        if any(later.reads_column(frame, column) for frame in FRAMES
+                                               for column in stage.writes[frame])}
+                           for i, stage in enumerate(self.stages)}
+        # columns classified once, as inputs or not and by stage reading, writing or overwriting them
+        self.classified = {frame: set() for frame in FRAMES}
+        self.input_columns = {frame: set() for frame in FRAMES}
+        self.stage_columns = {stage.name: {role: {frame: set() for frame in FRAMES}
+                                           for role in ['reads', 'writes', 'overwrites']} for stage in self.stages}
+        self.originals = {frame: {} for frame in FRAMES}
+        self.has_run = False
+        self.last_run = []
+
+    def frame(self, frame):
+        return self.buildings if frame == 'buildings' else self.boundaries
+
+    def classify(self, frame, columns):
+        """Matches the columns of frame not classified yet with the column patterns of the stages"""
+
+        for column in columns:
+            if column in self.classified[frame]:
+                continue
+            self.classified[frame].add(column)
+
+            is_input = None
+            for stage in self.stages:
+                reads, writes = stage.reads_column(frame, column), stage.writes_column(frame, column)
+                # an input is read by a stage before being written by any earlier stage
+                if is_input is None and (reads or writes):
+                    is_input = reads
+                roles = self.stage_columns[stage.name]
+                if reads:
+                    roles['reads'][frame].add(column)
+                if writes:
+                    roles['writes'][frame].add(column)
+                if reads and writes:
+                    roles['overwrites'][frame].add(column)
+            if is_input:
+                self.input_columns[frame].add(column)
+
+    def is_input(self, frame, column):
+        """Returns True if column of frame is read by a stage before being written by any earlier stage"""
+
+        self.classify(frame, [column])
+
+        return column in self.input_columns[frame]
+
+    def downstream_stages(self, changes):
+        """
+        Returns the names of the stages to rerun after a change of columns
+
+        Args:
+            changes (dict): 'buildings' and/or 'boundaries' -> list of the changed columns
+
+        Returns:
+            list of str
+        """
+
+        for frame in FRAMES:
+            self.classify(frame, changes.get(frame, []))
+
+        dirty = set()
+        for stage in self.stages:
+            reads = self.stage_columns[stage.name]['reads']
+            if stage.name in dirty or any(not reads[frame].isdisjoint(changes.get(frame, [])) for frame in FRAMES):
+                dirty.add(stage.name)
+                dirty |= self.dependents[stage.name]
+
+        return [stage.name for stage in self.stages if stage.name in dirty]
+
+    def run_stage(self, stage):
+        """Runs a stage after restoring the original values of the inputs it overwrites"""
+
+        for frame in FRAMES:
+            data, originals = self.frame(frame), self.originals[frame]
+            self.classify(frame, data.columns)
+            for column in self.stage_columns[stage.name]['overwrites'][frame]:
+                if column not in data.columns:
+                    continue
+                if column in originals:
+                    data[column] = originals[column].copy()
+                else:
+                    originals[column] = data[column].copy()
+
+        stage.function(self)
+
+    def run(self):
+        """Runs all the stages
+
+        Returns:
+            DataFrame: the buildings with the model results
+        """
+
+        for stage in self.stages:
+            self.run_stage(stage)
+
+        self.has_run = True
+        self.last_run = [stage.name for stage in self.stages]
+
+        return self.buildings
+
+    def update(self, buildings=None, boundaries=None):
+        """
+        Sets new values of input columns and reruns the stages affected by the values that changed
+
+        Only the input columns (see :meth:`is_input`) are taken from buildings and boundaries, the result columns and
+        the columns read by no stage are ignored, so that frames derived from the original inputs can be given as is.
+
+        Args:
+            buildings (DataFrame): new building input columns, in the row order of the simulated buildings
+            boundaries (DataFrame): new boundary input columns, in the row order of the simulated boundaries
+
+        Returns:
+            DataFrame: the buildings with the model results
+        """
+
+        changes = {frame: [] for frame in FRAMES}
+        for frame, new_values in zip(FRAMES, [buildings, boundaries]):
+            if new_values is None:
+                continue
+
+            data, originals = self.frame(frame), self.originals[frame]
+            if new_values.shape[0] != data.shape[0]:
+                raise ValueError(f'{frame} update has {new_values.shape[0]} rows instead of {data.shape[0]}')
+
+            self.classify(frame, new_values.columns)
+            for column in new_values.columns:
+                if column not in self.input_columns[frame]:
+                    continue
+                values = new_values[column].values
+                if column in data.columns and same_values(originals[column] if column in originals else data[column],
+                                                          values):
+                    continue
+                data[column] = values
+                if column in originals:
+                    originals[column] = data[column].copy()
+                changes[frame].append(column)
+
+        if not self.has_run:
+            return self.run()
+
+        stage_names = self.downstream_stages(changes)
+        for stage in self.stages:
+            if stage.name in stage_names:
+                self.run_stage(stage)
+        self.last_run = stage_names
+
+        return self.buildings
@@ -2,42 +2,21 @@
 import datetime
 
 from Simulation.climate import run_models_BM as run_climate_models_BM
+from Simulation.climate import PreprocessedClimate
+# moved to Simulation.climate, kept here for the imports from Simulation.main
+from Simulation.climate import load_climate_data, EPW_name_dict
+from Simulation.solar_masks import run_models as run_solar_mask_models, elevation_model, has_footprints
 from Simulation.solar_gains import run_models as run_solar_gain_models
 from Simulation.thermal_losses import run_models as run_thermal_loss_models
 from Simulation.thermal_needs import run_models as run_thermal_need_models
 from Simulation.energy_consumption import run_models as run_energy_consumption_models
 from Simulation.energy_indicators import run_models as run_energy_indicators
+from Simulation.store import BuildingStore, unpack
+from Simulation.parallel import run_models_parallel, shard_count
 from Simulation.buildingmodel.exceptions import ModelListError
-from pvlib.iotools import read_epw
-
-EPW_name_dict = {
-    "temp_air": "air_temperature",
-    "temp_dew": "dew_point_temperature",
-    "dni": "direct_normal_radiation",
-    "dhi": "diffuse_horizontal_radiation",
-    "opaque_sky_cover": "opaque_sky_cover",
-}
 
 energy_list     = ['electricity', 'gas', 'oil', 'biomass', 'district_network', 'biogas']
 
-def load_climate_data(file_path):
-    """Reads an EPW climate file and returns the relevant climate data
-
-    Args:
-        file_path (str): path to EPW climate file
-
-    Returns:
-        Dataframe : DataFrame containing air_temperature, dew_point_temperature, wind_speed, wind_direction,
-        direct_normal_radiation, diffuse_horizontal_radiation
-    """
-
-    data, metadata = read_epw(file_path, coerce_year="2019")
-    data = data.loc[:, EPW_name_dict.keys()]
-    data = data.rename(EPW_name_dict, axis=1)
-    data.astype(float)
-
-    return data, metadata
-
 ALL_MODELS = ['climate', 'solar_masks', 'solar_gains', 'thermal_losses', 'dwelling_needs', 'thermal_needs',
               'energy_consumption', 'energy_indicators']
 
@@ -50,10 +29,15 @@ def run_models_quick(buildings, boundaries, climate, metadata, parameters):
     Args:
         dwellings (GeoDataframe): a GeoDataframe containing the dwelling parameters
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
-        buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
-        climate (GeoDataframe): a GeoDataframe containing the climate data
+        buildings (GeoDataframe or BuildingStore): a GeoDataframe containing the building geometries and parameters,
+        or a store containing the buildings and boundaries in which case boundaries is ignored and the result columns
+        are converted to their compact types
+        climate (GeoDataframe or PreprocessedClimate): a GeoDataframe containing the climate data, or a climate
+        already preprocessed by :func:`Simulation.climate.preprocess_climate` in which case the climate models are
+        not run again
         metadata (dict): climate metadata
-        parameters: instance of class Parameters
+        parameters: instance of class Parameters, the buildings are simulated by parameters.n_cpu processes when
+        there are enough of them (see :func:`Simulation.parallel.shard_count`)
 
     Returns:
         tuple of DataFrame and GeoDataFrame, containing the results of the models
@@ -62,8 +46,60 @@ def run_models_quick(buildings, boundaries, climate, metadata, parameters):
     check_model_list(parameters.models)
 
     # Climate models
-    if 'climate' in parameters.models:
-        run_climate_models_BM(climate, metadata)
+    degree_hours = None
+    if isinstance(climate, PreprocessedClimate):
+        degree_hours = climate.degree_hours()
+        climate = climate.to_frame()
+    elif 'climate' in parameters.models:
+        climate = run_climate_models_BM(climate, metadata)
+
+    frames = unpack(buildings, boundaries)
+    count = shard_count(frames[0].shape[0], parameters.n_cpu)
+    elevation_data = None
+    if count > 1 and needs_solar_masks(*frames, parameters):
+        # solar masks are the only models depending on other buildings, the elevation model of the whole stock is
+        # calculated once and shared with the shards
+        elevation_data = elevation_model(frames[0], parameters.grid_resolution)
+
+    if count > 1:
+        run_models_parallel(*frames, climate, degree_hours, parameters, count, elevation_data)
+    else:
+        run_building_models(buildings, boundaries, climate, degree_hours, parameters)
+
+    if isinstance(buildings, BuildingStore):
+        buildings.compact()
+
+    return frames[0]
+
+
+def needs_solar_masks(buildings, boundaries, parameters):
+    """Returns True if the solar masks must be calculated, the masks already present in boundaries are kept and the
+    boundaries of buildings without polygon footprints are left without masks"""
+
+    return ('solar_masks' in parameters.models and not boundaries.columns.str.startswith('mask_').any() and
+            has_footprints(buildings))
+
+
+def run_building_models(buildings, boundaries, climate, degree_hours, parameters, elevation_data=None):
+    """Runs the models following the climate models on buildings and boundaries, modified in place
+
+    Args:
+        buildings (GeoDataframe or BuildingStore): a GeoDataframe containing the building geometries and parameters,
+        or a store in which case boundaries is ignored
+        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
+        climate (DataFrame): the climate data returned by the climate models
+        degree_hours (DataFrame): the degree hour table of the climate, calculated by the thermal loss models if None
+        parameters: instance of class Parameters
+        elevation_data (numpy array): the elevation model used to calculate the solar masks, calculated from buildings
+        if None
+
+    Returns:
+
+    """
+
+    # Solar mask models
+    if needs_solar_masks(*unpack(buildings, boundaries), parameters):
+        run_solar_mask_models(buildings, boundaries, parameters, elevation_data)
 
     # Solar gain models
     if 'solar_gains' in parameters.models:
@@ -71,7 +107,7 @@ def run_models_quick(buildings, boundaries, climate, metadata, parameters):
 
     # Thermal loss models
     if 'thermal_losses' in parameters.models:
-        run_thermal_loss_models(buildings, boundaries, climate)
+        run_thermal_loss_models(buildings, boundaries, climate, degree_hours)
 
     """
     # dwelling needs
@@ -90,7 +126,6 @@ def run_models_quick(buildings, boundaries, climate, metadata, parameters):
     if 'energy_indicators' in parameters.models:
         run_energy_indicators(buildings, parameters)
 
-    return buildings
 
 def check_model_list(model_list):
     """checks a model list for validity
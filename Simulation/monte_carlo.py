@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+
+from Simulation.incremental import IncrementalSimulation
+from Simulation.energy_consumption import energy_allocation, allocation_columns, energy_list, END_USES
+from Simulation.energy_indicators import actual_energy_indicators, conventional_energy_indicators, diagnosis_class, \
+    bin_DPE_letter_energy
+from Simulation.thermal_needs import heating_needs
+from Simulation.utils import get_beta_distribution, building_boundary_index, CP_AIR, RHO_AIR
+
+
+def relative_distribution(dist_dict):
+    """Returns the beta distribution of the ratio of a variable following dist_dict to its mean"""
+
+    mean = dist_dict['min'] + (dist_dict['max'] - dist_dict['min']) * dist_dict['alpha'] / (dist_dict['alpha'] +
+                                                                                           dist_dict['beta'])
+
+    return dict(dist_dict, min=dist_dict['min'] / mean, max=dist_dict['max'] / mean)
+
+
+# Beta distributions of the factors applied to the uncertain inputs. The dhw and specific needs spread like the
+# dwelling level draws of Simulation.dwelling_needs (daily_dhw_use_by_occupant and specific_annual_need_by_occupant
+# of houses), normalized by their mean.
+DEFAULT_DISTRIBUTIONS = {
+    'buildings': {
+        'annual_dhw_needs': relative_distribution({'min': 10., 'max': 150., 'alpha': 2.5, 'beta': 4.5}),
+        'annual_specific_needs': relative_distribution({'min': 900., 'max': 3000., 'alpha': 2.5, 'beta': 4.5}),
+    },
+    'boundaries': {},
+}
+
+# Inputs that can be sampled, the other inputs are those of the deterministic simulation
+SAMPLED_COLUMNS = {
+    'buildings': ['air_change_rate', 'annual_occupant_gains', 'conventional_occupant_gains', 'heated_area_share',
+                  'intermittency_factor', 'conventional_intermittency_factor', 'regulation_factor', 'annual_dhw_needs',
+                  'conventional_dhw_needs', 'annual_specific_needs', 'annual_cooking_needs'],
+    'boundaries': ['u_value', 'window_u_value'],
+}
+
+MONTE_CARLO_OUTPUTS = ['annual_heating_needs', 'total_final_consumption', 'total_primary_consumption',
+                       'total_CO2_emission', 'conventional_primary_consumption_by_surface', 'diagnosis_class']
+
+
+class SampledInputs(object):
+    '''
+    The inputs of a Monte Carlo simulation, it should take care of the following:
+        - the sampled columns are the deterministic values multiplied by factors drawn in their beta distribution,
+          one per row and sample
+        - the other columns are returned as (rows x 1) arrays broadcasting over the samples
+        - the factors are drawn with the generator given, leaving the global numpy generator untouched
+    '''
+
+    def __init__(self, frames, distributions, sample_count, rng=None):
+        self.frames = frames
+        self.samples = {}
+        for frame, columns in distributions.items():
+            for column, dist_dict in columns.items():
+                if column not in SAMPLED_COLUMNS[frame]:
+                    raise ValueError(f'{frame} column {column} can not be sampled, the sampled columns are '
+                                     f'{SAMPLED_COLUMNS[frame]}')
+                values = frames[frame][column].values.astype(float).reshape((-1, 1))
+                self.samples[frame, column] = values * get_beta_distribution(dist_dict, (values.shape[0], sample_count),
+                                                                             random_state=rng)
+
+    def get(self, frame, column):
+        if (frame, column) in self.samples:
+            return self.samples[frame, column]
+
+        return self.frames[frame][column].values.astype(float).reshape((-1, 1))
+
+
+def building_sums(values, boundary_rows, building_count):
+    """Sums boundary values of shape (boundaries x samples) by building, the boundaries without building are skipped"""
+
+    sums = np.zeros((building_count, values.shape[1]))
+    in_building = boundary_rows >= 0
+    np.add.at(sums, boundary_rows[in_building], values[in_building])
+
+    return sums
+
+
+def sampled_indicators(buildings, annual, conventional, parameters):
+    """
+    Calculates the energy indicators of each building and sample with the models of Simulation.energy_indicators, on
+    a frame with one row per building and sample
+
+    Args:
+        buildings (DataFrame): the buildings
+        annual (ndarray): annual energy allocation of shape (buildings x energies x end uses x samples)
+        conventional (ndarray): conventional energy allocation of the same shape
+        parameters: instance of class Parameters
+
+    Returns:
+        DataFrame with one row per building and sample, in building then sample order
+    """
+
+    sample_count = annual.shape[-1]
+    annual = np.moveaxis(annual, -1, 1).reshape((-1,) + annual.shape[1:3])
+    conventional = np.moveaxis(conventional, -1, 1).reshape((-1,) + conventional.shape[1:3])
+
+    columns = allocation_columns(annual, 'annual', {'heating': 'heating', 'dhw': 'dhw', 'cooking': 'cooking'})
+    columns['annual_electricity_specific'] = annual[:, energy_list.index('electricity'), END_USES.index('specific')]
+    columns.update(allocation_columns(conventional, 'conventional', {'heating': 'heating', 'dhw': 'dhw'}))
+    columns['living_area'] = np.repeat(buildings['living_area'].values, sample_count)
+    samples = pd.DataFrame(columns)
+
+    actual_energy_indicators(samples, parameters)
+    conventional_energy_indicators(samples, parameters)
+    diagnosis_class(samples)
+
+    return samples
+
+
+def run_monte_carlo(buildings, boundaries, climate, metadata, parameters, sample_count=1000, distributions=None,
+                    seed=None):
+    """
+    Runs the building models for sample_count draws of the uncertain inputs at once
+
+    The models that do not depend on the sampled inputs (solar gains, degree hours) are run once. The boundary and
+    ventilation losses, thermal needs and energy consumption are then calculated on arrays of shape
+    (buildings x samples) and the energy indicators on one row per building and sample.
+
+    Args:
+        buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
+        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
+        climate (GeoDataframe or PreprocessedClimate): the climate data or a preprocessed climate
+        metadata (dict): climate metadata
+        parameters: instance of class Parameters
+        sample_count (int): number of samples
+        distributions (dict): 'buildings' and/or 'boundaries' -> column -> beta distribution (see
+        :func:`Simulation.utils.get_beta_distribution`) of the factor applied to the column, defaults to
+        DEFAULT_DISTRIBUTIONS. The columns must be in SAMPLED_COLUMNS.
+        seed (int): seed of the random draws, which use their own generator
+
+    Returns:
+        DataFrame with the building_id, the sample number and the MONTE_CARLO_OUTPUTS of each building and sample
+    """
+
+    if distributions is None:
+        distributions = DEFAULT_DISTRIBUTIONS
+
+    rng = np.random.default_rng(seed)
+
+    simulation = IncrementalSimulation(buildings.copy(), boundaries.copy(), climate, metadata, parameters)
+    simulation.run()
+    buildings, boundaries = simulation.buildings, simulation.boundaries
+    # the occupant gains of the inputs, before their clip by the thermal need models
+    frames = {'buildings': buildings.assign(**simulation.originals['buildings']), 'boundaries': boundaries}
+    inputs = SampledInputs(frames, distributions, sample_count, rng)
+    get = inputs.get
+
+    building_count = buildings.shape[0]
+    boundary_rows = building_boundary_index(boundaries, buildings)
+
+    # Boundary losses
+    loss_factor = get('boundaries', 'u_value') * get('boundaries', 'opaque_area') + \
+        get('boundaries', 'window_u_value') * get('boundaries', 'window_area')
+    loss_factor = (loss_factor * get('boundaries', 'adjacency_factor') +
+                   get('boundaries', 'thermal_bridge_loss_factor'))
+    # the annual losses are calculated with the actual heating set point
+    degree_hours = {'annual': 'actual_unified_degree_hours', 'conventional': 'conventional_unified_degree_hours'}
+    boundary_losses = {mode: building_sums(np.broadcast_to(loss_factor * get('boundaries', udh) / 1000.,
+                                                           (boundaries.shape[0], sample_count)),
+                                           boundary_rows, building_count) for mode, udh in degree_hours.items()}
+    solar_gains = building_sums(get('boundaries', 'transmitted_solar_gain'), boundary_rows, building_count)
+
+    # Ventilation losses
+    air_flow = get('buildings', 'volume') * get('buildings', 'air_change_rate') * CP_AIR * RHO_AIR / (3600. * 1000.)
+    thermal_losses = {mode: boundary_losses[mode] + get('buildings', udh) * air_flow
+                      for mode, udh in degree_hours.items()}
+
+    # Thermal needs
+    to_sim = buildings['to_sim'].values.astype(bool).reshape((-1, 1))
+    annual_solar_gains = np.clip(solar_gains, 0., parameters.maximal_solar_gain_share * thermal_losses['annual'])
+    needs = {}
+    for mode, intermittency in [('annual', 'intermittency_factor'),
+                                ('conventional', 'conventional_intermittency_factor')]:
+        mode_needs, _ = heating_needs(thermal_losses[mode], annual_solar_gains,
+                                      get('buildings', f'{mode}_occupant_gains'), get('buildings', 'heated_area_share'),
+                                      get('buildings', intermittency), get('buildings', 'regulation_factor'),
+                                      parameters.maximal_occupant_gain_share)
+        needs[mode] = np.where(to_sim, mode_needs, 0.)
+    needs['annual'] = np.maximum(needs['annual'], 0.)
+
+    # Energy consumption
+    def sample_array(frame, column):
+        return np.broadcast_to(get(frame, column), (building_count, sample_count))
+
+    annual = energy_allocation(buildings, needs['annual'], sample_array('buildings', 'annual_dhw_needs'),
+                               specific_needs=sample_array('buildings', 'annual_specific_needs'),
+                               cooking_needs=sample_array('buildings', 'annual_cooking_needs'))
+    conventional = energy_allocation(buildings, needs['conventional'],
+                                     sample_array('buildings', 'conventional_dhw_needs'))
+
+    # Energy indicators
+    samples = sampled_indicators(buildings, annual, conventional, parameters)
+    samples.insert(0, 'sample', np.tile(np.arange(sample_count), building_count))
+    samples.insert(0, 'building_id', np.repeat(buildings['building_id'].values, sample_count))
+    samples['annual_heating_needs'] = needs['annual'].ravel()
+
+    return samples.loc[:, ['building_id', 'sample'] + MONTE_CARLO_OUTPUTS]
+
+
+def summarize_monte_carlo(samples, quantiles=(0.05, 0.5, 0.95), columns=('total_final_consumption',)):
+    """
+    Summarizes the samples returned by :func:`run_monte_carlo` by building
+
+    Args:
+        samples (DataFrame): the samples
+        quantiles (list of float): the quantiles to calculate
+        columns (list of str): the numeric outputs to summarize
+
+    Returns:
+        DataFrame indexed by building_id with the mean and quantiles {column}_q{quantile} of each column and the share
+        of the samples in each diagnosis class
+    """
+
+    by_building = samples.groupby('building_id')
+    summary = {}
+    for column in columns:
+        summary[f'{column}_mean'] = by_building[column].mean()
+        for quantile in quantiles:
+            summary[f'{column}_q{quantile:g}'] = by_building[column].quantile(quantile)
+
+    summary = pd.DataFrame(summary)
+    class_shares = pd.crosstab(samples['building_id'], samples['diagnosis_class'].astype(str), normalize='index')
+    class_shares = class_shares.reindex(columns=bin_DPE_letter_energy, fill_value=0.).add_prefix('diagnosis_class_')
+
+    return summary.join(class_shares)
@@ -0,0 +1,191 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from Simulation.utils import building_boundary_index
+
+# Minimal number of buildings of a shard, smaller simulations are run in the calling process
+MIN_SHARD_BUILDINGS = 2000
+
+# State of the worker processes, set once by _init_worker
+_worker_state = {}
+
+
+def shard_count(building_count, n_cpu, min_shard_buildings=None):
+    """Returns the number of shards used to simulate building_count buildings on n_cpu processes, shards having at
+    least min_shard_buildings buildings (defaults to MIN_SHARD_BUILDINGS)"""
+
+    if n_cpu is None or n_cpu <= 1:
+        return 1
+
+    if min_shard_buildings is None:
+        min_shard_buildings = MIN_SHARD_BUILDINGS
+
+    return max(1, min(n_cpu, building_count // min_shard_buildings))
+
+
+def share_array(array):
+    """
+    Copies an array in a new shared memory block
+
+    Args:
+        array (numpy array): the array to share
+
+    Returns:
+        tuple of the SharedMemory, that must be kept open and unlinked by the caller, and of the specification given
+        to :func:`attach_array`
+    """
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """Returns the SharedMemory and a read-only array view of an array shared by :func:`share_array`"""
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+    array.flags.writeable = False
+
+    return shm, array
+
+
+class SharedClimate(object):
+    '''
+    The climate data in shared memory, it should take care of the following:
+        - the numeric columns are stored in one float64 block and the time index in an int64 block
+        - the workers rebuild the climate DataFrame with the original column types from the shared blocks
+        - the blocks are released by close
+    '''
+
+    def __init__(self, climate):
+        self.columns = list(climate.columns)
+        self.dtypes = [climate[col].dtype.str for col in self.columns]
+        self.tz = climate.index.tz
+        self.values_shm, self.values_spec = share_array(climate.values.astype(np.float64))
+        self.index_shm, self.index_spec = share_array(climate.index.asi8)
+
+    def spec(self):
+        return self.columns, self.dtypes, self.tz, self.values_spec, self.index_spec
+
+    @staticmethod
+    def attach(spec):
+        """Rebuilds the climate DataFrame from the specification returned by spec, returns it with the SharedMemory"""
+
+        columns, dtypes, tz, values_spec, index_spec = spec
+        values_shm, values = attach_array(values_spec)
+        index_shm, index = attach_array(index_spec)
+        climate_index = pd.DatetimeIndex(pd.to_datetime(index, utc=True))
+        if tz is not None:
+            climate_index = climate_index.tz_convert(tz)
+        else:
+            climate_index = climate_index.tz_localize(None)
+        climate = pd.DataFrame({col: values[:, i].astype(dtype, copy=False) for i, (col, dtype) in enumerate(zip(columns, dtypes))},
+                               index=climate_index)
+
+        return climate, (values_shm, index_shm)
+
+    def close(self):
+        for shm in [self.values_shm, self.index_shm]:
+            shm.close()
+            shm.unlink()
+
+
+def _init_worker(climate_spec, degree_hours, parameters, elevation_spec):
+    climate, shms = SharedClimate.attach(climate_spec)
+    _worker_state.update(climate=climate, shms=shms, degree_hours=degree_hours, parameters=parameters,
+                         elevation_data=None)
+    if elevation_spec is not None:
+        elevation_shm, elevation_data = attach_array(elevation_spec)
+        _worker_state.update(elevation_data=elevation_data, shms=shms + (elevation_shm,))
+
+
+def _run_shard(buildings, boundaries):
+    from Simulation.main import run_building_models
+
+    run_building_models(buildings, boundaries, _worker_state['climate'], _worker_state['degree_hours'],
+                        _worker_state['parameters'], _worker_state['elevation_data'])
+
+    return buildings, boundaries
+
+
+def split_shards(buildings, boundaries, count):
+    """
+    Splits buildings in count contiguous shards together with their boundaries
+
+    Args:
+        buildings (DataFrame): the buildings
+        boundaries (DataFrame): the boundaries
+        count (int): the number of shards
+
+    Returns:
+        tuple of the list of (buildings, boundaries) shards and of the boundary positions of each shard
+    """
+
+    building_shards = np.arange(buildings.shape[0]) * count // buildings.shape[0]
+    # boundaries whose building is missing go to the first shard
+    boundary_shards = building_shards[np.clip(building_boundary_index(boundaries, buildings), 0, None)]
+
+    shards, boundary_positions = [], []
+    for shard in range(count):
+        positions = np.flatnonzero(boundary_shards == shard)
+        shards.append((buildings.iloc[building_shards == shard].copy(), boundaries.iloc[positions].copy()))
+        boundary_positions.append(positions)
+
+    return shards, boundary_positions
+
+
+def write_back(frame, results):
+    """Sets the columns of results, whose rows are in the same order as frame, in frame"""
+
+    for col in results.columns:
+        frame[col] = results[col].values
+
+
+def run_models_parallel(buildings, boundaries, climate, degree_hours, parameters, count, elevation_data=None):
+    """
+    Runs the building models on count shards of buildings in a process pool
+
+    The shards are contiguous blocks of buildings with their boundaries. The climate data, and the elevation model if
+    the solar masks are calculated, are shared with the workers through shared memory instead of being sent with each
+    shard. The results are merged in the original order of the buildings and boundaries, that are modified in place
+    as in a sequential run.
+
+    Args:
+        buildings (DataFrame): the buildings
+        boundaries (DataFrame): the boundaries
+        climate (DataFrame): the climate data returned by the climate models
+        degree_hours (DataFrame): the degree hour table of the climate or None
+        parameters: instance of class Parameters
+        count (int): the number of shards, see :func:`shard_count`
+        elevation_data (numpy array): the elevation model of all the buildings, see
+        :func:`Simulation.solar_masks.elevation_model`
+
+    Returns:
+
+    """
+
+    shared_climate = SharedClimate(climate)
+    elevation_shm, elevation_spec = None, None
+    if elevation_data is not None:
+        elevation_shm, elevation_spec = share_array(elevation_data)
+
+    try:
+        shards, boundary_positions = split_shards(buildings, boundaries, count)
+        with ProcessPoolExecutor(max_workers=count, initializer=_init_worker,
+                                 initargs=(shared_climate.spec(), degree_hours, parameters, elevation_spec)) as executor:
+            results = list(executor.map(_run_shard, *zip(*shards)))
+    finally:
+        shared_climate.close()
+        if elevation_shm is not None:
+            elevation_shm.close()
+            elevation_shm.unlink()
+
+    boundary_order = np.argsort(np.concatenate(boundary_positions), kind='stable')
+    write_back(buildings, pd.concat([result[0] for result in results]))
+    write_back(boundaries, pd.concat([result[1] for result in results]).iloc[boundary_order])
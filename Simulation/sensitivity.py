@@ -0,0 +1,359 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# the energy consumption models import Simulation.main, which must be imported first
+import Simulation.main
+from Simulation.energy_consumption import energy_allocation, energy_list, END_USES
+from Simulation.thermal_needs import aggregate_boundaries
+from Simulation.utils import heating_season, CP_AIR, RHO_AIR
+
+# Integer variables for boundary types
+EXTERIOR_WALL = 0
+INTERIOR_WALL = 1
+ROOF = 2
+FLOOR = 3
+
+SENSITIVITY_OUTPUTS = ['total_final_consumption', 'total_CO2_emission']
+
+
+def degree_hour_slopes(climate, set_points, heating_season_start=datetime.datetime(2019, 10, 1),
+                       heating_season_end=datetime.datetime(2020, 5, 20)):
+    """
+    Calculates the derivative of the unified degree hours with respect to the heating set point, which is the number of
+    hours of the heating season during which the temperature is below the set point
+
+    Args:
+        climate (Dataframe): a Dataframe containing climate data
+        set_points (numpy array): the heating set points
+        heating_season_start (datetime.time): start of the heating season
+        heating_season_end (datetime.time): end of the heating season
+
+    Returns:
+        Dataframe indexed by set point with columns air_unified_degree_hours and ground_unified_degree_hours
+    """
+
+    heating_season_index = heating_season(climate, heating_season_start, heating_season_end)
+    column_set_points = np.unique(np.asarray(set_points, dtype=float)).reshape((-1, 1))
+
+    return pd.DataFrame(index=pd.Index(column_set_points.ravel(), name='set_point'), data={
+        f'{medium}_unified_degree_hours': (climate.loc[heating_season_index, f'{medium}_temperature'].values <
+                                           column_set_points).sum(axis=1).astype(float)
+        for medium in ['air', 'ground']})
+
+
+def set_point_change_ranges(climate, set_points, heating_season_start=datetime.datetime(2019, 10, 1),
+                            heating_season_end=datetime.datetime(2020, 5, 20)):
+    """
+    Calculates the range of set point changes over which the set point slopes are exact, which is the range between
+    the hourly air and ground temperatures of the heating season surrounding the set point
+
+    The unified degree hours are piecewise linear in the set point and the heating periods of the solar gains change
+    each time the set point crosses an hourly air temperature, a change is exact if it is above set_point_change_min
+    and at most set_point_change_max.
+
+    Args:
+        climate (Dataframe): a Dataframe containing climate data
+        set_points (numpy array): the heating set points
+        heating_season_start (datetime.time): start of the heating season
+        heating_season_end (datetime.time): end of the heating season
+
+    Returns:
+        Dataframe indexed by set point with columns set_point_change_min and set_point_change_max
+    """
+
+    heating_season_index = heating_season(climate, heating_season_start, heating_season_end)
+    set_points = np.unique(np.asarray(set_points, dtype=float))
+    lower_bounds = np.full(set_points.shape[0], -np.inf)
+    upper_bounds = np.full(set_points.shape[0], np.inf)
+    for medium in ['air', 'ground']:
+        temperatures = np.unique(climate.loc[heating_season_index, f'{medium}_temperature'].values.astype(float))
+        # first temperature at or above each set point
+        positions = np.searchsorted(temperatures, set_points, side='left')
+        lower_bounds = np.maximum(lower_bounds, np.where(positions > 0, temperatures[np.maximum(positions - 1, 0)],
+                                                         -np.inf))
+        upper_bounds = np.minimum(upper_bounds, np.where(positions < temperatures.shape[0],
+                                                         temperatures[np.minimum(positions,
+                                                                                 temperatures.shape[0] - 1)],
+                                                         np.inf))
+
+    return pd.DataFrame(index=pd.Index(set_points, name='set_point'),
+                        data={'set_point_change_min': lower_bounds - set_points,
+                              'set_point_change_max': upper_bounds - set_points})
+
+
+def consumption_factors(buildings, parameters):
+    """
+    Calculates the increase of the outputs for a unit increase of the annual heating needs of each building, from the
+    allocation of the heating needs to the main and backup systems
+
+    Args:
+        buildings (DataFrame): the buildings, giving the energy carriers, efficiencies and backup shares
+        parameters: instance of class Parameters
+
+    Returns:
+        dict output -> numpy array, for each output of SENSITIVITY_OUTPUTS
+    """
+
+    heating = energy_allocation(buildings, np.ones(buildings.shape[0]),
+                                np.zeros(buildings.shape[0]))[:, :, END_USES.index('heating')]
+    co2_factors = np.array([parameters.co2_energies.get(energy, 0.) for energy in energy_list])
+
+    return {'total_final_consumption': heating.sum(axis=1), 'total_CO2_emission': heating @ co2_factors}
+
+
+def thermal_loss_changes(boundaries, changed_boundaries, building_ids, degree_hours=None):
+    """
+    Calculates the change of the annual thermal losses of each building when the U values of its boundaries are set to
+    those of changed_boundaries
+
+    Args:
+        boundaries (DataFrame): the simulated boundaries
+        changed_boundaries (DataFrame): the same boundaries, in the same order, with other u_value and window_u_value
+        building_ids (numpy array): the ids of the buildings for which the changes are returned
+        degree_hours (numpy array): the unified degree hours of each boundary, defaults to its
+        actual_unified_degree_hours. With the derivatives of the degree hours, gives the derivatives of the changes
+        with respect to the set point.
+
+    Returns:
+        numpy array aligned on building_ids
+    """
+
+    if degree_hours is None:
+        degree_hours = boundaries['actual_unified_degree_hours'].values
+
+    loss_factor_changes = ((changed_boundaries['u_value'].values - boundaries['u_value'].values) *
+                           boundaries['opaque_area'].values +
+                           (changed_boundaries['window_u_value'].values - boundaries['window_u_value'].values) *
+                           boundaries['window_area'].values)
+    changes = pd.DataFrame({'building_id': boundaries['building_id'].values,
+                            'annual_thermal_losses': loss_factor_changes * boundaries['adjacency_factor'].values *
+                            degree_hours / 1000.})
+
+    return changes.groupby('building_id')['annual_thermal_losses'].sum().reindex(building_ids, fill_value=0.).values
+
+
+def boundary_degree_hour_slopes(boundaries, climate):
+    """Returns the derivative of the unified degree hours of each boundary with respect to its actual heating set
+    point, 0 for the boundaries without losses to the air or the ground"""
+
+    slopes = degree_hour_slopes(climate, boundaries['actual_heating_set_point'].values)
+
+    boundary_slopes = np.zeros(boundaries.shape[0])
+    air_boundaries = boundaries['type'].isin([EXTERIOR_WALL, ROOF]).values
+    ground_boundaries = boundaries['type'].isin([FLOOR]).values
+    for selection, medium in [(air_boundaries, 'air'), (ground_boundaries, 'ground')]:
+        boundary_slopes[selection] = slopes[f'{medium}_unified_degree_hours'].reindex(
+            boundaries.loc[selection, 'actual_heating_set_point'].values).values
+
+    return boundary_slopes
+
+
+def set_point_loss_slopes(buildings, boundaries, climate, building_ids):
+    """
+    Calculates the derivative of the annual thermal losses (boundaries and ventilation) of each building with respect
+    to its actual heating set point
+
+    Args:
+        buildings (DataFrame): the simulated buildings
+        boundaries (DataFrame): the simulated boundaries
+        climate (DataFrame): the climate data
+        building_ids (numpy array): the ids of the buildings for which the derivatives are returned
+
+    Returns:
+        numpy array aligned on building_ids
+    """
+
+    boundary_slopes = boundary_degree_hour_slopes(boundaries, climate)
+    boundary_slopes = pd.DataFrame({
+        'building_id': boundaries['building_id'].values,
+        'annual_thermal_losses': (boundaries['loss_factor'].values * boundaries['adjacency_factor'].values +
+                                  boundaries['thermal_bridge_loss_factor'].values) * boundary_slopes / 1000.})
+    boundary_slopes = boundary_slopes.groupby('building_id')['annual_thermal_losses'].sum().reindex(
+        building_ids, fill_value=0.).values
+
+    slopes = degree_hour_slopes(climate, buildings['actual_heating_set_point'].values)
+    current_buildings = buildings.loc[building_ids, :]
+    ventilation_slopes = (slopes['air_unified_degree_hours'].reindex(
+        current_buildings['actual_heating_set_point'].values).values * current_buildings['volume'].values *
+                          current_buildings['air_change_rate'].values * CP_AIR * RHO_AIR) / (3600. * 1000.)
+
+    return boundary_slopes + ventilation_slopes
+
+
+def set_point_change_bounds(buildings, boundaries, climate, building_ids):
+    """
+    Calculates the range of changes of the actual heating set point of each building over which its set point slope is
+    exact, see :func:`set_point_change_ranges`
+
+    Args:
+        buildings (DataFrame): the simulated buildings
+        boundaries (DataFrame): the simulated boundaries
+        climate (DataFrame): the climate data
+        building_ids (numpy array): the ids of the buildings for which the ranges are returned
+
+    Returns:
+        tuple of numpy arrays aligned on building_ids: lower (excluded) and upper (included) bounds of the changes
+    """
+
+    ranges = set_point_change_ranges(climate, np.concatenate([boundaries['actual_heating_set_point'].values,
+                                                              buildings['actual_heating_set_point'].values]))
+    # the range of a building is the intersection of the ranges of its set point and of those of its boundaries
+    bounds = pd.concat([
+        pd.DataFrame({'building_id': frame['building_id'].values,
+                      'lower': ranges['set_point_change_min'].reindex(frame['actual_heating_set_point'].values).values,
+                      'upper': ranges['set_point_change_max'].reindex(frame['actual_heating_set_point'].values).values})
+        for frame in [boundaries, buildings]])
+    bounds = bounds.groupby('building_id').agg(lower=('lower', 'max'), upper=('upper', 'min')).reindex(building_ids)
+
+    return bounds['lower'].values, bounds['upper'].values
+
+
+def heating_need_slopes(buildings, boundaries, parameters, occupant_gains, building_ids):
+    """
+    Calculates the derivative of the annual heating needs with respect to the annual thermal losses, and the range of
+    thermal losses on which it is valid
+
+    The heating needs of :func:`Simulation.thermal_needs.calculate_thermal_needs` are linear in the thermal losses
+    between the losses at which the solar gains and the occupant gains start or stop being clipped to their maximal
+    share of the losses and at which the needs become negative and are set to 0. The derivative accounts for the clips
+    that bind at the current losses.
+
+    Args:
+        buildings (DataFrame): the simulated buildings
+        boundaries (DataFrame): the simulated boundaries
+        parameters: instance of class Parameters
+        occupant_gains (numpy array): the annual occupant gains given to the thermal need models, before their clip
+        building_ids (numpy array): the ids of the buildings for which the derivatives are returned
+
+    Returns:
+        tuple of numpy arrays aligned on building_ids: derivatives, lower and upper bounds of the thermal losses
+    """
+
+    gain_share = parameters.maximal_occupant_gain_share
+    solar_share = parameters.maximal_solar_gain_share
+    current_buildings = buildings.loc[building_ids, :]
+
+    thermal_losses = current_buildings['annual_thermal_losses'].values.astype(float)
+    solar_gains = np.clip(aggregate_boundaries(boundaries, building_ids)['transmitted_solar_gain'], 0., None)
+    occupant_gains = np.clip(occupant_gains, 0., None)
+    heated_factor = current_buildings['heated_area_share'].values * current_buildings['intermittency_factor'].values
+    regulation_factor = current_buildings['regulation_factor'].values
+
+    solar_clipped = solar_gains > solar_share * thermal_losses
+    occupant_clipped = occupant_gains > gain_share * thermal_losses
+    raw_slopes = regulation_factor * (heated_factor * (1. - solar_share * solar_clipped) - gain_share * occupant_clipped)
+    raw_needs = ((thermal_losses - np.minimum(solar_gains, solar_share * thermal_losses)) * heated_factor -
+                 np.minimum(occupant_gains, gain_share * thermal_losses)) * regulation_factor
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        breakpoints = np.stack([np.where(solar_share > 0., solar_gains / solar_share, np.nan),
+                                np.where(gain_share > 0., occupant_gains / gain_share, np.nan),
+                                np.where(raw_slopes != 0., thermal_losses - raw_needs / raw_slopes, np.nan)])
+    losses = thermal_losses.reshape((1, -1))
+    lower_bounds = np.max(np.where(breakpoints <= losses, breakpoints, -np.inf), axis=0)
+    upper_bounds = np.min(np.where(breakpoints > losses, breakpoints, np.inf), axis=0)
+
+    return np.where(raw_needs > 0., raw_slopes, 0.), lower_bounds, upper_bounds
+
+
+def linear_sensitivity(simulation, boundary_variables, outputs=None):
+    """
+    Calculates, for each simulated building, the coefficients of a linear model of the outputs with respect to changes
+    of the boundary U values and of the actual heating set point
+
+    A boundary variable goes from 0 (the simulated U values) to 1 (the U values of its boundaries), so that the outputs
+    of a combination of variables are the simulated outputs plus the sum of the coefficients of the variables. The set
+    point coefficient is per °C. The coefficients are exact as long as the annual thermal losses of the building, which
+    are the simulated losses plus the sum of the thermal_losses_{variable} of the variables, stay between
+    thermal_losses_min and thermal_losses_max. The set point coefficient is a local slope: the degree hours bend and
+    the heating periods of the solar gains change each time the set point crosses an hourly temperature of the heating
+    season, so that it is only exact for changes above heating_set_point_min and at most heating_set_point_max, which
+    are usually a fraction of °C. Beyond them, the set point results are an approximation. As the boundary losses are
+    the product of the U values and of the degree hours, the {output}_{variable}_heating_set_point coefficients give
+    the change of the coefficient of a boundary variable per °C of set point change.
+
+    Args:
+        simulation (IncrementalSimulation): a simulation that has run
+        boundary_variables (dict): variable name -> boundaries, in the order of the simulated boundaries, whose u_value
+        and window_u_value are the values of the variable at 1
+        outputs (list of str): the building outputs, in SENSITIVITY_OUTPUTS, defaults to all of them
+
+    Returns:
+        DataFrame indexed by building_id with the simulated outputs, the {output}_{variable} coefficients, the annual
+        thermal losses with their validity range, the thermal_losses_{variable} changes and the validity range of the
+        set point changes
+    """
+
+    if outputs is None:
+        outputs = SENSITIVITY_OUTPUTS
+
+    buildings, boundaries, parameters = simulation.buildings, simulation.boundaries, simulation.parameters
+    building_ids = buildings.loc[buildings.to_sim, 'building_id'].values
+    occupant_gains = simulation.originals['buildings'].get('annual_occupant_gains', buildings['annual_occupant_gains'])
+    occupant_gains = occupant_gains.loc[building_ids].values
+
+    need_slopes, lower_bounds, upper_bounds = heating_need_slopes(buildings, boundaries, parameters, occupant_gains,
+                                                                  building_ids)
+    loss_changes = {name: thermal_loss_changes(boundaries, changed_boundaries, building_ids)
+                    for name, changed_boundaries in boundary_variables.items()}
+    loss_changes['heating_set_point'] = set_point_loss_slopes(buildings, boundaries, simulation.climate, building_ids)
+    degree_hour_changes = boundary_degree_hour_slopes(boundaries, simulation.climate)
+    for name, changed_boundaries in boundary_variables.items():
+        loss_changes[f'{name}_heating_set_point'] = thermal_loss_changes(boundaries, changed_boundaries, building_ids,
+                                                                         degree_hour_changes)
+
+    factors = consumption_factors(buildings.loc[building_ids, :], parameters)
+    sensitivity = {output: buildings.loc[building_ids, output].values for output in outputs}
+    for output in outputs:
+        for name, changes in loss_changes.items():
+            sensitivity[f'{output}_{name}'] = factors[output] * need_slopes * changes
+    sensitivity['annual_thermal_losses'] = buildings.loc[building_ids, 'annual_thermal_losses'].values
+    sensitivity['thermal_losses_min'] = lower_bounds
+    sensitivity['thermal_losses_max'] = upper_bounds
+    for name, changes in loss_changes.items():
+        sensitivity[f'thermal_losses_{name}'] = changes
+    sensitivity['heating_set_point_min'], sensitivity['heating_set_point_max'] = set_point_change_bounds(
+        buildings, boundaries, simulation.climate, building_ids)
+
+    return pd.DataFrame(sensitivity, index=pd.Index(building_ids, name='building_id'))
+
+
+def evaluate_linear_sensitivity(sensitivity, variables, output='total_final_consumption'):
+    """
+    Evaluates the linear model of :func:`linear_sensitivity` for many combinations of variables with matrix products
+
+    A combination is valid if its thermal losses stay in the validity range of the building and, when it changes the
+    set point, if the change stays in the validity range of the set point coefficient.
+
+    Args:
+        sensitivity (DataFrame): the result of :func:`linear_sensitivity`
+        variables (DataFrame): one row per combination, one column per variable (0 to 1 for boundary variables, change
+        in °C for heating_set_point)
+        output (str): the output to evaluate
+
+    Returns:
+        tuple of DataFrame (combinations x buildings): the outputs and True where the linear model is exact
+    """
+
+    names = list(variables.columns)
+    x = variables.values.astype(float)
+    if 'heating_set_point' in names:
+        # products of the boundary variables and of the set point change
+        boundary_names = [name for name in names if name != 'heating_set_point']
+        x = np.concatenate([x, variables[boundary_names].values.astype(float) *
+                            variables[['heating_set_point']].values.astype(float)], axis=1)
+        names = names + [f'{name}_heating_set_point' for name in boundary_names]
+    predictions = sensitivity[output].values + x @ sensitivity[[f'{output}_{name}' for name in names]].values.T
+    thermal_losses = (sensitivity['annual_thermal_losses'].values +
+                      x @ sensitivity[[f'thermal_losses_{name}' for name in names]].values.T)
+    valid = ((thermal_losses >= sensitivity['thermal_losses_min'].values) &
+             (thermal_losses <= sensitivity['thermal_losses_max'].values))
+    if 'heating_set_point' in names:
+        set_point_changes = variables['heating_set_point'].values.astype(float).reshape((-1, 1))
+        valid &= ((set_point_changes > sensitivity['heating_set_point_min'].values) &
+                  (set_point_changes <= sensitivity['heating_set_point_max'].values))
+
+    return (pd.DataFrame(predictions, index=variables.index, columns=sensitivity.index),
+            pd.DataFrame(valid, index=variables.index, columns=sensitivity.index))
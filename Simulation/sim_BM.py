@@ -1,5 +1,9 @@
+import functools
 import pandas as pd
 from Simulation.main import *
+from Simulation.climate import preprocess_climate
+from Simulation.incremental import IncrementalSimulation
+from Simulation.sensitivity import linear_sensitivity, evaluate_linear_sensitivity
 import os
 
 
@@ -27,16 +31,55 @@ co2_energies = {
                 "biogas": 0.024
             }
 
-def FMES(climate, metadata, reno_dict, heating_set_point = 18):
+@functools.lru_cache(maxsize=None)
+def _read_case_study(building_file, boundary_file):
+
+    buildings = pd.read_csv(building_file, sep=';')
+    boundaries = pd.read_csv(boundary_file, sep=';')
+    buildings.set_index('building_id', inplace=True, drop=False)
+
+    return buildings, boundaries
+
+
+def load_case_study(building_file=data_path['data'] + 'Building_case_study.csv',
+                    boundary_file=data_path['data'] + 'Boundaries_case_study.csv'):
+    """Loads the building and boundary inputs of the case study
+
+    The csv files are only read once, each call returns fresh copies that can be modified by the models.
+
+    Args:
+        building_file (str): path to the building csv file
+        boundary_file (str): path to the boundary csv file
+
+    Returns:
+        tuple of DataFrame, containing the buildings (indexed by building_id) and the boundaries
+    """
 
-    buildings = pd.read_csv(data_path['data'] + 'Building_case_study.csv', sep=';')
-    boundaries = pd.read_csv(data_path['data'] + 'Boundaries_case_study.csv', sep=';')
-    metadata['building_altitude'] = buildings.altitude.mean()
+    buildings, boundaries = _read_case_study(building_file, boundary_file)
+
+    return buildings.copy(), boundaries.copy()
+
+
+def set_heating_set_point(buildings, boundaries, heating_set_point):
 
     buildings['actual_heating_set_point'] = heating_set_point
     boundaries['actual_heating_set_point'] = heating_set_point
 
-    buildings.set_index('building_id', inplace=True, drop=False)
+
+def apply_renovation(buildings, boundaries, reno_dict):
+    """Applies the renovation measures of reno_dict to the buildings and boundaries
+
+    The measures only modify the envelope U values and the heating system, they do not change the inputs of the
+    climate, solar gain and degree hour models.
+
+    Args:
+        buildings (DataFrame): a DataFrame containing the building parameters
+        boundaries (DataFrame): a DataFrame containing the boundary parameters
+        reno_dict (dict): the renovation measures, a measure is applied when its value is not None
+
+    Returns:
+
+    """
 
     if reno_dict['291 Mass inventory heating'] is not None:
         buildings['main_heating_system_efficiency'] = reno_dict['291 Mass inventory heating']     # efficiency heating_system
@@ -56,6 +99,20 @@ def FMES(climate, metadata, reno_dict, heating_set_point = 18):
     if reno_dict['231 Bearing outer wall'] is not None:
         boundaries.loc[boundaries.type == 0, 'u_value'] = 0.2       #exterior walls
 
+
+# Renovation measure changing the heating system, the other measures only change the envelope U values
+HEATING_MEASURE = '291 Mass inventory heating'
+
+
+def FMES(climate, metadata, reno_dict, heating_set_point = 18):
+
+    buildings, boundaries = load_case_study()
+    if not isinstance(climate, PreprocessedClimate):
+        metadata = dict(metadata, building_altitude=buildings.altitude.mean())
+
+    set_heating_set_point(buildings, boundaries, heating_set_point)
+    apply_renovation(buildings, boundaries, reno_dict)
+
     parameters = Parameters(co2_energies=co2_energies)
 
     buildings = run_models_quick(buildings, boundaries, climate, metadata, parameters)
@@ -64,6 +121,186 @@ def FMES(climate, metadata, reno_dict, heating_set_point = 18):
     return float(buildings['total_final_consumption'].iloc[0])
 
 
+
+def renovation_sensitivity(climate, metadata, reno_values, heating_set_point=18, buildings=None, boundaries=None,
+                           parameters=None):
+    """Calculates the linear sensitivity of the outputs of each building to the renovation measures and the set point
+
+    The envelope measures are variables going from 0 (not applied) to 1 (applied), see
+    :func:`Simulation.sensitivity.linear_sensitivity`. The heating measure changes the energy carriers, it is not
+    linear: the sensitivity is calculated without it and, if reno_values gives it, with it.
+
+    Args:
+        climate: climate DataFrame or PreprocessedClimate
+        metadata (dict): climate metadata
+        reno_values (dict): renovation measure -> value used when the measure is applied (see
+        :func:`apply_renovation`)
+        heating_set_point (float): the actual heating set point around which the sensitivity is calculated
+        buildings (DataFrame): building inputs, defaults to the case study buildings
+        boundaries (DataFrame): boundary inputs, defaults to the case study boundaries
+        parameters: instance of class Parameters
+
+    Returns:
+        DataFrame indexed by heating_renovation (True if the heating measure is applied) and building_id
+    """
+
+    if buildings is None or boundaries is None:
+        buildings, boundaries = load_case_study()
+
+    if parameters is None:
+        parameters = Parameters(co2_energies=co2_energies)
+
+    if not isinstance(climate, PreprocessedClimate):
+        metadata = dict(metadata, building_altitude=buildings.altitude.mean())
+        if 'climate' in parameters.models:
+            climate = run_climate_models_BM(climate, metadata)
+        climate = PreprocessedClimate(climate, metadata, None)
+
+    envelope_measures = [measure for measure in reno_values if measure != HEATING_MEASURE]
+    heating_renovations = [False] + ([True] if reno_values.get(HEATING_MEASURE) is not None else [])
+
+    sensitivities = {}
+    for heating_renovation in heating_renovations:
+        heating_dict = dict.fromkeys(reno_dict)
+        if heating_renovation:
+            heating_dict[HEATING_MEASURE] = reno_values[HEATING_MEASURE]
+
+        heating_buildings, heating_boundaries = buildings.copy(), boundaries.copy()
+        set_heating_set_point(heating_buildings, heating_boundaries, heating_set_point)
+        apply_renovation(heating_buildings, heating_boundaries, heating_dict)
+        simulation = IncrementalSimulation(heating_buildings, heating_boundaries, climate, climate.metadata,
+                                           parameters)
+        simulation.run()
+
+        variables = {}
+        for measure in envelope_measures:
+            variables[measure] = simulation.boundaries.copy()
+            apply_renovation(simulation.buildings.copy(), variables[measure],
+                             dict(dict.fromkeys(reno_dict), **{measure: reno_values[measure]}))
+        sensitivities[heating_renovation] = linear_sensitivity(simulation, variables)
+
+    return pd.concat(sensitivities, names=['heating_renovation'])
+
+
+def evaluate_renovation_packages(sensitivity, packages, output='total_final_consumption'):
+    """Evaluates renovation packages with the linear sensitivity returned by :func:`renovation_sensitivity`
+
+    Args:
+        sensitivity (DataFrame): the result of :func:`renovation_sensitivity`
+        packages (DataFrame): one row per package, one column per renovation measure (1 if applied, 0 otherwise) and
+        optionally a heating_set_point column giving the change of the set point in °C
+        output (str): the output to evaluate
+
+    Returns:
+        tuple of DataFrame (packages x buildings): the outputs and True where the linear model is exact
+    """
+
+    heating_renovations = (packages[HEATING_MEASURE] > 0 if HEATING_MEASURE in packages.columns
+                           else pd.Series(False, index=packages.index))
+    variables = packages.drop(columns=[HEATING_MEASURE], errors='ignore')
+
+    predictions, valid = [], []
+    for heating_renovation in heating_renovations.unique():
+        selection = (heating_renovations == heating_renovation).values
+        results = evaluate_linear_sensitivity(sensitivity.loc[heating_renovation], variables.loc[selection, :],
+                                              output)
+        predictions.append(results[0])
+        valid.append(results[1])
+
+    return pd.concat(predictions).loc[packages.index, :], pd.concat(valid).loc[packages.index, :]
+
+class ScenarioBatch(object):
+    """
+    Runs many combinations of climates, renovation dictionaries and heating set points on the same building inputs
+
+    The inputs are loaded once and each climate is preprocessed once. Each combination of climate and heating set point
+    is an :class:`Simulation.incremental.IncrementalSimulation` on which the renovation scenarios are applied one after
+    the other, only the stages reading the inputs changed by a renovation are rerun. As renovations only change U
+    values and heating systems, the solar gains, degree hours and ventilation losses are calculated once per
+    combination.
+
+    Args:
+        climates (dict): climate name -> tuple of climate DataFrame and metadata dict as returned by load_climate_data,
+        path to an EPW file or PreprocessedClimate
+        reno_dicts (dict): scenario name -> renovation dictionary (see :func:`apply_renovation`)
+        heating_set_points (list of float): the actual heating set points to simulate
+        buildings (DataFrame): building inputs, defaults to the case study buildings
+        boundaries (DataFrame): boundary inputs, defaults to the case study boundaries
+        parameters: instance of class Parameters
+        result_columns (list of str): the building columns kept in the results
+    """
+
+    def __init__(self, climates, reno_dicts, heating_set_points=(18,), buildings=None, boundaries=None,
+                 parameters=None, result_columns=None):
+
+        if buildings is None or boundaries is None:
+            buildings, boundaries = load_case_study()
+
+        if parameters is None:
+            parameters = Parameters(co2_energies=co2_energies)
+
+        if result_columns is None:
+            result_columns = ['total_final_consumption', 'total_primary_consumption', 'total_CO2_emission',
+                              'conventional_primary_consumption_by_surface', 'diagnosis_class']
+
+        check_model_list(parameters.models)
+
+        self.climates = climates
+        self.reno_dicts = reno_dicts
+        self.heating_set_points = heating_set_points
+        self.buildings = buildings
+        self.boundaries = boundaries
+        self.parameters = parameters
+        self.result_columns = result_columns
+
+    def climate_stage(self, climate_name, climate):
+        """Returns the preprocessed climate, leaving the original climate and metadata untouched
+
+        EPW paths go through :func:`Simulation.climate.preprocess_climate` so that they are preprocessed only once
+        per session for the altitude of the buildings.
+        """
+
+        if isinstance(climate, str):
+            climate = preprocess_climate(climate, self.buildings.altitude.mean())
+
+        if isinstance(climate, PreprocessedClimate):
+            return climate
+
+        climate, metadata = climate
+        metadata = dict(metadata, building_altitude=self.buildings.altitude.mean())
+        if 'climate' in self.parameters.models:
+            climate = run_climate_models_BM(climate, metadata)
+
+        return PreprocessedClimate(climate, metadata, (climate_name, metadata['building_altitude']))
+
+    def run(self):
+        """Runs all the scenarios
+
+        Returns:
+            DataFrame with one row per climate, heating set point, renovation scenario and building
+        """
+
+        results = []
+        for climate_name, climate in self.climates.items():
+            climate = self.climate_stage(climate_name, climate)
+            for heating_set_point in self.heating_set_points:
+                buildings, boundaries = self.buildings.copy(), self.boundaries.copy()
+                set_heating_set_point(buildings, boundaries, heating_set_point)
+                simulation = IncrementalSimulation(buildings.copy(), boundaries.copy(), climate, climate.metadata,
+                                                   self.parameters)
+                for scenario_name, reno_dict in self.reno_dicts.items():
+                    scenario_buildings, scenario_boundaries = buildings.copy(), boundaries.copy()
+                    apply_renovation(scenario_buildings, scenario_boundaries, reno_dict)
+                    simulation.update(scenario_buildings, scenario_boundaries)
+                    result = simulation.buildings.loc[:, ['building_id'] + self.result_columns].reset_index(drop=True)
+                    result.insert(0, 'scenario', scenario_name)
+                    result.insert(0, 'heating_set_point', heating_set_point)
+                    result.insert(0, 'climate', climate_name)
+                    results.append(result)
+
+        return pd.concat(results, ignore_index=True)
+
+
 Energy_consumption_kWh = FMES(french_climate, french_metadata, reno_dict,16)
 
 
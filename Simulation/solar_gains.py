@@ -1,10 +1,9 @@
-import gc
 from datetime import datetime
 import numpy as np
-import pandas as pd
 import pvlib
 #import buildingmodel.cython_utils.shading as shading_utils
-from Simulation.utils import heating_season, add_parameter_from_building
+from Simulation.utils import heating_season
+from Simulation.store import unpack
 
 # Integer variables for boundary types
 EXTERIOR_WALL = 0
@@ -12,66 +11,120 @@ INTERIOR_WALL = 1
 ROOF = 2
 FLOOR = 3
 
+# Number of solar exposed boundaries processed together, bounds the size of the (boundaries x time steps) arrays
+BOUNDARY_BLOCK_SIZE = 500
 
-def mask_influence(boundaries, climate):
+
+def visible_beam(masks, sun_height, sun_azimuth):
+    """Determines at which time steps the sun beam reaches each boundary given its solar mask
+
+    The mask column of the sun azimuth sector is compared to the sun height, the mask having
+    int(360 / angular_resolution + 1) columns, the column i covering the azimuths from i * angular_resolution to
+    (i + 1) * angular_resolution (see :func:`Simulation.solar_masks.solar_mask`).
+
+    Args:
+        masks (numpy array): a N x M numpy array of mask heights, where N is the number of boundaries and M the number
+        of mask columns
+        sun_height (numpy array): a time series of sun heights
+        sun_azimuth (numpy array): a time series of sun azimuths (pvlib convention, north = 0, clockwise)
+
+    Returns:
+        a N x T boolean array, where T is the number of time steps of sun position provided
+    """
+
+    sector_count = masks.shape[1] - 1
+    sectors = np.clip((sun_azimuth * sector_count / 360.).astype(np.int64), 0, sector_count - 1)
+
+    return (sun_height > masks[:, sectors]) & (sun_height > 0.)
+
+
+def sky_view_factor(masks):
+    """Calculates the sky view factor of each boundary from its solar mask (Middel, A., Lukasczyk, J., Maciejewski, R.,
+    Demuzere, M., & Roth, M. (2018). Sky View Factor footprints for urban climate modeling. Urban climate, 25, 120-134.)
+
+    Args:
+        masks (numpy array): a N x M numpy array of mask heights, the last column being the copy of the first one
+
+    Returns:
+        numpy array containing the sky view factor of each boundary
+    """
+
+    return 1. - (np.sin(np.radians(masks[:, :-1])) ** 2).mean(axis=1)
+
+
+def mask_influence(solar_boundaries, climate):
     """This function calculates the influence of the solar masks of each boundary on the diffuse and direct normal
     radiation
 
     For the direct radiation, at each time step and for each boundary, the sun height is compared to the
     height of the solar mask for the current sun azimuth. If it is higher, the original direct radiation value
-    is retained. If not, it is set to 0.
+    is retained. If not, it is set to 0. Only the daylight time steps are compared.
 
     For the diffuse radiation, a sky view factor for each boundary is calculated and then applied to the diffuse
     radiation (Middel, A., Lukasczyk, J., Maciejewski, R., Demuzere, M., & Roth, M. (2018).
     Sky View Factor footprints for urban climate modeling. Urban climate, 25, 120-134.)
 
+    Boundaries without mask columns are not shaded.
+
     Args:
-        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries
+        solar_boundaries (GeoDataframe): a block of solar exposed boundaries (exterior walls and roofs)
         climate (Dataframe): a Dataframe containing climate data
 
     Returns:
-        a tuple of numpy arrays containing the horizontal diffuse and normal direct radiation for each boundary
-        and each time step
+        a tuple of numpy arrays (boundaries x time steps) containing the normal direct and horizontal diffuse
+        radiation for each boundary and each time step
     """
 
-    solar_exposed_boundaries = boundaries.loc[boundaries['type'].isin([0, 2]), :]
-    mask_columns = [col_name for col_name in solar_exposed_boundaries.columns if col_name.startswith('mask_')]
+    mask_columns = [col_name for col_name in solar_boundaries.columns if col_name.startswith('mask_')]
+    mask_columns = sorted(mask_columns, key=lambda col_name: int(col_name[len('mask_'):]))
+    direct_normal_radiation = climate['direct_normal_radiation'].values.astype(np.float64)
+    diffuse_horizontal_radiation = climate['diffuse_horizontal_radiation'].values.astype(np.float64)
 
-    masks = solar_exposed_boundaries.loc[solar_exposed_boundaries['type'].isin([0, 2]), mask_columns].values
-    #visible_beam = shading_utils.visible_beam(masks.astype(np.float64),
-                                              #climate['sun_height'].values.astype(np.float64),
-                                              #climate['sun_azimuth'].values.astype(np.float64))
-    visible_beam = 0.8
-    direct_radiation = climate['direct_normal_radiation'].values * visible_beam
+    if len(mask_columns) == 0:
+        boundary_count = solar_boundaries.shape[0]
+        return (np.tile(direct_normal_radiation, (boundary_count, 1)),
+                np.tile(diffuse_horizontal_radiation, (boundary_count, 1)))
 
-    # sky_view = 1 - 1. / masks.shape[1] * ((np.sin(np.radians(masks)) ** 2).sum(axis=1))
-    # diffuse_radiation = climate['diffuse_horizontal_radiation'].values * np.tile(sky_view.reshape((-1, 1)),
-    #                                                                              climate.shape[0])
+    masks = solar_boundaries[mask_columns].values.astype(np.float64)
+    daylight = np.flatnonzero((climate['sun_height'].values > 0.) & (direct_normal_radiation > 0.))
 
-    return direct_radiation
+    direct_radiation = np.zeros((masks.shape[0], climate.shape[0]))
+    direct_radiation[:, daylight] = visible_beam(masks, climate['sun_height'].values[daylight],
+                                                 climate['sun_azimuth'].values[daylight]) * \
+                                    direct_normal_radiation[daylight]
 
+    diffuse_radiation = sky_view_factor(masks).reshape((-1, 1)) * diffuse_horizontal_radiation
 
-def radiation_on_boundary_model(boundaries, direct_radiation, climate):
+    return direct_radiation, diffuse_radiation
+
+
+def radiation_on_boundary_model(solar_boundaries, direct_radiation, diffuse_radiation, climate):
     """Calculation of the angle of incidence and diffuse and direct radiation on each boundary
 
-    Returns:
+    The diffuse radiation on the boundaries is obtained with an isotropic sky model.
 
+    Args:
+        solar_boundaries (GeoDataframe): a block of solar exposed boundaries (exterior walls and roofs)
+        direct_radiation: a numpy array (boundaries x time steps) of the visible direct normal radiation
+        diffuse_radiation: a numpy array (boundaries x time steps) of the visible diffuse horizontal radiation
+        climate (Dataframe): a Dataframe containing climate data for the time steps to calculate
+
+    Returns:
+        a tuple of numpy arrays (boundaries x time steps) containing the direct and diffuse radiation on the
+        boundaries and the angle of incidence
     """
-    solar_exposed_boundaries = boundaries.loc[boundaries['type'].isin([EXTERIOR_WALL, ROOF]), :]
-    boundary_inclinations = get_boundary_inclination(solar_exposed_boundaries)
-    boundary_count = solar_exposed_boundaries.shape[0]
+    boundary_inclinations = get_boundary_inclination(solar_boundaries)
 
-    sun_azimuth = np.tile(climate['sun_azimuth'].values.reshape(-1, 1), boundary_count).transpose()
     zenith = 90. - climate['sun_height'].values
     angle_of_incidence = pvlib.irradiance.aoi(boundary_inclinations.reshape((-1, 1)),
-                                              solar_exposed_boundaries['azimuth'].values.reshape((-1, 1)),
+                                              solar_boundaries['azimuth'].values.reshape((-1, 1)),
                                               zenith,
-                                              sun_azimuth)
+                                              climate['sun_azimuth'].values)
 
     poa_direct = np.maximum(direct_radiation * np.cos(np.radians(angle_of_incidence)), 0.)
-    # poa_diffuse = sky_diffuse + ground_diffuse
+    poa_diffuse = diffuse_radiation * ((1. + np.cos(np.radians(boundary_inclinations))) / 2.).reshape((-1, 1))
 
-    return poa_direct, angle_of_incidence
+    return poa_direct, poa_diffuse, angle_of_incidence
 
 
 def get_boundary_inclination(solar_exposed_boundaries):
@@ -90,80 +143,109 @@ def get_boundary_inclination(solar_exposed_boundaries):
     return boundary_inclinations
 
 
-def transmission_model(boundaries, direct_radiation, angle_of_incidence,
-                       heating_period_mask):
+def transmission_model(solar_boundaries, direct_radiation, diffuse_radiation, angle_of_incidence,
+                       heating_period_masks, set_point_index):
     """Calculates the total solar gains absorbed by the boundaries (opaque and windows) and transmitted (windows)
     during the heating season when the air temperature is below the heating set point
 
+    The transmitted radiation of the boundaries sharing a heating set point is reduced over time with a single matrix
+    product with the heating period mask of this set point.
+
     Args:
-        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries
-        direct_radiation:
-        diffuse_radiation:
-        angle_of_incidence:
-        heating_period_mask: a pd.DataFrame (time steps x solar boundaries) containing a mask (0 or 1 values) defining
-        the steps during the heating season when the air temperature is below the heating set point
+        solar_boundaries (GeoDataframe): a block of solar exposed boundaries (exterior walls and roofs)
+        direct_radiation: a numpy array (boundaries x time steps) of direct radiation on the boundaries
+        diffuse_radiation: a numpy array (boundaries x time steps) of diffuse radiation on the boundaries
+        angle_of_incidence: a numpy array (boundaries x time steps) of angles of incidence
+        heating_period_masks: a boolean numpy array (set points x time steps) defining for each set point the steps
+        during the heating season when the air temperature is below the heating set point
+        set_point_index: a numpy array giving for each boundary its row in heating_period_masks
 
     Returns:
-        GeoDataframe with columns absorbed_solar_gain and transmitted_solar_gain in kWh
+        numpy array containing the transmitted solar gain of each boundary in kWh
     """
 
-    direct_radiation = direct_radiation * heating_period_mask.values.transpose()
-
-    boundaries['transmitted_solar_gain'] = 0.
-    boundaries['window_area'] = boundaries['window_share'] * boundaries['area']
-    boundaries['opaque_area'] = boundaries['area'] - boundaries['window_area']
-
-    solar_boundaries = boundaries.loc[boundaries['type'].isin([EXTERIOR_WALL, ROOF]), :]
-
     window_transmission_factor = solar_boundaries['window_solar_factor'].values.reshape((-1, 1))
     transmission_coefficient = np.clip(((1. - (angle_of_incidence / 90.) ** 5) * window_transmission_factor), 0., 1.)
-    direct_transmission = transmission_coefficient * direct_radiation
-    boundaries.loc[solar_boundaries.index, 'transmitted_solar_gain'] = solar_boundaries['window_area'] * (direct_transmission).sum(axis=1) / 1000.
+    transmitted = transmission_coefficient * direct_radiation + window_transmission_factor * diffuse_radiation
 
+    transmitted_radiation = np.zeros(solar_boundaries.shape[0])
+    for set_point_id, heating_period_mask in enumerate(heating_period_masks):
+        boundary_mask = set_point_index == set_point_id
+        if boundary_mask.any():
+            transmitted_radiation[boundary_mask] = transmitted[boundary_mask] @ heating_period_mask.astype(float)
 
-def heating_periods(climate, boundaries, heating_season_start=datetime(2019, 10, 1),
+    return solar_boundaries['window_area'].values * transmitted_radiation / 1000.
+
+
+def heating_periods(climate, solar_boundaries, heating_season_start=datetime(2019, 10, 1),
                     heating_season_end=datetime(2020, 5, 20)):
     """Calculates the time steps belonging to heating season and for which the air temperature is below the heating set
     point.
 
+    The mask only depends on the heating set point, it is calculated once for each unique set point of the boundaries.
+
     Returns:
-        pandas.DataFrame
+        a tuple containing the unique set points, a boolean numpy array (set points x time steps) of heating period
+        masks and a numpy array giving for each boundary the index of its set point
     """
-    heating_season_index = heating_season(climate, heating_season_start, heating_season_end)
-    solar_boundaries = boundaries.loc[boundaries['type'].isin([EXTERIOR_WALL, ROOF]), :]
-    unique_set_points = solar_boundaries['actual_heating_set_point'].unique()
+    in_heating_season = climate.index.isin(heating_season(climate, heating_season_start, heating_season_end))
+    set_points, set_point_index = np.unique(solar_boundaries['actual_heating_set_point'].values, return_inverse=True)
+    heating_period_masks = in_heating_season & (climate['air_temperature'].values < set_points.reshape((-1, 1)))
+
+    return set_points, heating_period_masks, set_point_index
+
 
-    heating_period_mask = pd.DataFrame(index=climate.index, columns=solar_boundaries.index, data=0.)
+def solar_time_steps(climate):
+    """Returns a boolean numpy array flagging the daylight time steps of the climate
 
-    for set_point in unique_set_points:
-        boundary_indices = solar_boundaries.loc[solar_boundaries['actual_heating_set_point'] == set_point, :].index
-        heating_period_mask.loc[climate['air_temperature'] < set_point, boundary_indices] = 1.
+    The flag is calculated by the climate models (see :func:`Simulation.climate.daylight`), it is only recalculated
+    for climate data that does not contain it.
+    """
 
-    heating_period_mask.loc[~heating_period_mask.index.isin(heating_season_index), :] = 0.
+    if 'daylight' in climate.columns:
+        return climate['daylight'].values.astype(bool)
 
-    return heating_period_mask
+    return ((climate['sun_height'].values > 0.) & ((climate['direct_normal_radiation'].values > 0.) |
+                                                  (climate['diffuse_horizontal_radiation'].values > 0.)))
 
 
-def run_models(buildings, boundaries, climate):
+def run_models(buildings, boundaries, climate, block_size=BOUNDARY_BLOCK_SIZE):
     """
+    Calculates the transmitted solar gain of each boundary. The solar exposed boundaries are processed by blocks of
+    block_size boundaries, on the daylight time steps belonging to at least one heating period only, so that the
+    memory used does not depend on the number of boundaries and that no work is spent on time steps without solar
+    radiation.
 
     Args:
-        buildings:
+        buildings (GeoDataframe or BuildingStore): a GeoDataframe containing the building geometries and parameters,
+        or a store in which case boundaries is ignored
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries
         climate (Dataframe): a Dataframe containing climate data
-        parameters
+        block_size (int): number of boundaries processed together
 
     Returns:
 
     """
 
-    direct_radiation = mask_influence(boundaries, climate)
-    gc.collect()
-
-    direct_radiation, angle_of_incidence = radiation_on_boundary_model(boundaries, direct_radiation, climate)
-    gc.collect()
+    buildings, boundaries = unpack(buildings, boundaries)
+    boundaries['transmitted_solar_gain'] = 0.
+    boundaries['window_area'] = boundaries['window_share'] * boundaries['area']
+    boundaries['opaque_area'] = boundaries['area'] - boundaries['window_area']
 
-    heating_period_mask = heating_periods(climate, boundaries)
-    gc.collect()
-    transmission_model(boundaries, direct_radiation, angle_of_incidence, heating_period_mask)
-    gc.collect()
+    solar_boundaries = boundaries.loc[boundaries['type'].isin([EXTERIOR_WALL, ROOF]), :]
+    set_points, heating_period_masks, set_point_index = heating_periods(climate, solar_boundaries)
+    solar_steps = solar_time_steps(climate) & heating_period_masks.any(axis=0)
+    heating_period_masks = heating_period_masks[:, solar_steps]
+    climate = climate.loc[solar_steps, :]
+
+    transmitted_solar_gain = np.zeros(solar_boundaries.shape[0])
+    for start in range(0, solar_boundaries.shape[0], block_size):
+        block = solar_boundaries.iloc[start:start + block_size]
+        direct_radiation, diffuse_radiation = mask_influence(block, climate)
+        poa_direct, poa_diffuse, angle_of_incidence = radiation_on_boundary_model(block, direct_radiation,
+                                                                                  diffuse_radiation, climate)
+        transmitted_solar_gain[start:start + block_size] = transmission_model(block, poa_direct, poa_diffuse,
+                                                                              angle_of_incidence, heating_period_masks,
+                                                                              set_point_index[start:start + block_size])
+
+    boundaries.loc[solar_boundaries.index, 'transmitted_solar_gain'] = transmitted_solar_gain
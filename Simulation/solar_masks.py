@@ -1,18 +1,71 @@
 import numpy as np
 import pandas as pd
-import shape_optim.buildingmodel.cython_utils.shading as shading_utils
-from shape_optim.buildingmodel.logger import duration_logging
+from scipy.spatial import cKDTree
+from shapely.geometry import Polygon
+from Simulation.buildingmodel.logger import duration_logging
+from Simulation.store import unpack
+
+# Integer variables for boundary types
+EXTERIOR_WALL = 0
+INTERIOR_WALL = 1
+ROOF = 2
+FLOOR = 3
+
+# Number of boundaries whose neighbouring elevation points are processed together, bounds the size of the
+# (boundary, point) pair arrays
+MASK_BLOCK_SIZE = 200
+
+
+def has_footprints(buildings):
+    """Returns True if the geometries of all the buildings are shapely polygons, from which the elevation model is
+    calculated (the case study files give them as WKT strings)"""
+
+    return 'geometry' in buildings.columns and all(isinstance(geometry, Polygon)
+                                                   for geometry in buildings['geometry'].values)
+
+
+def discretize_polygons(polygons, polygon_ends, resolution):
+    """Discretizes the edges of polygons in points spaced by resolution
+
+    Each edge of length L gives int(L / resolution) + 1 points starting at its first vertex, zero length edges give
+    no point. The z coordinate of the points is the z coordinate of the first vertex of their edge.
+
+    Args:
+        polygons (numpy array): a N x 3 array containing the vertices of all the polygons, each polygon being closed
+        polygon_ends (numpy array): the index of the last vertex of each polygon in polygons
+        resolution (float): the distance between two points of an edge
+
+    Returns: a M x 3 numpy array containing the coordinates of the points
+
+    """
+
+    is_edge_start = np.ones(polygons.shape[0], dtype=bool)
+    is_edge_start[polygon_ends] = False
+    edge_starts = np.flatnonzero(is_edge_start)
+
+    start_vertices = polygons[edge_starts, :]
+    directions = polygons[edge_starts + 1, :2] - start_vertices[:, :2]
+    edge_lengths = np.sqrt((directions ** 2).sum(axis=1))
+    point_counts = np.where(edge_lengths == 0., 0, (edge_lengths / resolution).astype(np.int64) + 1)
+    directions = directions / np.where(edge_lengths == 0., 1., edge_lengths).reshape((-1, 1))
+
+    # position of each point along its edge
+    edge_ids = np.repeat(np.arange(edge_starts.shape[0]), point_counts)
+    point_ranks = np.arange(edge_ids.shape[0]) - np.repeat(np.cumsum(point_counts) - point_counts, point_counts)
+
+    points = np.empty((edge_ids.shape[0], 3), dtype=np.float64)
+    points[:, :2] = start_vertices[edge_ids, :2] + directions[edge_ids] * (point_ranks * resolution).reshape((-1, 1))
+    points[:, 2] = start_vertices[edge_ids, 2]
+
+    return points
 
 
 @duration_logging
 def elevation_model(buildings, grid_resolution=1.):
     """Create an elevation model from the gis data representing the buildings
 
-    To minimize the computation burden of mask calculation, we include in the grid only the points that fall in the
-    building footprints.
-    To do so, we iterate over the buildings and create a grid that covers the bounding box of their footprint. Then
-    we select only the points that are contained by the building footprint and assign to their z coordinate the
-    altitude of the building's roof.
+    To minimize the computation burden of mask calculation, we include in the grid only the points that fall on the
+    building footprint outlines, at the altitude of the building's roof.
 
     Args:
         buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
@@ -24,78 +77,121 @@ def elevation_model(buildings, grid_resolution=1.):
     """
 
     coordinate_list = []
-    polygon_ends = []
+    roof_altitudes = (buildings['height'] + buildings['altitude']).values
 
-    for i, idx in enumerate(buildings.index):
-        coordinate_array = np.array(buildings.geometry[idx].exterior.coords)
+    for i, geometry in enumerate(buildings.geometry.values):
+        coordinate_array = np.array(geometry.exterior.coords)[:, :2]
         non_duplicate_ids = np.append(np.where(np.diff(coordinate_array, axis=0).sum(axis=1) != 0.)[0],
                                       coordinate_array.shape[0] - 1)
         coordinate_array = coordinate_array[non_duplicate_ids, :]
-        roof_altitude = buildings.loc[idx, 'height'] + buildings.loc[idx, 'altitude']
-        coordinate_array = np.concatenate([coordinate_array, roof_altitude * np.ones((coordinate_array.shape[0], 1))],
-                                          axis=1)
-        coordinate_list.append(coordinate_array)
+        coordinate_list.append(np.concatenate([coordinate_array,
+                                               roof_altitudes[i] * np.ones((coordinate_array.shape[0], 1))], axis=1))
 
-        if i == 0:
-            polygon_ends.append(coordinate_array.shape[0] - 1)
-        else:
-            polygon_ends.append(coordinate_array.shape[0] + polygon_ends[i - 1])
+    if len(coordinate_list) == 0:
+        return np.zeros((0, 3))
 
     all_coordinates = np.concatenate(coordinate_list).astype(np.float64)
-    polygon_ends = np.array(polygon_ends, dtype=np.int32)
-    points = np.array(shading_utils.discretize_polygons(all_coordinates, polygon_ends, np.float64(grid_resolution)))
-    return points
+    polygon_ends = np.cumsum([coordinates.shape[0] for coordinates in coordinate_list]) - 1
+
+    return discretize_polygons(all_coordinates, polygon_ends, np.float64(grid_resolution))
+
+
+def wall_back_masks(boundary_azimuths, angular_resolution, sector_count):
+    """Returns a boolean array of shape (boundaries x sector_count), True for the azimuth sectors behind each wall
+
+    The azimuths are given with the pvlib convention (north = 0, clockwise), the sector i covering the azimuths from
+    i * angular_resolution to (i + 1) * angular_resolution.
+    """
+
+    starts = (((boundary_azimuths + 90.) % 360.) / angular_resolution).astype(np.int64)
+    sectors = np.arange(sector_count)
+    back_sectors = int(180. / angular_resolution) + 1
+
+    return ((sectors - starts.reshape((-1, 1))) % sector_count) < back_sectors
 
 
 @duration_logging
 def solar_mask(boundaries, elevation_data, angular_resolution=5., bbox_filter=100.):
     """Calculates the solar mask from boundary geometries and elevation data
 
-    For each boundary, the height and azimuth of all the points in the grid are calculated. Then the points are binned
-    in the azimuth intervals for which the mask is calculated, with the maximum angular height for each bin giving the
-    mask value.
+    The elevation points are indexed in a KD-tree on their horizontal coordinates and, for each exterior wall and roof,
+    only the points within bbox_filter meters of its center and higher than it are considered. The angular heights
+    and azimuths (pvlib convention, north = 0, clockwise) of these points are binned in the azimuth sectors for which
+    the mask is calculated, with the maximum angular height for each sector giving the mask value. The sectors behind
+    an exterior wall are set to 90°, interior walls and floors have no mask.
+
+    The mask has int(360 / angular_resolution + 1) columns, mask_i covering the azimuths from i * angular_resolution
+    to (i + 1) * angular_resolution, the last column (360°) being a copy of the first one.
 
     Args:
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries
         elevation_data (numpy array): a N x 3 containing elevation data
         angular_resolution (float): the angular resolution (in degrees) at which the mask will be computed. Defaults to 5.
-        bbox_filter (float):
+        bbox_filter (float): the distance in meters beyond which the elevation points are ignored
 
     Returns: a Dataframe containing the angular height of the mask for each boundary (index) and each azimuth interval (columns)
 
     """
 
-    boundary_centers = np.zeros((boundaries.shape[0], 3))
-    boundary_centers[:, 0], boundary_centers[:, 1], boundary_centers[:, 2] = boundaries.loc[:, 'center_x'], \
-                                                                             boundaries.loc[:, 'center_y'], \
-                                                                             boundaries.loc[:, 'center_z']
+    boundary_centers = boundaries[['center_x', 'center_y', 'center_z']].values.astype(np.float64)
+    boundary_types = boundaries['type'].values
+    # the last mask column is the azimuth 360°, equal to the first one
+    mask_count = int(360. / angular_resolution + 1.)
+    sector_count = mask_count - 1
+    solar_masks = np.zeros((boundaries.shape[0], mask_count), dtype=np.float64)
+
+    walls = boundary_types == EXTERIOR_WALL
+    solar_masks[walls, :sector_count] = np.where(wall_back_masks(boundaries['azimuth'].values[walls].astype(np.float64),
+                                                                 angular_resolution, sector_count), 90., 0.)
+
+    exposed_ids = np.flatnonzero(np.isin(boundary_types, [EXTERIOR_WALL, ROOF]))
+    if elevation_data.shape[0] > 0:
+        tree = cKDTree(elevation_data[:, :2])
+        for start in range(0, exposed_ids.shape[0], MASK_BLOCK_SIZE):
+            block_ids = exposed_ids[start:start + MASK_BLOCK_SIZE]
+            neighbours = tree.query_ball_point(boundary_centers[block_ids, :2], r=bbox_filter)
+            neighbour_counts = np.array([len(points) for points in neighbours])
+            if neighbour_counts.sum() == 0:
+                continue
+
+            pair_boundaries = np.repeat(block_ids, neighbour_counts)
+            pair_points = np.concatenate([points for points in neighbours if len(points) > 0]).astype(np.int64)
+            offsets = elevation_data[pair_points] - boundary_centers[pair_boundaries]
+            above = offsets[:, 2] > 0.
+            pair_boundaries, offsets = pair_boundaries[above], offsets[above]
+
+            azimuths = np.degrees(np.arctan2(offsets[:, 0], offsets[:, 1])) % 360.
+            heights = np.degrees(np.arcsin(offsets[:, 2] / np.sqrt((offsets ** 2).sum(axis=1))))
+            sectors = np.minimum((azimuths / angular_resolution).astype(np.int64), sector_count - 1)
+            np.maximum.at(solar_masks, (pair_boundaries, sectors), heights)
+
+    solar_masks[:, sector_count] = solar_masks[:, 0]
+
+    mask_columns = [f'mask_{i}' for i in range(mask_count)]
+    solar_masks = pd.DataFrame(index=boundaries.index, columns=mask_columns, data=solar_masks)
+    boundaries[mask_columns] = solar_masks
 
-    solar_masks = shading_utils.calculate_shading(boundary_centers.astype(np.float64),
-                                                  elevation_data.astype(np.float64),
-                                                  boundaries.loc[:, 'azimuth'].values.astype(np.float64),
-                                                  angular_resolution,
-                                                  bbox_filter,
-                                                  boundaries.loc[:, 'type'].values.astype(np.int32))
-    mask_columns = [f'mask_{i}' for i in range(solar_masks.shape[1])]
-    boundaries[mask_columns] = pd.DataFrame(index=boundaries.index,
-                                            columns=mask_columns,
-                                            data=solar_masks)
+    return solar_masks
 
 
-def run_models(buildings, boundaries, parameters):
+def run_models(buildings, boundaries, parameters, elevation_data=None):
     """
 
     Args:
-        buildings (GeoDataframe):  a GeoDataframe containing the building geometries and parameters
+        buildings (GeoDataframe or BuildingStore):  a GeoDataframe containing the building geometries and parameters,
+        or a store in which case boundaries is ignored
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries
         parameters: instance of class Parameters
+        elevation_data (numpy array): the elevation model, shared by all the shards of a parallel simulation. Defaults
+        to None in which case it is calculated from buildings
 
     Returns:
 
     """
 
-    elevation_data = elevation_model(buildings, parameters.grid_resolution)
-    solar_masks = solar_mask(boundaries, elevation_data, parameters.angular_resolution, parameters.bbox_filter)
-    boundaries = pd.concat([boundaries, solar_masks], axis=1)
+    buildings, boundaries = unpack(buildings, boundaries)
+    if elevation_data is None:
+        elevation_data = elevation_model(buildings, parameters.grid_resolution)
+    solar_mask(boundaries, elevation_data, parameters.angular_resolution, parameters.bbox_filter)
 
     return boundaries
@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+
+from Simulation.utils import building_boundary_index
+
+ENERGY_DTYPE = pd.CategoricalDtype(['electricity', 'gas', 'oil', 'biomass', 'district_network', 'biogas'])
+USAGE_DTYPE = pd.CategoricalDtype(['residential', 'agriculture', 'annex', 'commercial', 'unknown', 'industrial',
+                                   'religious'])
+RESIDENTIAL_TYPE_DTYPE = pd.CategoricalDtype(['house', 'apartment'])
+
+# Column types of the building inputs. Set points are kept in float64 as they are used to look up degree hours.
+BUILDING_SCHEMA = {
+    'building_id': 'int64',
+    'main_usage': USAGE_DTYPE,
+    'residential_type': RESIDENTIAL_TYPE_DTYPE,
+    'heating_system': 'category',
+    'main_heating_energy': ENERGY_DTYPE,
+    'backup_heating_energy': ENERGY_DTYPE,
+    'dhw_energy': ENERGY_DTYPE,
+    'cooking_energy': ENERGY_DTYPE,
+    'to_sim': 'bool',
+    'residential_only': 'bool',
+    'has_annex': 'bool',
+    'multi_dwelling': 'bool',
+    'conventional_heating_set_point': 'float64',
+    'actual_heating_set_point': 'float64',
+    'dwelling_count': 'float32',
+    'floor_count': 'float32',
+    'height': 'float32',
+    'altitude': 'float32',
+    'construction_year': 'float32',
+    'floor_area': 'float32',
+    'living_area': 'float32',
+    'living_area_share': 'float32',
+    'exterior_wall_area': 'float32',
+    'roof_area': 'float32',
+    'exterior_floor_area': 'float32',
+    'volume': 'float32',
+    'air_change_rate': 'float32',
+    'main_heating_system_efficiency': 'float32',
+    'backup_heating_system_efficiency': 'float32',
+    'backup_heating_share': 'float32',
+    'wall_u_value': 'float32',
+    'roof_u_value': 'float32',
+    'floor_u_value': 'float32',
+    'wall_window_u_value': 'float32',
+    'window_area': 'float32',
+    'heated_area_share': 'float32',
+    'intermittency_factor': 'float32',
+    'conventional_intermittency_factor': 'float32',
+    'regulation_factor': 'float32',
+}
+
+# Column types of the boundary inputs, the coordinates of the boundary centers are kept in float64
+BOUNDARY_SCHEMA = {
+    'building_id': 'int64',
+    'type': 'int8',
+    'conventional_heating_set_point': 'float64',
+    'actual_heating_set_point': 'float64',
+    'center_z': 'float32',
+    'height': 'float32',
+    'altitude': 'float32',
+    'area': 'float32',
+    'azimuth': 'float32',
+    'floor_count': 'float32',
+    'u_value': 'float32',
+    'window_u_value': 'float32',
+    'window_solar_factor': 'float32',
+    'window_share': 'float32',
+}
+
+# Float64 columns starting with these prefixes are stored in float32 when not in the schema (model results)
+FLOAT32_PREFIXES = ('annual_', 'peak_', 'conventional_', 'total_', 'actual_', 'unified_', 'maximal_', 'transmitted_',
+                    'thermal_bridge_', 'adjacency_', 'loss_', 'window_', 'opaque_')
+
+# Solar mask heights are angles between 0 and 90 degrees, float16 keeps them within 0.1 degree
+FLOAT16_PREFIXES = ('mask_',)
+
+
+def compact_frame(frame, schema, result_columns=True):
+    """
+    Converts the columns of a frame to the types given by a schema. The float64 columns missing from the schema are
+    converted to float32 if they start with one of FLOAT32_PREFIXES and to float16 for FLOAT16_PREFIXES.
+
+    Args:
+        frame (DataFrame): the buildings or boundaries, modified in place
+        schema (dict): column name -> type, the columns missing from the frame are ignored
+        result_columns (bool): whether to convert the columns of FLOAT32_PREFIXES, the models write float64 values
+        in them so they are only converted once the models have run
+
+    Returns:
+        DataFrame: the converted frame
+    """
+
+    dtypes = {col: dtype for col, dtype in schema.items() if col in frame.columns}
+    for col in frame.columns:
+        if col not in schema and frame[col].dtype == np.float64:
+            if col.startswith(FLOAT32_PREFIXES):
+                if result_columns:
+                    dtypes[col] = 'float32'
+            elif col.startswith(FLOAT16_PREFIXES):
+                dtypes[col] = 'float16'
+
+    for col, dtype in dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and frame[col].dtype != dtype:
+            # values missing from the categories become NaN
+            frame[col] = pd.Categorical(frame[col].astype(object), dtype=dtype)
+        elif frame[col].dtype != dtype:
+            frame[col] = frame[col].astype(dtype)
+
+    return frame
+
+
+class BuildingStore(object):
+    '''
+    Compact storage of the buildings and boundaries of a simulation, it should take care of the following:
+        - typed columns following BUILDING_SCHEMA and BOUNDARY_SCHEMA (categorical energies, usages and residential
+          types, int8 boundary types, float32 where the precision allows it and float16 solar masks)
+        - boundaries sorted by building, the boundaries of the building at position i being the rows
+          offsets[i]:offsets[i + 1]
+        - per building sums of boundary columns without group-by
+
+    A store can be given instead of the buildings to the run_models function of each Simulation stage, the boundaries
+    argument is then ignored and both frames are modified in place.
+    '''
+
+    def __init__(self, buildings, boundaries):
+        # index columns written by previous csv exports are not needed
+        buildings = buildings.loc[:, ~buildings.columns.str.startswith('Unnamed:')]
+        boundaries = boundaries.loc[:, ~boundaries.columns.str.startswith('Unnamed:')]
+        buildings = compact_frame(buildings.copy(), BUILDING_SCHEMA, result_columns=False)
+        buildings.index = pd.Index(buildings['building_id'].values, name='building_id')
+
+        boundary_rows = building_boundary_index(boundaries, buildings)
+        # boundaries whose building is missing are kept after all the others
+        boundary_rows = np.where(boundary_rows < 0, buildings.shape[0], boundary_rows)
+        order = np.argsort(boundary_rows, kind='stable')
+
+        self.buildings = buildings
+        self.boundaries = compact_frame(boundaries.iloc[order].reset_index(drop=True), BOUNDARY_SCHEMA,
+                                       result_columns=False)
+        self.boundary_rows = boundary_rows[order]
+        self.offsets = np.searchsorted(self.boundary_rows, np.arange(buildings.shape[0] + 1))
+
+    def __len__(self):
+        return self.buildings.shape[0]
+
+    def building_boundaries(self, building_position):
+        """Returns the boundaries of the building at building_position"""
+
+        return self.boundaries.iloc[self.offsets[building_position]:self.offsets[building_position + 1]]
+
+    def building_sums(self, columns, building_ids=None):
+        """
+        Sums boundary columns by building
+
+        Args:
+            columns (list of str): the boundary columns to sum
+            building_ids (numpy array): the ids of the buildings for which the sums are returned, defaults to all the
+            buildings of the store
+
+        Returns:
+            dict of numpy arrays aligned on building_ids, buildings without boundaries getting 0.
+        """
+
+        building_count = self.buildings.shape[0]
+        in_building = self.boundary_rows < building_count
+        rows = self.boundary_rows[in_building]
+        sums = {col: np.bincount(rows, weights=self.boundaries[col].values[in_building], minlength=building_count)
+                for col in columns}
+
+        if building_ids is not None:
+            positions = self.buildings.index.get_indexer(building_ids)
+            sums = {col: np.where(positions >= 0, values[positions], 0.) for col, values in sums.items()}
+
+        return sums
+
+    def compact(self):
+        """Converts the result columns added by the models to their compact types"""
+
+        compact_frame(self.buildings, BUILDING_SCHEMA)
+        compact_frame(self.boundaries, BOUNDARY_SCHEMA)
+
+    def memory_usage(self):
+        """Returns the memory used by the buildings and boundaries in bytes"""
+
+        return {'buildings': self.buildings.memory_usage(deep=True).sum(),
+                'boundaries': self.boundaries.memory_usage(deep=True).sum()}
+
+
+def unpack(buildings, boundaries=None):
+    """
+    Returns the building and boundary frames of a BuildingStore, any other buildings argument is returned unchanged
+    with the boundaries
+
+    Args:
+        buildings (DataFrame or BuildingStore): the buildings or a store
+        boundaries (DataFrame): the boundaries, ignored if buildings is a store
+
+    Returns:
+        tuple of DataFrame
+    """
+
+    if isinstance(buildings, BuildingStore):
+        return buildings.buildings, buildings.boundaries
+
+    return buildings, boundaries
@@ -0,0 +1,158 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Simulation.main import run_models_quick, check_model_list
+from Simulation.store import BuildingStore
+
+DEFAULT_RESULT_COLUMNS = ['building_id', 'annual_heating_needs', 'conventional_heating_needs',
+                          'total_final_consumption', 'total_primary_consumption', 'total_CO2_emission',
+                          'conventional_primary_consumption_by_surface', 'diagnosis_class']
+
+
+def read_chunks(file_path, chunk_size):
+    """
+    Reads a csv (separated by ';' like the case study files) or parquet file by chunks of rows
+
+    Args:
+        file_path (str): path to the file, parquet files are recognized by their .parquet or .pq extension
+        chunk_size (int): maximal number of rows of a chunk
+
+    Returns:
+        generator of DataFrame
+    """
+
+    if os.path.splitext(file_path)[1] in ['.parquet', '.pq']:
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(file_path, sep=';', chunksize=chunk_size):
+            yield chunk
+
+
+def read_partitions(building_file, boundary_file, partition_size=10000):
+    """
+    Reads the buildings and their boundaries by partitions of partition_size buildings
+
+    Both files are read together in a single pass, they must be sorted by building_id so that the boundaries of a
+    partition are read right after those of the previous one. Only one partition and one chunk of boundaries are
+    kept in memory.
+
+    Args:
+        building_file (str): path to the building csv or parquet file, sorted by building_id
+        boundary_file (str): path to the boundary csv or parquet file, sorted by building_id
+        partition_size (int): number of buildings of a partition
+
+    Returns:
+        generator of tuples of DataFrame, containing the buildings (indexed by building_id) and their boundaries
+    """
+
+    boundary_chunks = read_chunks(boundary_file, partition_size * 10)
+    pending = pd.DataFrame()
+    boundaries_exhausted = False
+    previous_id = None
+
+    for buildings in read_chunks(building_file, partition_size):
+        building_ids = buildings['building_id'].values
+        if (building_ids[1:] < building_ids[:-1]).any() or (previous_id is not None and building_ids[0] <= previous_id):
+            raise ValueError(f'{building_file} is not sorted by building_id')
+        previous_id = building_ids[-1]
+
+        while not boundaries_exhausted and (pending.shape[0] == 0 or pending['building_id'].iloc[-1] <= previous_id):
+            chunk = next(boundary_chunks, None)
+            if chunk is None:
+                boundaries_exhausted = True
+            else:
+                pending = pd.concat([pending, chunk], ignore_index=True)
+
+        if pending.shape[0] == 0:
+            buildings.set_index('building_id', inplace=True, drop=False)
+            yield buildings, pending
+            continue
+
+        in_partition = (pending['building_id'] <= previous_id).values
+        boundaries = pending.loc[in_partition & pending['building_id'].isin(building_ids).values].reset_index(drop=True)
+        pending = pending.loc[~in_partition].reset_index(drop=True)
+
+        buildings.set_index('building_id', inplace=True, drop=False)
+        yield buildings, boundaries
+
+
+class ResultWriter(object):
+    '''
+    Appends the results of the partitions to a csv or parquet file, it should take care of the following:
+        - the file is created by the first partition, an existing file is replaced
+        - with parquet, each partition is written as a row group
+        - categorical results (diagnosis classes) are written as strings
+    '''
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.parquet = os.path.splitext(output_path)[1] in ['.parquet', '.pq']
+        self.writer = None
+        self.row_count = 0
+
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    def write(self, results):
+        results = results.reset_index(drop=True)
+        for col in results.columns[results.dtypes == 'category']:
+            results[col] = results[col].astype(str).where(results[col].notna(), None)
+
+        if self.parquet:
+            table = pa.Table.from_pandas(results, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.output_path, table.schema)
+            self.writer.write_table(table.cast(self.writer.schema))
+        else:
+            results.to_csv(self.output_path, sep=';', index=False, mode='a', header=self.row_count == 0)
+
+        self.row_count += results.shape[0]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def simulate_partitions(building_file, boundary_file, climate, parameters, output_path, partition_size=10000,
+                        result_columns=None):
+    """
+    Simulates a building stock that does not fit in memory, partition by partition
+
+    The buildings and boundaries are read by partitions of partition_size buildings (see :func:`read_partitions`),
+    each partition is stored in a :class:`Simulation.store.BuildingStore`, simulated against the same preprocessed
+    climate and its results are appended to output_path before the next partition is read.
+
+    Args:
+        building_file (str): path to the building csv or parquet file, sorted by building_id
+        boundary_file (str): path to the boundary csv or parquet file, sorted by building_id
+        climate (PreprocessedClimate): the climate returned by :func:`Simulation.climate.preprocess_climate`
+        parameters: instance of class Parameters
+        output_path (str): path to the csv or parquet result file
+        partition_size (int): number of buildings simulated together
+        result_columns (list of str): the building columns written to the results, defaults to
+        DEFAULT_RESULT_COLUMNS
+
+    Returns:
+        int: the number of buildings simulated
+    """
+
+    check_model_list(parameters.models)
+
+    if result_columns is None:
+        result_columns = DEFAULT_RESULT_COLUMNS
+
+    writer = ResultWriter(output_path)
+    try:
+        for buildings, boundaries in read_partitions(building_file, boundary_file, partition_size):
+            buildings = run_models_quick(BuildingStore(buildings, boundaries), None, climate, climate.metadata,
+                                         parameters)
+            writer.write(buildings.loc[:, result_columns])
+    finally:
+        writer.close()
+
+    return writer.row_count
@@ -1,6 +1,8 @@
 import datetime
 import numpy as np
+import pandas as pd
 from Simulation.utils import heating_season, CP_AIR, RHO_AIR
+from Simulation.store import unpack
 import geopandas as gpd
 
 # Integer variables for boundary types
@@ -9,52 +11,96 @@ INTERIOR_WALL = 1
 ROOF = 2
 FLOOR = 3
 
+# Heating set points for which the degree hour table of a climate is precomputed, in °C
+DEGREE_HOUR_SET_POINTS = np.round(np.arange(14., 24.05, 0.1), 1)
+
+
+def degree_hour_table(climate, set_points=DEGREE_HOUR_SET_POINTS, heating_season_start=datetime.datetime(2019, 10, 1),
+                      heating_season_end=datetime.datetime(2020, 5, 20)):
+    """
+    Calculates the unified degree hours of the air and ground temperatures and the heating season duration for a range
+    of heating set points
+
+    Args:
+        climate (Dataframe): a Dataframe containing climate data
+        set_points (numpy array): the heating set points
+        heating_season_start (datetime.time): start of the heating season
+        heating_season_end (datetime.time): end of the heating season
+
+    Returns:
+        Dataframe indexed by set point with columns air_unified_degree_hours, ground_unified_degree_hours and
+        heating_season_duration
+    """
+    heating_season_index = heating_season(climate, heating_season_start, heating_season_end)
+    air_temperature = climate.loc[heating_season_index, 'air_temperature'].values
+    ground_temperature = climate.loc[heating_season_index, 'ground_temperature'].values
+    set_points = np.asarray(set_points, dtype=float)
+    column_set_points = set_points.reshape((-1, 1))
+
+    return pd.DataFrame(index=pd.Index(set_points, name='set_point'), data={
+        'air_unified_degree_hours': np.where(air_temperature < column_set_points,
+                                             column_set_points - air_temperature, 0.).sum(axis=1),
+        'ground_unified_degree_hours': np.where(ground_temperature < column_set_points,
+                                                column_set_points - ground_temperature, 0.).sum(axis=1),
+        'heating_season_duration': (air_temperature < column_set_points).sum(axis=1),
+    })
+
+
 def unified_degree_hours(buildings, boundaries, climate, heating_season_start=datetime.datetime(2019, 10, 1),
-                         heating_season_end=datetime.datetime(2020, 5, 20)):
+                         heating_season_end=datetime.datetime(2020, 5, 20), degree_hours=None):
     """
     Calculates the unified degree hours for each boundary and building. Unified degree hours are obtained by taking
     the sum of the difference between the heating set point and the exterior temperature for each hour of the heating
     season during which the exterior temperature is below the heating set point. For walls, roofs and buildings,
     the exterior temperature is the air temperature. For floors, it is the ground temperature.
 
+    The values are looked up by set point in a degree hour table (see :func:`degree_hour_table`), the set points
+    missing from the table are calculated from the climate data.
+
     Args:
         buildings (GeoDataframe): a GeoDataframe containing the building geometries
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries
         climate (Dataframe): a Dataframe containing climate data
         heating_season_start (datetime.time): start of the heating season
         heating_season_end (datetime.time): end of the heating season
+        degree_hours (Dataframe): a degree hour table of the climate calculated for the same heating season. Defaults
+        to None in which case only the set points used are calculated
 
     Returns:
 
     """
-    # we select the temperatures during the heating season
-    heating_season_index = heating_season(climate, heating_season_start, heating_season_end)
-    air_temperature = climate.loc[heating_season_index, 'air_temperature']
-    ground_temperature = climate.loc[heating_season_index, 'ground_temperature']
+    set_point_variables = ['conventional_heating_set_point', 'actual_heating_set_point']
+    set_points = np.unique(np.concatenate([boundaries[set_point_variables].values.ravel(),
+                                           buildings[set_point_variables].values.ravel()]))
+    if degree_hours is None:
+        degree_hours = degree_hour_table(climate, set_points, heating_season_start, heating_season_end)
+    else:
+        missing_set_points = set_points[~np.isin(set_points, degree_hours.index)]
+        if missing_set_points.shape[0] > 0:
+            degree_hours = pd.concat([degree_hours, degree_hour_table(climate, missing_set_points,
+                                                                      heating_season_start, heating_season_end)])
+
+    air_boundaries = boundaries['type'].isin([EXTERIOR_WALL, ROOF])
+    ground_boundaries = boundaries['type'].isin([FLOOR])
+    boundaries['unified_degree_hours'] = 0.
 
-    # Calculation is done for unique values of the heating set points and then applied to the corresponding boundaries
-    # and buildings
     for mode in ['conventional', 'actual']:
         set_point_variable = f'{mode}_heating_set_point'
         udh_variable = f'{mode}_unified_degree_hours'
-        unique_set_points = boundaries[set_point_variable].unique()
-        boundaries['unified_degree_hours'] = 0.
 
-        for set_point in unique_set_points:
-            # unified degree hours for walls, roofs and buildings
-            air_unified_degree_hour = (set_point - air_temperature[air_temperature < set_point]).sum()
-            boundaries.loc[(boundaries['type'].isin([0, 2])) & (boundaries[set_point_variable] == set_point),
-                           udh_variable] = air_unified_degree_hour
-            buildings.loc[buildings[set_point_variable] == set_point, udh_variable] = air_unified_degree_hour
+        # unified degree hours for walls, roofs and buildings
+        boundaries.loc[air_boundaries, udh_variable] = degree_hours['air_unified_degree_hours'].reindex(
+            boundaries.loc[air_boundaries, set_point_variable].values).values
+        buildings[udh_variable] = degree_hours['air_unified_degree_hours'].reindex(
+            buildings[set_point_variable].values).values
 
-            # unified degree hours for floors
-            ground_unified_degree_hour = (set_point - ground_temperature[ground_temperature < set_point]).sum()
-            boundaries.loc[(boundaries['type'].isin([3])) & (boundaries[set_point_variable] == set_point),
-                           udh_variable] = ground_unified_degree_hour
+        # unified degree hours for floors
+        boundaries.loc[ground_boundaries, udh_variable] = degree_hours['ground_unified_degree_hours'].reindex(
+            boundaries.loc[ground_boundaries, set_point_variable].values).values
 
-            # heating season duration in hours
-            heating_season_duration = (air_temperature < set_point).sum()
-            buildings.loc[buildings[set_point_variable] == set_point, 'heating_season_duration'] = heating_season_duration
+    # heating season duration in hours
+    buildings['heating_season_duration'] = degree_hours['heating_season_duration'].reindex(
+        buildings['actual_heating_set_point'].values).values
 
 
 def maximal_temperature_difference(buildings, boundaries, climate):
@@ -180,20 +226,22 @@ def ventilation_losses(buildings):
                                             buildings['air_change_rate'] * CP_AIR * RHO_AIR) / 3600.
 
 
-def run_models(buildings, boundaries, climate):
+def run_models(buildings, boundaries, climate, degree_hours=None):
     """
     run the models to calculate the thermal losses of a building (ventilation and boundaries)
 
     Args:
-        buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
+        buildings (GeoDataframe or BuildingStore): a GeoDataframe containing the building geometries and parameters,
+        or a store in which case boundaries is ignored
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
         climate (Dataframe): a Dataframe containing climate data
-        parameters
+        degree_hours (Dataframe): the degree hour table of the climate, see :func:`degree_hour_table`
 
     Returns:
 
     """
-    unified_degree_hours(buildings, boundaries, climate)
+    buildings, boundaries = unpack(buildings, boundaries)
+    unified_degree_hours(buildings, boundaries, climate, degree_hours=degree_hours)
     maximal_temperature_difference(buildings, boundaries, climate)
     #thermal_bridge_losses(boundaries)
     boundaries['thermal_bridge_loss_factor'] = 0.
@@ -2,6 +2,12 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 
+from Simulation.store import BuildingStore, unpack
+
+# Boundary columns summed by building to calculate the thermal needs
+BOUNDARY_SUM_COLUMNS = ['annual_thermal_losses', 'conventional_thermal_losses', 'peak_thermal_losses',
+                        'transmitted_solar_gain']
+
 
 def calculate_heated_area_share(buildings):
     """
@@ -56,14 +62,20 @@ def calculate_conventional_intermittency(buildings, dwellings):
     buildings.loc[(buildings.residential_type == 'house'), 'conventional_intermittency_factor'] = 0.95
 
 
-def calculate_thermal_needs(buildings, boundaries, parameters):
+def calculate_thermal_needs(buildings, boundaries, parameters, store=None):
     """
     Calculates the annual and peak thermal needs by combining the boundary losses, ventilation losses, solar gains,
     occupant internal gains and intermittency factor
 
+    Boundary losses and solar gains are aggregated once by building with a group-by on building_id, the needs of all
+    simulated buildings are then obtained with whole-column operations.
+
     Args:
         buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
+        parameters: instance of class Parameters
+        store (BuildingStore): the store containing buildings and boundaries, its precomputed boundary rows are then
+        used to aggregate the boundaries
 
     Returns:
 
@@ -76,50 +88,43 @@ def calculate_thermal_needs(buildings, boundaries, parameters):
     gain_share = parameters.maximal_occupant_gain_share
     solar_share = parameters.maximal_solar_gain_share
 
-    for b_index in buildings.loc[buildings.to_sim].building_id:
-        current_boundaries = boundaries.loc[boundaries['building_id'] == b_index, :]
-        #current_dwellings = dwellings.loc[dwellings['building_id'] == b_index, :]
-        heating_season_ration = buildings.loc[b_index, 'heating_season_duration'] / 8760.
-
-        # Actual thermal losses take into account intermittency and actual occupant gains
-        buildings.loc[b_index, 'annual_thermal_losses'] = (current_boundaries['annual_thermal_losses'].sum() +
-                                                           buildings.loc[b_index, 'annual_ventilation_losses'])
-        #buildings.loc[b_index, 'annual_occupant_gains'] = (current_dwellings['occupant_gains'].sum() *heating_season_ration)
-        buildings.loc[b_index, 'annual_occupant_gains'] = np.clip(buildings.loc[b_index, 'annual_occupant_gains'],
-                                                         0.,
-                                                         gain_share * buildings.loc[b_index, 'annual_thermal_losses'])
-        buildings.loc[b_index, 'annual_solar_gains'] = current_boundaries['transmitted_solar_gain'].sum()
-        buildings.loc[b_index,
-                      'annual_solar_gains'] = np.clip(buildings.loc[b_index, 'annual_solar_gains'],
-                                                      0.,
-                                                      solar_share * buildings.loc[b_index, 'annual_thermal_losses'])
-
-        buildings.loc[b_index, 'annual_heating_needs'] = (buildings.loc[b_index, 'annual_thermal_losses'] -
-                                                          buildings.loc[b_index, 'annual_solar_gains'])
-        buildings.loc[b_index, 'annual_heating_needs'] *= buildings.loc[b_index, 'heated_area_share']
-        buildings.loc[b_index, 'annual_heating_needs'] *= buildings.loc[b_index, 'intermittency_factor']
-        buildings.loc[b_index, 'annual_heating_needs'] -= buildings.loc[b_index, 'annual_occupant_gains']
-        buildings.loc[b_index, 'annual_heating_needs'] *= buildings.loc[b_index, 'regulation_factor']
-
-        buildings.loc[b_index, 'peak_heating_needs'] = (current_boundaries['peak_thermal_losses'].sum() +
-                                                        buildings.loc[b_index, 'peak_ventilation_losses'])
-
-        # Conventional thermal losses do not take into account intermittency and actual occupant gains
-        buildings.loc[b_index,
-                      'conventional_thermal_losses'] = (current_boundaries['conventional_thermal_losses'].sum() +
-                                                        buildings.loc[b_index, 'conventional_ventilation_losses'])
-        #buildings.loc[b_index,'conventional_occupant_gains'] = (current_dwellings['conventional_occupant_gains'].sum() *heating_season_ration)
-        buildings.loc[b_index,
-                      'conventional_occupant_gains'] = np.clip(buildings.loc[b_index, 'conventional_occupant_gains'],
-                                                               0.,
-                                                               gain_share * buildings.loc[b_index,
-                                                                                          'conventional_thermal_losses'])
-
-        buildings.loc[b_index, 'conventional_heating_needs']     = (buildings.loc[b_index, 'conventional_thermal_losses'] - buildings.loc[b_index, 'annual_solar_gains'])
-        buildings.loc[b_index, 'conventional_heating_needs']    *= buildings.loc[b_index, 'heated_area_share']
-        buildings.loc[b_index, 'conventional_heating_needs']    *= buildings.loc[b_index, 'conventional_intermittency_factor']
-        buildings.loc[b_index, 'conventional_heating_needs']    -= buildings.loc[b_index, 'conventional_occupant_gains']
-        buildings.loc[b_index, 'conventional_heating_needs']    *= buildings.loc[b_index, 'regulation_factor']
+    b_index = buildings.loc[buildings.to_sim, 'building_id'].values
+    if store is None:
+        boundary_sums = aggregate_boundaries(boundaries, b_index)
+    else:
+        boundary_sums = store.building_sums(BOUNDARY_SUM_COLUMNS, b_index)
+    current_buildings = buildings.loc[b_index, :]
+
+    # Actual thermal losses take into account intermittency and actual occupant gains
+    annual_thermal_losses = (boundary_sums['annual_thermal_losses'] +
+                             current_buildings['annual_ventilation_losses'].values)
+    annual_solar_gains = np.clip(boundary_sums['transmitted_solar_gain'], 0., solar_share * annual_thermal_losses)
+
+    heated_area_share = current_buildings['heated_area_share'].values
+    regulation_factor = current_buildings['regulation_factor'].values
+    annual_heating_needs, annual_occupant_gains = heating_needs(
+        annual_thermal_losses, annual_solar_gains, current_buildings['annual_occupant_gains'].values,
+        heated_area_share, current_buildings['intermittency_factor'].values, regulation_factor, gain_share)
+
+    peak_heating_needs = (boundary_sums['peak_thermal_losses'] +
+                          current_buildings['peak_ventilation_losses'].values)
+
+    # Conventional thermal losses do not take into account intermittency and actual occupant gains
+    conventional_thermal_losses = (boundary_sums['conventional_thermal_losses'] +
+                                   current_buildings['conventional_ventilation_losses'].values)
+    conventional_heating_needs, conventional_occupant_gains = heating_needs(
+        conventional_thermal_losses, annual_solar_gains, current_buildings['conventional_occupant_gains'].values,
+        heated_area_share, current_buildings['conventional_intermittency_factor'].values, regulation_factor,
+        gain_share)
+
+    buildings.loc[b_index, 'annual_thermal_losses'] = annual_thermal_losses
+    buildings.loc[b_index, 'annual_occupant_gains'] = annual_occupant_gains
+    buildings.loc[b_index, 'annual_solar_gains'] = annual_solar_gains
+    buildings.loc[b_index, 'annual_heating_needs'] = annual_heating_needs
+    buildings.loc[b_index, 'peak_heating_needs'] = peak_heating_needs
+    buildings.loc[b_index, 'conventional_thermal_losses'] = conventional_thermal_losses
+    buildings.loc[b_index, 'conventional_occupant_gains'] = conventional_occupant_gains
+    buildings.loc[b_index, 'conventional_heating_needs'] = conventional_heating_needs
 
     buildings.loc[(buildings.intermittency_factor == 0.), 'peak_heating_needs'] = 0.
 
@@ -127,6 +132,53 @@ def calculate_thermal_needs(buildings, boundaries, parameters):
     #buildings.loc[buildings['conventional_heating_needs'] < 0., 'conventional_heating_needs'] = 0.
 
 
+def heating_needs(thermal_losses, solar_gains, occupant_gains, heated_area_share, intermittency_factor,
+                  regulation_factor, gain_share):
+    """
+    Calculates the heating needs from the thermal losses and gains, the occupant gains being clipped to gain_share of
+    the thermal losses. The arrays have the shape (buildings) or (buildings x samples), the arrays of shape
+    (buildings) being broadcast over the samples.
+
+    Args:
+        thermal_losses (ndarray): boundary and ventilation losses
+        solar_gains (ndarray): solar gains, already clipped
+        occupant_gains (ndarray): occupant gains
+        heated_area_share (ndarray): heated area share of the buildings
+        intermittency_factor (ndarray): intermittency factor of the buildings
+        regulation_factor (ndarray): regulation factor of the buildings
+        gain_share (float): maximal share of the thermal losses covered by occupant gains
+
+    Returns:
+        tuple of ndarray: the heating needs and the clipped occupant gains
+    """
+
+    sample_shape = (-1,) + (1,) * (np.ndim(thermal_losses) - 1)
+    solar_gains, occupant_gains, heated_area_share, intermittency_factor, regulation_factor = [
+        np.reshape(values, sample_shape) if np.ndim(values) == 1 else values
+        for values in [solar_gains, occupant_gains, heated_area_share, intermittency_factor, regulation_factor]]
+    occupant_gains = np.clip(occupant_gains, 0., gain_share * thermal_losses)
+
+    return (((thermal_losses - solar_gains) * heated_area_share * intermittency_factor - occupant_gains) *
+            regulation_factor), occupant_gains
+
+
+def aggregate_boundaries(boundaries, building_ids):
+    """
+    Sums the boundary losses and solar gains of each building in a single group-by on building_id
+
+    Args:
+        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
+        building_ids (numpy array): the ids of the buildings for which the sums are returned
+
+    Returns:
+        dict of numpy arrays aligned on building_ids, buildings without boundaries getting 0.
+    """
+
+    boundary_sums = boundaries.groupby('building_id')[BOUNDARY_SUM_COLUMNS].sum().reindex(building_ids, fill_value=0.)
+
+    return {col: boundary_sums[col].values for col in BOUNDARY_SUM_COLUMNS}
+
+
 def aggregate_intermittency(buildings, dwellings):
 
     mean_intermittency_factor = dwellings.groupby('building_id')['intermittency_factor'].mean()
@@ -162,14 +214,17 @@ def run_models(buildings, boundaries, parameters):
     """
 
     Args:
-        buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
+        buildings (GeoDataframe or BuildingStore): a GeoDataframe containing the building geometries and parameters,
+        or a store in which case boundaries is ignored
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
 
     Returns:
 
     """
+    store = buildings if isinstance(buildings, BuildingStore) else None
+    buildings, boundaries = unpack(buildings, boundaries)
     #calculate_conventional_intermittency(buildings, dwellings)
     #aggregate_intermittency(buildings, dwellings)
     #calculate_regulation_factor(buildings)
     #calculate_heated_area_share(buildings)
-    calculate_thermal_needs(buildings, boundaries, parameters)
+    calculate_thermal_needs(buildings, boundaries, parameters, store)
@@ -1,6 +1,7 @@
 import datetime
 from scipy.stats import beta
 import numpy as np
+import pandas as pd
 
 CP_AIR = 1004.  # Heat capacity of air in J/kg/K
 RHO_AIR = 1.2  # Density of air at 20 °C in kg/m3
@@ -38,14 +39,33 @@ def heating_season(climate, heating_season_start=datetime.datetime(2019, 10, 1),
     return first_period.union(second_period)
 
 
+def building_boundary_index(boundaries, buildings):
+    """
+    Returns for each boundary the position of its building in buildings, -1 for the boundaries whose building is
+    missing. It can be computed once and reused by all the joins of boundary and building parameters.
+
+    Args:
+        boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
+        buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters, with unique
+        building_id values
+
+    Returns:
+        numpy array of int
+    """
+
+    return pd.Index(buildings['building_id']).get_indexer(boundaries['building_id'])
+
+
 def add_parameter_from_building(boundaries, buildings, boundary_parameter_name, building_parameter_name, boundary_types=None):
     """
+    Sets a building parameter on the boundaries of each building with a single join on building_id, the boundaries
+    whose building is missing keep their value
 
     Args:
         boundaries (GeoDataframe): a GeoDataframe containing the boundary geometries and parameters
         buildings (GeoDataframe): a GeoDataframe containing the building geometries and parameters
-        boundary_parameter_name (str): the name of the parameter to retrieve in buildings
-        building_parameter_name (str): the name of the parameter to set in boundaries
+        boundary_parameter_name (str): the name of the parameter to set in boundaries
+        building_parameter_name (str): the name of the parameter to retrieve in buildings
         boundary_types (list of ints): the list of types of the boundaries on which to apply the parameter. Defaults to
         None in which case it is applied to all types
 
@@ -59,20 +79,21 @@ def add_parameter_from_building(boundaries, buildings, boundary_parameter_name,
     if boundary_types is None:
         boundary_types = range(4)
 
-    for building_index in buildings.index:
-        current_boundaries = boundaries.loc[boundaries['building_id'] == buildings.loc[building_index, 'building_id'], :]
-        for boundary_type in boundary_types:
-            type_boundaries = current_boundaries.loc[current_boundaries['type'] == boundary_type, :]
-            boundaries.loc[type_boundaries.index, boundary_parameter_name] = buildings.loc[building_index,
-                                                                                           building_parameter_name]
+    building_rows = building_boundary_index(boundaries, buildings)
+    boundary_mask = (building_rows >= 0) & boundaries['type'].isin(boundary_types).values
+    boundaries.loc[boundary_mask, boundary_parameter_name] = \
+        buildings[building_parameter_name].values[building_rows[boundary_mask]]
+
+    return boundaries
 
 
-def get_beta_distribution(dist_dict, count):
+def get_beta_distribution(dist_dict, count, random_state=None):
     """
 
     Args:
         dist_dict:
         count:
+        random_state (numpy Generator): the generator of the draws, defaults to the global numpy generator
 
     Returns:
 
@@ -80,6 +101,7 @@ def get_beta_distribution(dist_dict, count):
     # np.random.seed()
     beta_distribution = beta.rvs(dist_dict['alpha'],
                                  dist_dict['beta'],
-                                 size=count)
+                                 size=count,
+                                 random_state=random_state)
 
     return dist_dict['min'] + beta_distribution * (dist_dict['max'] - dist_dict['min'])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from Simulation import sim_BM
+from Simulation.benchmarks import synthetic_stock
+from Simulation.climate import preprocess_climate
+from Simulation.main import Parameters
+
+# Number of buildings of the synthetic stocks used by the tests
+STOCK_SIZE = 40
+
+
+def varied_stock(building_count=STOCK_SIZE, seed=1):
+    """Returns a synthetic stock whose buildings have different heating set points and boundary orientations"""
+
+    buildings, boundaries = synthetic_stock(building_count, seed=seed)
+    rng = np.random.default_rng(seed)
+    buildings['actual_heating_set_point'] = rng.choice([17.5, 19., 20., 21.3], buildings.shape[0])
+    boundaries['actual_heating_set_point'] = buildings.loc[boundaries['building_id'],
+                                                           'actual_heating_set_point'].values
+    boundaries['azimuth'] = rng.uniform(0., 360., boundaries.shape[0])
+
+    return buildings, boundaries
+
+
+@pytest.fixture(scope='session')
+def preprocessed_climate():
+    return preprocess_climate(sim_BM.french_climate_data, 164.4)
+
+
+@pytest.fixture
+def climate(preprocessed_climate):
+    return preprocessed_climate.to_frame()
+
+
+@pytest.fixture
+def parameters():
+    return Parameters(co2_energies=sim_BM.co2_energies, n_cpu=1)
+
+
+@pytest.fixture(params=['case_study', 'synthetic_stock'])
+def stock(request):
+    """The buildings and boundaries of the case study and of a synthetic stock"""
+
+    if request.param == 'case_study':
+        return sim_BM.load_case_study()
+
+    return varied_stock()
@@ -0,0 +1,68 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from Simulation import sim_BM
+from Simulation.climate import (load_climate_data, run_models_BM, preprocess_climate, clear_climate_cache,
+                                PreprocessedClimate)
+
+
+@pytest.fixture
+def epw_path(tmp_path):
+    """A copy of the french EPW file that the tests can modify"""
+
+    path = str(tmp_path / 'climate.epw')
+    shutil.copy(sim_BM.french_climate_data, path)
+    yield path
+    clear_climate_cache()
+
+
+def test_preprocess_climate(epw_path):
+    climate = preprocess_climate(epw_path, 164.4)
+
+    data, metadata = load_climate_data(epw_path)
+    expected = run_models_BM(data, dict(metadata, building_altitude=164.4))
+    assert isinstance(climate, PreprocessedClimate)
+    pd.testing.assert_frame_equal(climate.to_frame(), expected)
+    assert climate.metadata['building_altitude'] == 164.4
+
+    # the frames given to the models are copies
+    climate.to_frame()['air_temperature'] = 0.
+    pd.testing.assert_frame_equal(climate.to_frame(), expected)
+
+
+def test_memory_cache(epw_path):
+    climate = preprocess_climate(epw_path, 164.4)
+
+    assert preprocess_climate(epw_path, 164.4) is climate
+    assert preprocess_climate(epw_path, 200.) is not climate
+
+    # a modified EPW file is preprocessed again
+    modification_time = os.path.getmtime(epw_path) + 10.
+    os.utime(epw_path, (modification_time, modification_time))
+    assert preprocess_climate(epw_path, 164.4) is not climate
+
+
+def test_disk_cache(epw_path, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    climate = preprocess_climate(epw_path, 164.4, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+    clear_climate_cache()
+    reloaded = preprocess_climate(epw_path, 164.4, cache_dir=cache_dir)
+
+    assert reloaded is not climate
+    # parquet gives back the time zone of the index as a datetime.timezone
+    assert (reloaded.to_frame().index == climate.to_frame().index).all()
+    pd.testing.assert_frame_equal(reloaded.to_frame().reset_index(drop=True),
+                                  climate.to_frame().reset_index(drop=True))
+    assert reloaded.metadata == climate.metadata
+
+    # a modified EPW file is not read from the stored climates
+    modification_time = os.path.getmtime(epw_path) + 10.
+    os.utime(epw_path, (modification_time, modification_time))
+    clear_climate_cache()
+    preprocess_climate(epw_path, 164.4, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 4
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from Simulation.energy_consumption import energy_allocation, run_models, energy_list, dhw_efficiencies, END_USES
+
+NEED_COLUMNS = ['annual_heating_needs', 'peak_heating_needs', 'conventional_heating_needs', 'annual_dhw_needs',
+                'peak_dhw_needs', 'conventional_dhw_needs', 'annual_specific_needs', 'peak_specific_needs',
+                'annual_cooking_needs']
+
+
+def reference_allocation(buildings, heating_needs, dhw_needs, specific_needs, cooking_needs):
+    """Allocates the needs building by building"""
+
+    allocation = np.zeros((buildings.shape[0], len(energy_list), len(END_USES)))
+
+    def add(row, energy, end_use, consumption):
+        if energy in energy_list:
+            allocation[row, energy_list.index(energy), END_USES.index(end_use)] += consumption
+
+    for row, building in enumerate(buildings.itertuples()):
+        if not building.to_sim:
+            continue
+        backup_share = building.backup_heating_share
+        add(row, building.main_heating_energy, 'heating',
+            heating_needs[row] / building.main_heating_system_efficiency * (1. - backup_share))
+        if backup_share > 0.:
+            add(row, building.backup_heating_energy, 'heating',
+                heating_needs[row] / building.backup_heating_system_efficiency * backup_share)
+        if building.dhw_energy in dhw_efficiencies:
+            add(row, building.dhw_energy, 'dhw', dhw_needs[row] / dhw_efficiencies[building.dhw_energy])
+        add(row, 'electricity', 'specific', specific_needs[row])
+        add(row, building.cooking_energy, 'cooking', cooking_needs[row])
+
+    return allocation
+
+
+@pytest.fixture
+def energy_stock(stock):
+    """The buildings of the stock with random needs, and random energies for the synthetic stock"""
+
+    buildings, _ = stock
+    rng = np.random.default_rng(1)
+    for col in NEED_COLUMNS:
+        buildings[col] = rng.uniform(0., 1e4, buildings.shape[0])
+
+    if buildings.shape[0] > 1:
+        main_energy = rng.integers(0, len(energy_list), buildings.shape[0])
+        buildings['main_heating_energy'] = np.array(energy_list)[main_energy]
+        buildings['backup_heating_energy'] = np.array(energy_list)[
+            (main_energy + rng.integers(1, len(energy_list), buildings.shape[0])) % len(energy_list)]
+        buildings['backup_heating_share'] = rng.choice([0., 0.2, 0.5], buildings.shape[0])
+        buildings['main_heating_system_efficiency'] = rng.uniform(0.5, 3., buildings.shape[0])
+        buildings['backup_heating_system_efficiency'] = rng.uniform(0.5, 1., buildings.shape[0])
+        buildings['dhw_energy'] = rng.choice(energy_list, buildings.shape[0])
+        buildings['cooking_energy'] = rng.choice(energy_list, buildings.shape[0])
+        buildings['heating_system'] = rng.choice(['district_network', 'boiler'], buildings.shape[0])
+        buildings['to_sim'] = rng.random(buildings.shape[0]) > 0.2
+
+    return buildings
+
+
+def test_energy_allocation(energy_stock):
+    buildings = energy_stock
+    needs = [buildings[f'annual_{end_use}_needs'].values for end_use in END_USES]
+
+    allocation = energy_allocation(buildings, *needs)
+
+    np.testing.assert_allclose(allocation, reference_allocation(buildings, *needs), rtol=1e-12)
+
+
+def test_energy_allocation_samples(energy_stock):
+    buildings = energy_stock
+    rng = np.random.default_rng(2)
+    heating_needs = rng.uniform(0., 1e4, (buildings.shape[0], 3))
+    dhw_needs = rng.uniform(0., 1e3, (buildings.shape[0], 3))
+
+    allocation = energy_allocation(buildings, heating_needs, dhw_needs)
+
+    assert allocation.shape == (buildings.shape[0], len(energy_list), len(END_USES), 3)
+    for sample in range(3):
+        np.testing.assert_allclose(allocation[..., sample],
+                                   energy_allocation(buildings, heating_needs[:, sample], dhw_needs[:, sample]),
+                                   rtol=1e-12)
+
+
+def test_run_models(energy_stock):
+    buildings = energy_stock
+
+    run_models(buildings)
+
+    annual = reference_allocation(buildings, *[buildings[f'annual_{end_use}_needs'].values for end_use in END_USES])
+    conventional = reference_allocation(buildings, buildings['conventional_heating_needs'].values,
+                                        buildings['conventional_dhw_needs'].values, np.zeros(buildings.shape[0]),
+                                        np.zeros(buildings.shape[0]))
+    for energy_id, energy in enumerate(energy_list):
+        for prefix, allocation in [('annual', annual), ('conventional', conventional)]:
+            np.testing.assert_allclose(buildings[f'{prefix}_{energy}_consumption'].values,
+                                       allocation[:, energy_id].sum(axis=1), rtol=1e-12)
+            for end_use in ['heating', 'dhw']:
+                np.testing.assert_allclose(buildings[f'{prefix}_{energy}_{end_use}'].values,
+                                           allocation[:, energy_id, END_USES.index(end_use)], rtol=1e-12)
+        np.testing.assert_allclose(buildings[f'annual_{energy}_cooking'].values,
+                                   annual[:, energy_id, END_USES.index('cooking')], rtol=1e-12)
@@ -0,0 +1,372 @@
+import os
+import random
+import shutil
+from collections import Counter
+
+import numpy as np
+import pytest
+
+bd = pytest.importorskip('bw2data')
+bc = pytest.importorskip('bw2calc')
+
+from L420A import everything as ev
+
+METHODS = [('gwp',), ('methane',)]
+ACTIVITIES = ['a', 'b', 'c', 'd']
+
+
+def technosphere(db, factor):
+    """Returns the activities of a small database whose supply chains loop, the emissions being scaled by factor"""
+
+    def activity(code, inputs, co2, ch4):
+        exchanges = [{'input': (db, code), 'amount': 1., 'type': 'production'}]
+        exchanges += [{'input': (db, input_code), 'amount': amount, 'type': 'technosphere'}
+                      for input_code, amount in inputs]
+        exchanges += [{'input': ('bio', 'co2'), 'amount': co2 * factor, 'type': 'biosphere'},
+                      {'input': ('bio', 'ch4'), 'amount': ch4 * factor, 'type': 'biosphere'}]
+        return {'name': code, 'unit': 'kg', 'exchanges': exchanges}
+
+    return {(db, 'a'): activity('a', [('b', 0.5), ('c', 0.2)], 2., 0.01),
+            (db, 'b'): activity('b', [('c', 0.3)], 1., 0.),
+            (db, 'c'): activity('c', [('a', 0.1)], 0.7, 0.05),
+            (db, 'd'): activity('d', [('b', 1.2)], 0.2, 0.002)}
+
+
+def with_uncertainty(activities, scale=0.1):
+    """Gives a lognormal uncertainty of the same scale to all the non zero input exchanges of the activities"""
+
+    for activity in activities.values():
+        for exchange in activity['exchanges']:
+            if exchange['type'] != 'production' and exchange['amount'] > 0.:
+                exchange.update({'uncertainty type': 2, 'loc': np.log(exchange['amount']), 'scale': scale})
+
+    return activities
+
+
+@pytest.fixture(scope='module')
+def project():
+    """A temporary project with the databases of 2020 and 2030, a database with uncertain exchanges and two methods"""
+
+    temp_dir = bd.projects._use_temp_directory()
+    bd.Database('bio').write({('bio', 'co2'): {'name': 'co2', 'type': 'emission', 'unit': 'kg'},
+                              ('bio', 'ch4'): {'name': 'ch4', 'type': 'emission', 'unit': 'kg'}})
+    bd.Database('db_2020').write(technosphere('db_2020', 1.))
+    bd.Database('db_2030').write(technosphere('db_2030', 0.6))
+    bd.Database('uncertain').write(with_uncertainty(technosphere('uncertain', 1.)))
+    for method, factors in zip(METHODS, [[(('bio', 'co2'), 1.), (('bio', 'ch4'), 28.)], [(('bio', 'ch4'), 1.)]]):
+        bd.Method(method).register()
+        bd.Method(method).write(factors)
+
+    yield
+
+    bd.projects._restore_orig_directory()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def lca_scores(db, demand):
+    """Calculates the scores of a demand {activity code: amount} of a database with one LCA per method"""
+
+    scores = []
+    for method in METHODS:
+        lca = bc.LCA({bd.get_activity((db, code)): amount for code, amount in demand.items()}, method)
+        lca.lci()
+        lca.lcia()
+        scores.append(lca.score)
+
+    return np.array(scores)
+
+
+def build_products(registry, count, seed):
+    """Creates count construction products, a third of them having renovation variants"""
+
+    rnd = random.Random(seed)
+    for i in range(count):
+        ev.Product(name=f'c{i}', id=i, amount=rnd.random(), unit='kg', service_life=rnd.randint(5, 70),
+                   production_lci=rnd.choice(ACTIVITIES), eol_lci=rnd.choice(ACTIVITIES + [None]), registry=registry)
+    for i in range(0, count, 3):
+        for k in range(rnd.randint(0, 2)):
+            ev.Product(name=f'r{i}_{k}', id=i, amount=rnd.random(), unit='kg', service_life=rnd.randint(5, 70),
+                       production_lci=rnd.choice(ACTIVITIES), eol_lci=rnd.choice(ACTIVITIES),
+                       major_renovation_possible=True, renovation_product=True, registry=registry)
+            for product in registry.construction_products(i):
+                product.major_renovation_possible = True
+
+
+
+def reference_points(mfa, products):
+    """Adds the replacement and eol points of the products one product and one year at a time"""
+
+    points = set()
+    for product in products:
+        targets = mfa.registry.renovation_products(product.id) if product.major_renovation_possible else [product]
+        for year in list(range(product.service_life + mfa.start, mfa.end - 1, product.service_life)) + [mfa.end]:
+            points.update((year, target) for target in targets)
+
+    return sorted(points, key=lambda point: point[0])
+
+
+
+@pytest.mark.parametrize('block_size', [1, 250])
+@pytest.mark.parametrize('demand_count', [1, 2, 6])
+def test_impact_matrix(project, block_size, demand_count):
+    """Both the forward solve of the demands (no more demands than methods) and the transposed solve give the
+    scores of bc.LCA"""
+
+    solvers = ev.LCASolverCache(METHODS, block_size=block_size)
+    codes = (ACTIVITIES * 2)[:demand_count]
+    amounts = np.arange(1., demand_count + 1.)
+
+    scores = solvers.impact_matrix('db_2020', [bd.get_activity(('db_2020', code)) for code in codes], amounts)
+
+    assert ('db_2020' in solvers.unit_scores) == (demand_count > len(METHODS))
+    for code, amount, activity_scores in zip(codes, amounts, scores):
+        np.testing.assert_allclose(activity_scores, lca_scores('db_2020', {code: amount}), rtol=1e-10)
+
+
+def test_impacts(project):
+    solvers = ev.LCASolverCache(METHODS)
+
+    for code in ['a', 'c', 'd']:
+        scores = solvers.impacts('db_2020', bd.get_activity(('db_2020', code)), 2.)
+        np.testing.assert_allclose(scores, lca_scores('db_2020', {code: 2.}), rtol=1e-10)
+
+    # the technosphere matrix is only factorized once per database
+    assert list(solvers.lcas) == ['db_2020']
+
+
+def test_give_me_embodied(project):
+    activities_and_years = [(2020, 'a', 'wall'), (2025, 'b', 'roof'), (2030, 'a', 'wall'), (2045, 'd', 'window')]
+    yearly_databases = {2020: ['db_2020'], 2030: ['db_2020', 'db_2030'], 2040: ['db_2030']}
+    pro_lca = ev.ProLCA(activities_and_years, methods=METHODS, yearly_databases=yearly_databases)
+
+    results = pro_lca.give_me_embodied()
+
+    assert list(results) == [(2020, 'a', 'db_2020'), (2025, 'b', 'db_2020'), (2030, 'a', 'db_2020'),
+                             (2030, 'a', 'db_2030'), (2045, 'd', 'db_2030')]
+    for (year, code, db), scores in results.items():
+        np.testing.assert_allclose(scores, lca_scores(db, {code: 1.}), rtol=1e-10)
+
+
+def test_lcia_result_store(project, tmp_path):
+    store = ev.LCIAResultStore(str(tmp_path / 'scores.sqlite'))
+    bd.Database('scratch').write(technosphere('scratch', 1.))
+    yearly_databases = {2020: ['scratch']}
+
+    first = ev.ProLCA([(2020, 'a', 'wall'), (2020, 'c', 'roof')], methods=METHODS, yearly_databases=yearly_databases,
+                      store=store).give_me_embodied()
+    # the second study only uses the stored scores
+    pro_lca = ev.ProLCA([(2020, 'c', 'roof'), (2020, 'a', 'wall')], methods=METHODS,
+                        yearly_databases=yearly_databases, store=store)
+    second = pro_lca.give_me_embodied()
+    assert len(pro_lca.solvers.lcas) == 0
+    for key, scores in first.items():
+        np.testing.assert_allclose(second[key], scores, rtol=1e-12)
+        np.testing.assert_allclose(scores, lca_scores('scratch', {key[1]: 1.}), rtol=1e-10)
+
+    # the stored scores of a rewritten database are not used anymore
+    bd.Database('scratch').write(technosphere('scratch', 2.))
+    third = ev.ProLCA([(2020, 'a', 'wall')], methods=METHODS, yearly_databases=yearly_databases,
+                      store=store).give_me_embodied()
+    np.testing.assert_allclose(third[(2020, 'a', 'scratch')], lca_scores('scratch', {'a': 1.}), rtol=1e-10)
+    store.close()
+
+
+def test_give_me_embodied_parallel(project):
+    activities_and_years = [(2020, 'a', 'wall'), (2030, 'c', 'roof'), (2045, 'd', 'window'), (2050, 'b', 'floor')]
+    yearly_databases = {2020: ['db_2020'], 2030: ['db_2020', 'db_2030'], 2040: ['db_2030']}
+    expected = ev.ProLCA(activities_and_years, methods=METHODS, yearly_databases=yearly_databases).give_me_embodied()
+
+    pro_lca = ev.ProLCA(activities_and_years, methods=METHODS, yearly_databases=yearly_databases, n_cpu=2)
+    try:
+        for _ in range(2):
+            results = pro_lca.give_me_embodied()
+            assert list(results) == list(expected)
+            for key, scores in expected.items():
+                np.testing.assert_allclose(results[key], scores, rtol=1e-12)
+            # each database stays on the worker that factorized it
+            assert pro_lca.database_workers == {'db_2020': 0, 'db_2030': 1}
+        pids = [executor.submit(os.getpid).result() for executor in pro_lca.executors]
+        assert len(set(pids)) == 2
+    finally:
+        pro_lca.close()
+    assert pro_lca.executors == []
+
+
+def standard_normals(samples, params):
+    """Returns the standard normal draws of the lognormal samples of params"""
+
+    lognormal = params['uncertainty_type'] == 2
+    return (np.log(samples[:, lognormal]) - params['loc'][lognormal]) / params['scale'][lognormal]
+
+
+def test_exchange_sample_store(project, tmp_path, monkeypatch):
+    lca = ev.LCASolverCache(METHODS).get_lca('uncertain', bd.get_activity(('uncertain', 'a')))
+    store = ev.ExchangeSampleStore(str(tmp_path / 'samples'), seed=3, chunk_size=7)
+
+    # copies, the memory-mapped files are rewritten by the next draws
+    technosphere_samples, biosphere_samples = map(np.array, store.samples('uncertain', lca, 20))
+
+    assert technosphere_samples.shape == (20, len(lca.tech_params))
+    assert biosphere_samples.shape == (20, len(lca.bio_params))
+    certain = lca.tech_params['uncertainty_type'] == 0
+    np.testing.assert_array_equal(technosphere_samples[:, certain],
+                                  np.broadcast_to(lca.tech_params['amount'][certain], (20, certain.sum())))
+    # the exchanges of both kinds have the same distribution, their draws must not be the same
+    technosphere_normals = standard_normals(technosphere_samples, lca.tech_params)
+    biosphere_normals = standard_normals(biosphere_samples, lca.bio_params)
+    assert not np.allclose(technosphere_normals[:, 0], biosphere_normals[:, 0])
+    assert store.draw_seeds('uncertain') != store.draw_seeds('db_2020')
+    assert len(set(store.draw_seeds('uncertain').values())) == 2
+
+    # the same seed gives the same samples, the stored samples are reused
+    other = ev.ExchangeSampleStore(str(tmp_path / 'other'), seed=3, chunk_size=7)
+    np.testing.assert_array_equal(other.samples('uncertain', lca, 20)[0], technosphere_samples)
+    monkeypatch.setattr(store, 'draw', None)
+    np.testing.assert_array_equal(store.samples('uncertain', lca, 10)[1], biosphere_samples[:10])
+    monkeypatch.undo()
+
+    # a new seed or more iterations draw the samples again
+    reseeded = ev.ExchangeSampleStore(str(tmp_path / 'samples'), seed=4, chunk_size=7)
+    assert not np.allclose(reseeded.samples('uncertain', lca, 20)[0], technosphere_samples)
+    assert reseeded.samples('uncertain', lca, 30)[0].shape == (30, len(lca.tech_params))
+
+
+def test_sample_impact_matrix(project, tmp_path):
+    store = ev.ExchangeSampleStore(str(tmp_path), seed=0)
+    solver = ev.MonteCarloLCASolver(METHODS, store, iterations=4)
+    demands = [bd.get_activity(('uncertain', code)) for code in ['a', 'c']]
+
+    scores = solver.sample_impact_matrix('uncertain', demands, [1., 2.])
+
+    technosphere_samples, biosphere_samples = store.samples('uncertain', solver.lcas['uncertain'], 4)
+    for iteration in range(4):
+        for d, (demand, amount) in enumerate(zip(demands, [1., 2.])):
+            for m, method in enumerate(METHODS):
+                lca = bc.LCA({demand: amount}, method)
+                lca.lci()
+                lca.rebuild_technosphere_matrix(np.asarray(technosphere_samples[iteration]))
+                lca.rebuild_biosphere_matrix(np.asarray(biosphere_samples[iteration]))
+                lca.lci_calculation()
+                lca.lcia()
+                assert scores[iteration, d, m] == pytest.approx(lca.score, rel=1e-10)
+    assert np.ptp(scores[:, 0, 0]) > 0.
+    # the static matrices are restored for the deterministic solves
+    np.testing.assert_allclose(solver.impacts('uncertain', demands[0]), lca_scores('uncertain', {'a': 1.}), rtol=1e-10)
+
+
+def test_give_me_embodied_uncertainty(project, tmp_path):
+    registry = ev.ProductRegistry()
+    # products of the same name are kept apart
+    walls = [ev.Product(name='wall', id=i, amount=1., unit='kg', registry=registry) for i in range(2)]
+    activities_and_years = [(2020, 'a', walls[0]), (2020, 'c', walls[0]), (2020, 'c', walls[1])]
+    store = ev.ExchangeSampleStore(str(tmp_path), seed=1)
+    pro_lca = ev.ProLCA(activities_and_years, methods=METHODS, yearly_databases={2020: ['uncertain']},
+                        sample_store=store, iterations=50)
+
+    results = pro_lca.give_me_embodied_uncertainty(confidence=0.9)
+
+    solver = ev.MonteCarloLCASolver(METHODS, store, iterations=50)
+    samples = solver.sample_impact_matrix('uncertain', [bd.get_activity(('uncertain', code)) for code in ['a', 'c']])
+    expected = {walls[0]: samples[:, 0] + samples[:, 1], walls[1]: samples[:, 1]}
+    assert len(results) == len(walls) * len(METHODS)
+    for product, product_samples in expected.items():
+        for m, method in enumerate(METHODS):
+            row = results.loc[(2020, product, 'uncertain', method)]
+            assert row['mean'] == pytest.approx(product_samples[:, m].mean(), rel=1e-10)
+            assert row['lower'] == pytest.approx(np.quantile(product_samples[:, m], 0.05), rel=1e-10)
+            assert row['upper'] == pytest.approx(np.quantile(product_samples[:, m], 0.95), rel=1e-10)
+
+
+def test_product_registry():
+    registry, other = ev.ProductRegistry(), ev.ProductRegistry()
+    build_products(registry, 30, 0)
+    build_products(other, 5, 1)
+
+    assert len(registry) == len(registry.real_instances) + len(registry.renovation_instances)
+    assert [product.name for product in registry.real_instances] == [f'c{i}' for i in range(30)]
+    assert not any(product in registry.positions for product in other.all_instances)
+    with pytest.raises(ValueError):
+        registry.position(other.all_instances[0])
+    for position, product in enumerate(registry.all_instances):
+        assert registry.position(product) == position
+        assert registry.construction_products(product.id) == [p for p in registry.real_instances if p.id == product.id]
+        assert registry.renovation_products(product.id) == [p for p in registry.renovation_instances
+                                                            if p.id == product.id]
+
+    table = registry.product_table()
+    assert list(table['amount']) == [product.amount for product in registry.all_instances]
+    assert list(table['renovation_product']) == [product.renovation_product for product in registry.all_instances]
+    for product, match in zip(registry.all_instances, table['construction_match']):
+        assert registry.all_instances[match] is ev.Mfa(registry=registry).match_renovation_product(product)
+
+    # the lists are emptied in place, the products of a new run are not added to those of the previous one
+    real_instances = registry.real_instances
+    registry.clear()
+    assert len(registry) == 0 and real_instances == [] and registry.construction_products(0) == []
+    assert len(other) > 0
+
+
+def test_default_registry():
+    product = ev.Product(name='default', id=-1, amount=1., unit='kg')
+
+    assert ev.Product.all_instances[-1] is product and ev.Product.real_instances[-1] is product
+    assert ev.Mfa().registry is ev.Product.default_registry
+    ev.Product.default_registry.clear()
+    assert ev.Product.all_instances == []
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_event_table(project, seed):
+    registry = ev.ProductRegistry()
+    build_products(registry, 60, seed)
+    mfa = ev.Mfa(2020, 2080, registry=registry)
+
+    mfa.add_products()
+
+    expected_points = reference_points(mfa, registry.real_instances)
+    assert Counter(mfa.points) == Counter(expected_points)
+    assert [year for year, _ in mfa.points] == [year for year, _ in expected_points]
+
+    events = mfa.event_table()
+    expected = Counter(mfa.clean_list_renovation() + mfa.clean_list_eol())
+    assert Counter(mfa.clean_list(events)) == expected
+    assert events['year'].is_monotonic_increasing
+
+    demands = mfa.activity_demands(events)
+    expected_amounts = Counter()
+    for year, lci, product in expected.elements():
+        if lci is not None:
+            expected_amounts[(year, lci)] += product.amount
+    assert len(demands) == len(expected_amounts)
+    for demand in demands.itertuples():
+        assert demand.amount == pytest.approx(expected_amounts[(demand.year, demand.lci)], rel=1e-12)
+
+
+def test_give_me_embodied_aggregated(project):
+    registry = ev.ProductRegistry()
+    build_products(registry, 30, 3)
+    mfa = ev.Mfa(2020, 2060, registry=registry)
+    mfa.add_products()
+    yearly_databases = {2020: ['db_2020'], 2030: ['db_2020', 'db_2030'], 2040: ['db_2030']}
+    pro_lca = ev.ProLCA(mfa.clean_list(), methods=METHODS, yearly_databases=yearly_databases)
+
+    aggregation = pro_lca.give_me_embodied_aggregated(mfa)
+
+    year_demands, product_demands = {}, {}
+    for year, lci, product in mfa.clean_list():
+        if lci is None:
+            continue
+        for db in pro_lca.database_chooser(year):
+            for demands, key in [(year_demands, (year, db)), (product_demands, (year, product, db))]:
+                demand = demands.setdefault(key, Counter())
+                demand[lci] += product.amount
+
+    year_results = aggregation.year_results()
+    assert set(year_results) == set(year_demands)
+    for (year, db), demand in year_demands.items():
+        np.testing.assert_allclose(year_results[(year, db)], lca_scores(db, demand), rtol=1e-10)
+
+    product_results = aggregation.product_results()
+    assert set(product_results) == set(product_demands)
+    for (year, product, db), demand in product_demands.items():
+        np.testing.assert_allclose(product_results[(year, product, db)], lca_scores(db, demand), rtol=1e-10)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Simulation.incremental import IncrementalSimulation
+from Simulation.main import run_models_quick
+
+
+def scale_u_values(buildings, boundaries):
+    boundaries['u_value'] = boundaries['u_value'] * 0.5
+    return {'boundaries': ['u_value']}
+
+
+def lower_set_points(buildings, boundaries):
+    for frame in [buildings, boundaries]:
+        frame['actual_heating_set_point'] = frame['actual_heating_set_point'] - 1.5
+    return {'buildings': ['actual_heating_set_point'], 'boundaries': ['actual_heating_set_point']}
+
+
+def change_heating_efficiency(buildings, boundaries):
+    buildings['main_heating_system_efficiency'] = buildings['main_heating_system_efficiency'] * 1.2
+    return {'buildings': ['main_heating_system_efficiency']}
+
+
+def double_occupant_gains(buildings, boundaries):
+    # the thermal need models clip the occupant gains, the update must start from the original gains
+    buildings['annual_occupant_gains'] = buildings['annual_occupant_gains'] * 2.
+    return {'buildings': ['annual_occupant_gains']}
+
+
+CHANGES = {'u_value': (scale_u_values, ['boundary_losses', 'thermal_needs', 'energy_consumption',
+                                        'energy_indicators']),
+           'set_points': (lower_set_points, ['solar_gains', 'degree_hours', 'boundary_losses', 'ventilation_losses',
+                                             'thermal_needs', 'energy_consumption', 'energy_indicators']),
+           'heating_efficiency': (change_heating_efficiency, ['energy_consumption', 'energy_indicators']),
+           'occupant_gains': (double_occupant_gains, ['thermal_needs', 'energy_consumption', 'energy_indicators'])}
+
+
+@pytest.mark.parametrize('change', list(CHANGES))
+def test_downstream_stages(stock, preprocessed_climate, parameters, change):
+    buildings, boundaries = stock
+    modify, expected_stages = CHANGES[change]
+    simulation = IncrementalSimulation(buildings, boundaries, preprocessed_climate, {}, parameters)
+
+    changes = modify(buildings.copy(), boundaries.copy())
+
+    assert simulation.downstream_stages(changes) == expected_stages
+
+
+@pytest.mark.parametrize('change', list(CHANGES))
+def test_update(stock, preprocessed_climate, parameters, change):
+    """An update only reruns the stages affected by the change and gives the results of a full run"""
+
+    buildings, boundaries = stock
+    modify, expected_stages = CHANGES[change]
+    simulation = IncrementalSimulation(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters)
+    simulation.run()
+
+    new_buildings, new_boundaries = buildings.copy(), boundaries.copy()
+    modify(new_buildings, new_boundaries)
+    results = simulation.update(new_buildings.copy(), new_boundaries.copy())
+
+    assert simulation.last_run == expected_stages
+    expected = run_models_quick(new_buildings, new_boundaries, preprocessed_climate, {}, parameters)
+    pd.testing.assert_frame_equal(results, expected, check_exact=False, rtol=1e-12)
+    for col in ['annual_thermal_losses', 'transmitted_solar_gain', 'actual_unified_degree_hours']:
+        np.testing.assert_allclose(simulation.boundaries[col].values, new_boundaries[col].values, rtol=1e-12)
+
+
+def test_unchanged_update(stock, preprocessed_climate, parameters):
+    buildings, boundaries = stock
+    simulation = IncrementalSimulation(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters)
+    simulation.run()
+
+    simulation.update(buildings, boundaries)
+
+    assert simulation.last_run == []
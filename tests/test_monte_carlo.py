@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from Simulation.main import run_models_quick
+from Simulation.monte_carlo import run_monte_carlo, summarize_monte_carlo, MONTE_CARLO_OUTPUTS
+
+NO_SAMPLING = {'buildings': {}, 'boundaries': {}}
+SAMPLE_COUNT = 3
+
+
+def constant_factor(factor):
+    """A beta distribution whose draws all give factor"""
+
+    return {'min': factor, 'max': factor, 'alpha': 2., 'beta': 2.}
+
+
+def assert_samples_equal(samples, expected):
+    """Checks that every sample of each building gives the outputs of the deterministic run"""
+
+    assert list(samples['building_id']) == list(np.repeat(expected['building_id'].values, SAMPLE_COUNT))
+    for col in MONTE_CARLO_OUTPUTS[:-1]:
+        np.testing.assert_allclose(samples[col].values, np.repeat(expected[col].values.astype(float), SAMPLE_COUNT),
+                                   rtol=1e-12, atol=1e-9, err_msg=col)
+    assert (samples['diagnosis_class'].astype(str).values ==
+            np.repeat(expected['diagnosis_class'].astype(str).values, SAMPLE_COUNT)).all()
+
+
+def test_no_sampling(stock, preprocessed_climate, parameters):
+    """Without sampled inputs, all the samples are the deterministic run"""
+
+    buildings, boundaries = stock
+
+    samples = run_monte_carlo(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters,
+                              sample_count=SAMPLE_COUNT, distributions=NO_SAMPLING, seed=0)
+
+    expected = run_models_quick(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters)
+    assert_samples_equal(samples, expected)
+
+
+def test_constant_factors(stock, preprocessed_climate, parameters):
+    """Factors drawn in distributions without spread give the deterministic run of the scaled inputs"""
+
+    buildings, boundaries = stock
+    distributions = {'buildings': {'air_change_rate': constant_factor(1.3), 'annual_dhw_needs': constant_factor(0.8)},
+                     'boundaries': {'u_value': constant_factor(0.6)}}
+
+    samples = run_monte_carlo(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters,
+                              sample_count=SAMPLE_COUNT, distributions=distributions, seed=0)
+
+    scaled_buildings, scaled_boundaries = buildings.copy(), boundaries.copy()
+    scaled_buildings['air_change_rate'] *= 1.3
+    scaled_buildings['annual_dhw_needs'] *= 0.8
+    scaled_boundaries['u_value'] *= 0.6
+    expected = run_models_quick(scaled_buildings, scaled_boundaries, preprocessed_climate, {}, parameters)
+    assert_samples_equal(samples, expected)
+
+
+def test_seed(stock, preprocessed_climate, parameters):
+    buildings, boundaries = stock
+
+    samples = [run_monte_carlo(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters,
+                               sample_count=50, seed=seed) for seed in [4, 4, 5]]
+
+    np.testing.assert_array_equal(samples[0]['total_final_consumption'], samples[1]['total_final_consumption'])
+    assert (samples[0]['total_final_consumption'] != samples[2]['total_final_consumption']).any()
+
+    summary = summarize_monte_carlo(samples[0])
+    assert list(summary.index) == list(buildings['building_id'].unique())
+    assert ((summary['total_final_consumption_q0.05'] <= summary['total_final_consumption_q0.5']) &
+            (summary['total_final_consumption_q0.5'] <= summary['total_final_consumption_q0.95'])).all()
+    class_shares = summary[[col for col in summary if col.startswith('diagnosis_class_')]]
+    np.testing.assert_allclose(class_shares.sum(axis=1), 1., rtol=1e-12)
+    assert summary['total_final_consumption_mean'].values == pytest.approx(
+        samples[0].groupby('building_id')['total_final_consumption'].mean().loc[summary.index].values, rel=1e-12)
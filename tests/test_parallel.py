@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+from shapely import wkt
+from shapely.affinity import translate
+
+from Simulation import parallel
+from Simulation.main import run_models_quick, Parameters
+from Simulation.sim_BM import co2_energies
+from conftest import varied_stock
+
+
+@pytest.fixture
+def spread_stock():
+    """A synthetic stock whose buildings are placed on a grid, without solar masks"""
+
+    buildings, boundaries = varied_stock()
+    side = int(np.ceil(np.sqrt(buildings.shape[0])))
+    dx = (np.arange(buildings.shape[0]) % side) * 25.
+    dy = (np.arange(buildings.shape[0]) // side) * 25.
+    footprint = wkt.loads(buildings['geometry'].iloc[0])
+    buildings['geometry'] = [translate(footprint, x, y) for x, y in zip(dx, dy)]
+    boundary_positions = buildings.index.get_indexer(boundaries['building_id'])
+    boundaries['center_x'] += dx[boundary_positions]
+    boundaries['center_y'] += dy[boundary_positions]
+
+    return buildings, boundaries.drop(columns=[col for col in boundaries if col.startswith('mask_')])
+
+
+@pytest.mark.parametrize('solar_masks', [False, True])
+def test_run_models_quick(spread_stock, preprocessed_climate, monkeypatch, solar_masks):
+    """The shards give the results of a sequential run, with the solar masks of the inputs or calculated from the
+    elevation model of the whole stock"""
+
+    buildings, boundaries = spread_stock if solar_masks else varied_stock()
+    monkeypatch.setattr(parallel, 'MIN_SHARD_BUILDINGS', 10)
+
+    results = {}
+    for n_cpu in [1, 3]:
+        shard_buildings, shard_boundaries = buildings.copy(), boundaries.sample(frac=1., random_state=2)
+        run_models_quick(shard_buildings, shard_boundaries, preprocessed_climate, {},
+                         Parameters(co2_energies=co2_energies, n_cpu=n_cpu))
+        results[n_cpu] = shard_buildings, shard_boundaries
+
+    assert parallel.shard_count(buildings.shape[0], 3) == 3
+    pd.testing.assert_frame_equal(results[3][0], results[1][0])
+    pd.testing.assert_frame_equal(results[3][1], results[1][1])
+
+
+def test_stock_without_masks(preprocessed_climate, parameters):
+    """The masks of buildings given with WKT footprints are not calculated, their boundaries are not shaded"""
+
+    buildings, boundaries = varied_stock()
+    mask_columns = [col for col in boundaries if col.startswith('mask_')]
+    unshaded = boundaries.assign(**{col: 0. for col in mask_columns})
+    boundaries = boundaries.drop(columns=mask_columns)
+
+    results = run_models_quick(buildings.copy(), boundaries, preprocessed_climate, {}, parameters)
+    expected = run_models_quick(buildings.copy(), unshaded, preprocessed_climate, {}, parameters)
+
+    assert not boundaries.columns.str.startswith('mask_').any()
+    np.testing.assert_allclose(boundaries['transmitted_solar_gain'].values,
+                               unshaded['transmitted_solar_gain'].values, rtol=1e-12)
+    pd.testing.assert_frame_equal(results, expected)
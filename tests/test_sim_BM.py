@@ -0,0 +1,73 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Simulation import sim_BM
+from Simulation.climate import load_climate_data
+from Simulation.main import run_models_quick
+
+RENO_DICTS = {'none': dict.fromkeys(sim_BM.reno_dict),
+              'windows_and_heating': dict(dict.fromkeys(sim_BM.reno_dict), **{'234 Windows': 1,
+                                                                              sim_BM.HEATING_MEASURE: 1}),
+              'all': dict.fromkeys(sim_BM.reno_dict, 1)}
+HEATING_SET_POINTS = [16., 20.]
+RENO_VALUES = dict(dict.fromkeys(sim_BM.reno_dict, 1), **{sim_BM.HEATING_MEASURE: 3.})
+
+
+def full_run(buildings, boundaries, climate, parameters, reno_dict, heating_set_point):
+    """Simulates one scenario from scratch"""
+
+    buildings, boundaries = buildings.copy(), boundaries.copy()
+    sim_BM.set_heating_set_point(buildings, boundaries, heating_set_point)
+    sim_BM.apply_renovation(buildings, boundaries, reno_dict)
+
+    return run_models_quick(buildings, boundaries, climate, climate.metadata, parameters)
+
+
+def test_scenario_batch(stock, preprocessed_climate, parameters):
+    buildings, boundaries = stock
+    batch = sim_BM.ScenarioBatch({'grenoble': preprocessed_climate}, RENO_DICTS, HEATING_SET_POINTS,
+                                 buildings=buildings, boundaries=boundaries, parameters=parameters)
+
+    results = batch.run().set_index(['heating_set_point', 'scenario', 'building_id'])
+
+    assert results.shape[0] == len(RENO_DICTS) * len(HEATING_SET_POINTS) * buildings.shape[0]
+    for heating_set_point in HEATING_SET_POINTS:
+        for scenario, reno_dict in RENO_DICTS.items():
+            expected = full_run(buildings, boundaries, preprocessed_climate, parameters, reno_dict, heating_set_point)
+            result = results.loc[(heating_set_point, scenario)].loc[expected['building_id']]
+            for col in ['total_final_consumption', 'total_primary_consumption', 'total_CO2_emission']:
+                np.testing.assert_allclose(result[col].values, expected[col].values, rtol=1e-12, err_msg=col)
+            assert (result['diagnosis_class'].values == expected['diagnosis_class'].values).all()
+
+
+def test_scenario_batch_fmes():
+    batch = sim_BM.ScenarioBatch({'grenoble': load_climate_data(sim_BM.french_climate_data)}, RENO_DICTS,
+                                 HEATING_SET_POINTS)
+
+    results = batch.run()
+
+    for row in results.itertuples():
+        climate, metadata = load_climate_data(sim_BM.french_climate_data)
+        assert row.total_final_consumption == pytest.approx(
+            sim_BM.FMES(climate, metadata, RENO_DICTS[row.scenario], row.heating_set_point), rel=1e-12)
+
+
+@pytest.mark.parametrize('set_point_change', [0., 0.005, 0.05])
+def test_renovation_sensitivity_fmes(preprocessed_climate, set_point_change):
+    """Within their validity range, the linear outputs of all the renovation packages are those of FMES"""
+
+    sensitivity = sim_BM.renovation_sensitivity(preprocessed_climate, None, RENO_VALUES, heating_set_point=18.)
+    packages = pd.DataFrame(list(itertools.product([0, 1], repeat=len(RENO_VALUES))), columns=list(RENO_VALUES))
+    packages['heating_set_point'] = set_point_change
+
+    predictions, valid = sim_BM.evaluate_renovation_packages(sensitivity, packages)
+
+    assert valid.values.all()
+    for package, prediction in enumerate(predictions.values[:, 0]):
+        reno_dict = {measure: RENO_VALUES[measure] if packages.loc[package, measure] else None
+                     for measure in RENO_VALUES}
+        assert prediction == pytest.approx(sim_BM.FMES(preprocessed_climate, None, reno_dict, 18. + set_point_change),
+                                           rel=1e-9)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Simulation.solar_gains import run_models, heating_periods, mask_influence, radiation_on_boundary_model, EXTERIOR_WALL, ROOF
+from Simulation.utils import heating_season
+
+
+def reference_solar_gains(boundaries, climate):
+    """Calculates the transmitted solar gain boundary by boundary, on all the time steps of the climate with the sun
+    above the horizon"""
+
+    solar_steps = climate.index.isin(heating_season(climate)) & (climate['sun_height'].values > 0.)
+    gains = pd.Series(0., index=boundaries.index)
+
+    for index in boundaries.index[boundaries['type'].isin([EXTERIOR_WALL, ROOF])]:
+        boundary = boundaries.loc[[index]]
+        direct_radiation, diffuse_radiation = mask_influence(boundary, climate)
+        poa_direct, poa_diffuse, angle_of_incidence = radiation_on_boundary_model(boundary, direct_radiation,
+                                                                                  diffuse_radiation, climate)
+        solar_factor = boundary['window_solar_factor'].iloc[0]
+        transmission = np.clip((1. - (angle_of_incidence[0] / 90.) ** 5) * solar_factor, 0., 1.)
+        transmitted = transmission * poa_direct[0] + solar_factor * poa_diffuse[0]
+        heating_period = solar_steps & (climate['air_temperature'].values <
+                                        boundary['actual_heating_set_point'].iloc[0])
+        window_area = boundary['window_share'].iloc[0] * boundary['area'].iloc[0]
+        gains[index] = window_area * transmitted[heating_period].sum() / 1000.
+
+    return gains
+
+
+@pytest.mark.parametrize('block_size', [7, 500])
+def test_run_models(stock, climate, block_size):
+    buildings, boundaries = stock
+    expected = reference_solar_gains(boundaries, climate)
+
+    run_models(buildings, boundaries, climate, block_size=block_size)
+
+    assert (expected > 0.).any()
+    np.testing.assert_allclose(boundaries['transmitted_solar_gain'].values, expected.values, rtol=1e-10)
+
+
+def test_heating_periods(stock, climate):
+    _, boundaries = stock
+    solar_boundaries = boundaries[boundaries['type'].isin([EXTERIOR_WALL, ROOF])]
+
+    set_points, heating_period_masks, set_point_index = heating_periods(climate, solar_boundaries)
+
+    assert heating_period_masks.dtype == bool
+    assert heating_period_masks.shape == (len(set_points), climate.shape[0])
+    in_heating_season = climate.index.isin(heating_season(climate))
+    for set_point, boundary_set_point_index in zip(solar_boundaries['actual_heating_set_point'], set_point_index):
+        expected = in_heating_season & (climate['air_temperature'].values < set_point)
+        assert set_points[boundary_set_point_index] == set_point
+        assert (heating_period_masks[boundary_set_point_index] == expected).all()
@@ -0,0 +1,109 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely import wkt
+from shapely.affinity import translate
+from shapely.geometry import Polygon
+
+from Simulation.solar_masks import discretize_polygons, elevation_model, solar_mask, EXTERIOR_WALL, ROOF
+
+
+def reference_discretization(polygons, polygon_ends, resolution):
+    """Discretizes the edges of the polygons point by point"""
+
+    points = []
+    for start, end in zip(np.append(0, polygon_ends[:-1] + 1), polygon_ends):
+        for vertex, next_vertex in zip(polygons[start:end], polygons[start + 1:end + 1]):
+            length = np.hypot(*(next_vertex[:2] - vertex[:2]))
+            if length == 0.:
+                continue
+            direction = (next_vertex[:2] - vertex[:2]) / length
+            for k in range(int(length / resolution) + 1):
+                points.append([*(vertex[:2] + direction * k * resolution), vertex[2]])
+
+    return np.array(points).reshape((-1, 3))
+
+
+def reference_solar_mask(boundaries, elevation_data, angular_resolution, bbox_filter):
+    """Calculates the solar mask boundary by boundary and azimuth sector by azimuth sector, the azimuths following
+    the pvlib convention (north = 0, clockwise)"""
+
+    sector_count = int(360. / angular_resolution)
+    masks = np.zeros((boundaries.shape[0], sector_count + 1))
+
+    for k, boundary in enumerate(boundaries.itertuples()):
+        if boundary.type == EXTERIOR_WALL:
+            start = int(((boundary.azimuth + 90.) % 360.) / angular_resolution)
+            for sector in range(start, start + int(180. / angular_resolution) + 1):
+                masks[k, sector % sector_count] = 90.
+        if boundary.type not in [EXTERIOR_WALL, ROOF]:
+            continue
+
+        offsets = elevation_data - np.array([boundary.center_x, boundary.center_y, boundary.center_z])
+        offsets = offsets[(offsets[:, 2] > 0.) & (np.hypot(offsets[:, 0], offsets[:, 1]) <= bbox_filter)]
+        azimuths = np.degrees(np.arctan2(offsets[:, 0], offsets[:, 1])) % 360.
+        heights = np.degrees(np.arcsin(offsets[:, 2] / np.linalg.norm(offsets, axis=1)))
+        for sector in range(sector_count):
+            in_sector = (azimuths >= sector * angular_resolution) & (azimuths < (sector + 1) * angular_resolution)
+            if in_sector.any():
+                masks[k, sector] = max(masks[k, sector], heights[in_sector].max())
+
+    masks[:, sector_count] = masks[:, 0]
+    return masks
+
+
+@pytest.fixture
+def neighbourhood(stock):
+    """The buildings of the stock placed on a grid, with random buildings around them"""
+
+    buildings, boundaries = stock
+    side = int(np.ceil(np.sqrt(buildings.shape[0])))
+    dx = (np.arange(buildings.shape[0]) % side) * 25.
+    dy = (np.arange(buildings.shape[0]) // side) * 25.
+    footprint = wkt.loads(buildings['geometry'].iloc[0])
+    boundary_positions = buildings.index.get_indexer(boundaries['building_id'])
+    boundaries['center_x'] += dx[boundary_positions]
+    boundaries['center_y'] += dy[boundary_positions]
+    boundaries = boundaries.drop(columns=[col for col in boundaries if col.startswith('mask_')])
+
+    rng = np.random.default_rng(0)
+    x_min, y_min = footprint.bounds[:2]
+    geometries = [translate(footprint, x, y) for x, y in zip(dx, dy)]
+    for _ in range(20):
+        x, y = x_min + rng.uniform(-80., 80. + dx.max()), y_min + rng.uniform(-80., 80. + dy.max())
+        width, depth = rng.uniform(5., 15., 2)
+        geometries.append(Polygon([(x, y), (x + width, y), (x + width, y + depth), (x, y + depth), (x, y)]))
+    heights = np.concatenate([buildings['height'].values, rng.uniform(3., 20., 20)])
+    surroundings = gpd.GeoDataFrame({'height': heights, 'altitude': buildings['altitude'].iloc[0]},
+                                    geometry=geometries)
+
+    return surroundings, boundaries
+
+
+def test_discretize_polygons():
+    rng = np.random.default_rng(0)
+    polygons, polygon_ends = [], []
+    for vertex_count in [4, 6, 5]:
+        vertices = np.column_stack([rng.uniform(0., 30., (vertex_count, 2)), rng.uniform(3., 20., vertex_count)])
+        # a duplicated vertex gives a zero length edge
+        vertices[2] = vertices[1]
+        vertices = np.vstack([vertices, vertices[:1]])
+        polygons.append(vertices)
+        polygon_ends.append(sum(polygon.shape[0] for polygon in polygons) - 1)
+    polygons = np.concatenate(polygons)
+
+    np.testing.assert_allclose(discretize_polygons(polygons, np.array(polygon_ends), 2.),
+                               reference_discretization(polygons, np.array(polygon_ends), 2.), rtol=1e-12)
+
+
+@pytest.mark.parametrize('angular_resolution', [5., 10.])
+def test_solar_mask(neighbourhood, angular_resolution):
+    surroundings, boundaries = neighbourhood
+    elevation_data = elevation_model(surroundings, 2.)
+
+    masks = solar_mask(boundaries, elevation_data, angular_resolution, 100.)
+
+    expected = reference_solar_mask(boundaries, elevation_data, angular_resolution, 100.)
+    assert ((expected > 0.) & (expected < 90.)).any()
+    np.testing.assert_allclose(masks.values, expected, rtol=1e-12)
+    np.testing.assert_allclose(boundaries[masks.columns].values, expected, rtol=1e-12)
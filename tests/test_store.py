@@ -0,0 +1,70 @@
+import warnings
+
+import numpy as np
+
+from Simulation.main import run_models_quick
+from Simulation.store import BuildingStore
+from Simulation.thermal_needs import BOUNDARY_SUM_COLUMNS
+from conftest import varied_stock
+
+
+def shuffled(stock):
+    """The buildings and boundaries of a stock, the boundaries not being sorted by building"""
+
+    buildings, boundaries = stock
+    return buildings, boundaries.sample(frac=1., random_state=1)
+
+
+def test_building_boundaries(stock):
+    buildings, boundaries = shuffled(stock)
+    store = BuildingStore(buildings, boundaries)
+
+    assert len(store) == buildings.shape[0]
+    for position, building_id in enumerate(buildings['building_id']):
+        building_boundaries = store.building_boundaries(position)
+        assert (building_boundaries['building_id'] == building_id).all()
+        assert building_boundaries.shape[0] == (boundaries['building_id'] == building_id).sum()
+
+
+def test_building_sums(stock):
+    buildings, boundaries = shuffled(stock)
+    store = BuildingStore(buildings, boundaries)
+    building_ids = buildings['building_id'].values[::-1]
+
+    sums = store.building_sums(BOUNDARY_SUM_COLUMNS, building_ids)
+
+    expected = boundaries.groupby('building_id')[BOUNDARY_SUM_COLUMNS].sum().loc[building_ids]
+    for col in BOUNDARY_SUM_COLUMNS:
+        # the store keeps the boundary results in float32
+        np.testing.assert_allclose(sums[col], expected[col].values, rtol=1e-6)
+
+
+def test_run_models_quick(stock, preprocessed_climate, parameters):
+    buildings, boundaries = shuffled(stock)
+    store = BuildingStore(buildings, boundaries)
+
+    expected = run_models_quick(buildings.copy(), boundaries.copy(), preprocessed_climate, {}, parameters)
+    results = run_models_quick(store, None, preprocessed_climate, {}, parameters)
+
+    assert list(results.index) == list(expected.index)
+    for col in expected.columns:
+        # energy columns without any value are float in the frames and categorical in the store
+        if expected[col].dtype.kind == 'f' and results[col].dtype.kind == 'f':
+            np.testing.assert_allclose(results[col].values.astype(float), expected[col].values, rtol=1e-5,
+                                       err_msg=col)
+    assert (results['diagnosis_class'].astype(str) == expected['diagnosis_class'].astype(str)).all()
+
+
+def test_result_column_types(preprocessed_climate, parameters):
+    """The models write float64 results, the result columns are only converted to float32 once they have run"""
+
+    store = BuildingStore(*shuffled(varied_stock()))
+    assert store.boundaries['annual_thermal_losses'].dtype == np.float64
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('error', 'Setting an item of incompatible dtype', FutureWarning)
+        run_models_quick(store, None, preprocessed_climate, {}, parameters)
+
+    for frame, col in [(store.buildings, 'annual_heating_needs'), (store.boundaries, 'annual_thermal_losses'),
+                       (store.boundaries, 'conventional_unified_degree_hours')]:
+        assert frame[col].dtype == np.float32
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Simulation.main import run_models_quick
+from Simulation.store import BuildingStore
+from Simulation.streaming import read_partitions, simulate_partitions, DEFAULT_RESULT_COLUMNS
+from conftest import varied_stock
+
+
+@pytest.fixture(params=['csv', 'parquet'])
+def stock_files(request, tmp_path):
+    """The buildings and boundaries of a synthetic stock written to files sorted by building_id"""
+
+    buildings, boundaries = varied_stock()
+    building_file, boundary_file = [str(tmp_path / f'{name}.{request.param}') for name in ['buildings', 'boundaries']]
+    for frame, path in [(buildings, building_file), (boundaries.sort_values('building_id', kind='stable'),
+                                                    boundary_file)]:
+        if request.param == 'csv':
+            frame.to_csv(path, sep=';', index=False)
+        else:
+            frame.to_parquet(path, index=False)
+
+    return building_file, boundary_file
+
+
+@pytest.mark.parametrize('partition_size', [7, 100])
+def test_read_partitions(stock_files, partition_size):
+    buildings, boundaries = varied_stock()
+
+    partitions = list(read_partitions(*stock_files, partition_size=partition_size))
+
+    assert len(partitions) == int(np.ceil(buildings.shape[0] / partition_size))
+    assert sum(partition[0].shape[0] for partition in partitions) == buildings.shape[0]
+    for partition_buildings, partition_boundaries in partitions:
+        expected = boundaries.loc[boundaries['building_id'].isin(partition_buildings['building_id'])]
+        assert list(partition_buildings.index) == list(partition_buildings['building_id'])
+        assert partition_boundaries.shape[0] == expected.shape[0]
+        assert partition_boundaries['building_id'].isin(partition_buildings['building_id']).all()
+
+
+def test_read_partitions_unsorted(tmp_path):
+    buildings, boundaries = varied_stock()
+    building_file, boundary_file = str(tmp_path / 'buildings.csv'), str(tmp_path / 'boundaries.csv')
+    buildings.iloc[::-1].to_csv(building_file, sep=';', index=False)
+    boundaries.to_csv(boundary_file, sep=';', index=False)
+
+    with pytest.raises(ValueError):
+        list(read_partitions(building_file, boundary_file, partition_size=10))
+
+
+def test_simulate_partitions(stock_files, preprocessed_climate, parameters, tmp_path):
+    output_path = str(tmp_path / f'results.{stock_files[0].split(".")[-1]}')
+
+    building_count = simulate_partitions(*stock_files, preprocessed_climate, parameters, output_path,
+                                         partition_size=15)
+
+    buildings, boundaries = varied_stock()
+    expected = run_models_quick(BuildingStore(buildings, boundaries), None, preprocessed_climate,
+                                preprocessed_climate.metadata, parameters)
+    if output_path.endswith('.csv'):
+        results = pd.read_csv(output_path, sep=';')
+    else:
+        results = pd.read_parquet(output_path)
+    assert building_count == buildings.shape[0]
+    assert list(results.columns) == DEFAULT_RESULT_COLUMNS
+    assert list(results['building_id']) == list(expected['building_id'])
+    for col in DEFAULT_RESULT_COLUMNS[1:-1]:
+        np.testing.assert_allclose(results[col].values, expected[col].values.astype(float), rtol=1e-6, err_msg=col)
+    assert (results['diagnosis_class'].values == expected['diagnosis_class'].astype(str).values).all()
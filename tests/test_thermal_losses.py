@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from Simulation.thermal_losses import degree_hour_table, unified_degree_hours, EXTERIOR_WALL, ROOF, FLOOR
+from Simulation.utils import heating_season
+
+
+def reference_degree_hours(climate, set_point):
+    """Calculates the air and ground unified degree hours and the heating season duration of one set point"""
+
+    season = heating_season(climate)
+    air_temperature = climate.loc[season, 'air_temperature']
+    ground_temperature = climate.loc[season, 'ground_temperature']
+
+    return ((set_point - air_temperature[air_temperature < set_point]).sum(),
+            (set_point - ground_temperature[ground_temperature < set_point]).sum(),
+            (air_temperature < set_point).sum())
+
+
+def test_degree_hour_table(climate):
+    set_points = [14., 17.5, 19., 19.25, 20., 21.3, 24.]
+    table = degree_hour_table(climate, set_points)
+
+    for set_point in set_points:
+        np.testing.assert_allclose(table.loc[set_point].values, reference_degree_hours(climate, set_point),
+                                   rtol=1e-12)
+
+
+@pytest.mark.parametrize('precomputed', [False, True])
+def test_unified_degree_hours(stock, preprocessed_climate, precomputed):
+    buildings, boundaries = stock
+    climate = preprocessed_climate.to_frame()
+    # a set point missing from the precomputed table
+    buildings.loc[buildings.index[0], 'actual_heating_set_point'] = 19.25
+    boundaries.loc[boundaries['building_id'] == buildings.index[0], 'actual_heating_set_point'] = 19.25
+    degree_hours = preprocessed_climate.degree_hours() if precomputed else None
+
+    unified_degree_hours(buildings, boundaries, climate, degree_hours=degree_hours)
+
+    set_points = np.unique(np.concatenate([frame[f'{mode}_heating_set_point'].values
+                                           for frame in [buildings, boundaries] for mode in ['conventional', 'actual']]))
+    reference = {set_point: reference_degree_hours(climate, set_point) for set_point in set_points}
+    for mode in ['conventional', 'actual']:
+        for types, position in [([EXTERIOR_WALL, ROOF], 0), ([FLOOR], 1)]:
+            selected = boundaries.loc[boundaries['type'].isin(types)]
+            expected = [reference[set_point][position] for set_point in selected[f'{mode}_heating_set_point']]
+            np.testing.assert_allclose(selected[f'{mode}_unified_degree_hours'].values, expected, rtol=1e-12)
+        expected = [reference[set_point][0] for set_point in buildings[f'{mode}_heating_set_point']]
+        np.testing.assert_allclose(buildings[f'{mode}_unified_degree_hours'].values, expected, rtol=1e-12)
+
+    expected = [reference[set_point][2] for set_point in buildings['actual_heating_set_point']]
+    np.testing.assert_array_equal(buildings['heating_season_duration'].values, expected)
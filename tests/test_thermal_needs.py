@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from Simulation.thermal_needs import calculate_thermal_needs
+
+NEED_COLUMNS = ['annual_thermal_losses', 'annual_occupant_gains', 'annual_solar_gains', 'annual_heating_needs',
+                'peak_heating_needs', 'conventional_thermal_losses', 'conventional_occupant_gains',
+                'conventional_heating_needs']
+
+
+def reference_thermal_needs(buildings, boundaries, parameters):
+    """Calculates the thermal needs building by building"""
+
+    gain_share = parameters.maximal_occupant_gain_share
+    solar_share = parameters.maximal_solar_gain_share
+    needs = pd.DataFrame(0., index=buildings.index, columns=NEED_COLUMNS)
+
+    for building_id in buildings.loc[buildings.to_sim, 'building_id']:
+        building = buildings.loc[building_id]
+        building_boundaries = boundaries.loc[boundaries['building_id'] == building_id]
+
+        losses = building_boundaries['annual_thermal_losses'].sum() + building['annual_ventilation_losses']
+        occupant_gains = np.clip(building['annual_occupant_gains'], 0., gain_share * losses)
+        solar_gains = np.clip(building_boundaries['transmitted_solar_gain'].sum(), 0., solar_share * losses)
+        heating_needs = (((losses - solar_gains) * building['heated_area_share'] * building['intermittency_factor'] -
+                          occupant_gains) * building['regulation_factor'])
+
+        conventional_losses = (building_boundaries['conventional_thermal_losses'].sum() +
+                               building['conventional_ventilation_losses'])
+        conventional_gains = np.clip(building['conventional_occupant_gains'], 0., gain_share * conventional_losses)
+        conventional_needs = (((conventional_losses - solar_gains) * building['heated_area_share'] *
+                               building['conventional_intermittency_factor'] - conventional_gains) *
+                              building['regulation_factor'])
+
+        peak_needs = building_boundaries['peak_thermal_losses'].sum() + building['peak_ventilation_losses']
+        if building['intermittency_factor'] == 0.:
+            peak_needs = 0.
+
+        needs.loc[building_id] = [losses, occupant_gains, solar_gains, max(heating_needs, 0.), peak_needs,
+                                  conventional_losses, conventional_gains, conventional_needs]
+
+    return needs
+
+
+def test_calculate_thermal_needs(stock, parameters):
+    buildings, boundaries = stock
+    if buildings.shape[0] > 1:
+        buildings.loc[buildings.index[::7], 'to_sim'] = False
+        buildings.loc[buildings.index[::5], 'intermittency_factor'] = 0.
+        # a building without boundaries
+        boundaries = boundaries.loc[boundaries['building_id'] != buildings.index[3]]
+
+    expected = reference_thermal_needs(buildings, boundaries, parameters)
+    calculate_thermal_needs(buildings, boundaries, parameters)
+
+    simulated = buildings['to_sim'].values.astype(bool)
+    for col in NEED_COLUMNS:
+        np.testing.assert_allclose(buildings.loc[simulated, col].values, expected.loc[simulated, col].values,
+                                   rtol=1e-12, err_msg=col)
+    for col in ['annual_heating_needs', 'conventional_heating_needs', 'peak_heating_needs']:
+        assert (buildings.loc[~simulated, col] == 0.).all()
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Simulation.utils import add_parameter_from_building, building_boundary_index
+from conftest import varied_stock
+
+
+def reference_parameter_from_building(boundaries, buildings, boundary_parameter_name, building_parameter_name,
+                                      boundary_types):
+    """Sets the building parameter on the boundaries building by building and type by type"""
+
+    for building_index in buildings.index:
+        current_boundaries = boundaries.loc[boundaries['building_id'] == buildings.loc[building_index, 'building_id']]
+        for boundary_type in boundary_types:
+            type_boundaries = current_boundaries.loc[current_boundaries['type'] == boundary_type]
+            boundaries.loc[type_boundaries.index, boundary_parameter_name] = buildings.loc[building_index,
+                                                                                           building_parameter_name]
+
+    return boundaries
+
+
+@pytest.mark.parametrize('boundary_types', [None, [0, 2]])
+def test_add_parameter_from_building(boundary_types):
+    buildings, boundaries = varied_stock()
+    # the boundaries of the missing buildings keep their value
+    buildings = buildings.sample(frac=0.7, random_state=0)
+    boundaries['set_point'] = -1.
+    expected = reference_parameter_from_building(boundaries.copy(), buildings, 'set_point', 'actual_heating_set_point',
+                                                 range(4) if boundary_types is None else boundary_types)
+
+    add_parameter_from_building(boundaries, buildings, 'set_point', 'actual_heating_set_point', boundary_types)
+
+    assert (boundaries['set_point'] == -1.).any() and (boundaries['set_point'] != -1.).any()
+    pd.testing.assert_series_equal(boundaries['set_point'], expected['set_point'])
+
+
+def test_building_boundary_index():
+    buildings, boundaries = varied_stock()
+    buildings = buildings.sample(frac=0.7, random_state=0)
+
+    building_rows = building_boundary_index(boundaries, buildings)
+
+    missing = ~boundaries['building_id'].isin(buildings['building_id']).values
+    assert (building_rows[missing] == -1).all()
+    np.testing.assert_array_equal(buildings['building_id'].values[building_rows[~missing]],
+                                  boundaries['building_id'].values[~missing])